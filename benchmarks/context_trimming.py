@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+Benchmark context window trimming as conversation history grows.
+
+Compares the single pass trimming over precomputed token counts with the
+previous approach, which popped the oldest message and re-counted the whole
+remaining list after each pop.
+"""
+
+import argparse
+import timeit
+
+from chatgpt_wrapper.backends.openai.context import REPLY_PRIMING_TOKENS, strip_messages_over_max_tokens
+
+MESSAGE_TOKENS = 50
+MAX_TOKENS = 4000
+HISTORY_SIZES = [100, 500, 1000, 2000, 5000, 10000]
+LEGACY_MAX_HISTORY_SIZE = 2000
+
+def make_messages(count):
+    messages = [{'role': 'system', 'content': 'system'}]
+    for i in range(count):
+        messages.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': ' '.join(['token'] * (MESSAGE_TOKENS - 5))})
+    return messages
+
+def count_tokens(messages):
+    # Cheap stand-in for tokenizing, the legacy algorithm's cost is dominated
+    # by how many times it is called, not by the tokenizer itself.
+    return sum(4 + 1 + len(m['content'].split()) for m in messages) + REPLY_PRIMING_TOKENS
+
+def legacy_strip(messages, max_tokens):
+    messages = list(messages)
+    token_count = count_tokens(messages)
+    while token_count > max_tokens and len(messages) > 1:
+        messages.pop(0)
+        token_count = count_tokens(messages)
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=5, help="runs per history size, default: 5")
+    args = parser.parse_args()
+    print(f"{'messages':>10} {'single pass (ms)':>18} {'legacy (ms)':>14}")
+    for size in HISTORY_SIZES:
+        messages = make_messages(size)
+        # Counts are computed once when messages are stored, so they are not
+        # part of the timed trimming work.
+        token_counts = [4 + 1 + len(m['content'].split()) for m in messages]
+        single_pass = timeit.timeit(lambda: strip_messages_over_max_tokens(messages, token_counts, MAX_TOKENS), number=args.number) / args.number
+        legacy = '-'
+        if size <= LEGACY_MAX_HISTORY_SIZE:
+            legacy = "%.2f" % (timeit.timeit(lambda: legacy_strip(messages, MAX_TOKENS), number=1) * 1000)
+        print(f"{size:>10} {single_pass * 1000:>18.3f} {legacy:>14}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Benchmark listing conversation history for a user with many conversations.
+
+Compares loading full Conversation ORM objects and converting each with a
+per-row mapper inspection (the previous get_history path) against the
+column-projected rows get_history uses now.
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import insert, inspect
+
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.backends.openai.api import HISTORY_COLUMNS
+from chatgpt_wrapper.backends.openai.orm import Base, create_storage, Conversation, engine_registry
+
+def legacy_object_as_dict(obj):
+    return {c.key: getattr(obj, c.key) for c in inspect(obj).mapper.column_attrs}
+
+def legacy_history(orm, user, limit):
+    return {c.id: legacy_object_as_dict(c) for c in orm.get_conversations(user, limit=limit)}
+
+def projected_history(orm, user, limit):
+    return {row.id: row._asdict() for row in orm.get_conversation_rows(user, HISTORY_COLUMNS, limit=limit)}
+
+def seed(orm, count):
+    user = orm.add_user('bench', None, None)
+    now = datetime.datetime.now()
+    rows = [dict(user_id=user.id, title=f'Conversation {i}', model='default', created_time=now, updated_time=now, hidden=False) for i in range(count)]
+    with orm.engine.begin() as conn:
+        conn.execute(insert(Conversation.__table__), rows)
+    return user
+
+def measure(orm, func, user, limit, number):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(number):
+        func(orm, user, limit)
+        # Drop loaded objects so every run starts cold, as a new request would.
+        orm.session.expunge_all()
+    elapsed = (time.perf_counter() - start) / number
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--conversations", type=int, default=100000, help="conversations for the user, default: 100000")
+    parser.add_argument("-n", "--number", type=int, default=3, help="runs per measurement, default: 3")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database = "sqlite:///%s" % os.path.join(directory, "history.db")
+        orm = create_storage(Config(config_dir=directory, data_dir=directory, config={'database': database}))
+        Base.metadata.create_all(orm.engine)
+        user = seed(orm, args.conversations)
+        print(f"{'listing':>10} {'path':>10} {'time (ms)':>12} {'peak (KiB)':>12}")
+        for label, limit in [('page', 20), ('full', None)]:
+            for path, func in [('orm', legacy_history), ('projected', projected_history)]:
+                elapsed, peak = measure(orm, func, user, limit, args.number)
+                print(f"{label:>10} {path:>10} {elapsed * 1000:>12.2f} {peak / 1024:>12.0f}")
+        engine_registry.dispose(database)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Benchmark SQLite inserts and reads with and without the performance profile.
+
+The baseline runs with SQLite's defaults (rollback journal, full fsync on
+every commit) and SQLAlchemy's default pool. The profile uses the default
+database_options: WAL journal mode, synchronous=NORMAL and a connection pool.
+
+Inserts commit one message at a time, the same way the shell stores them.
+Reads run from several threads while a writer keeps inserting.
+"""
+
+import argparse
+import copy
+import os
+import tempfile
+import threading
+import time
+
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.backends.openai.orm import Base, create_storage, engine_registry
+import chatgpt_wrapper.core.constants as constants
+
+BASELINE_OPTIONS = {
+    'pool_class': None,
+    'pool_size': None,
+    # Configured options are merged over the defaults, null skips a pragma.
+    'sqlite_pragmas': {name: None for name in constants.DEFAULT_SQLITE_PRAGMAS},
+}
+
+def make_orm(directory, name, options):
+    config = Config(config_dir=directory, data_dir=directory, config={
+        'database': "sqlite:///%s" % os.path.join(directory, "%s.db" % name),
+        'database_options': copy.deepcopy(options),
+    })
+    orm = create_storage(config)
+    Base.metadata.create_all(orm.engine)
+    return orm
+
+def bench_inserts(orm, conversation, count):
+    start = time.perf_counter()
+    for i in range(count):
+        orm.add_message(conversation, 'user', f'message number {i}', prompt_tokens=10)
+    return count / (time.perf_counter() - start)
+
+def bench_concurrent_reads(orm, conversation, threads, duration):
+    reads = [0] * threads
+    stop = threading.Event()
+
+    def reader(index):
+        while not stop.is_set():
+            orm.get_last_messages(conversation, limit=20)
+            reads[index] += 1
+        orm.close_session()
+
+    def writer():
+        while not stop.is_set():
+            orm.add_message(conversation, 'assistant', 'concurrent write', completion_tokens=10)
+        orm.close_session()
+
+    workers = [threading.Thread(target=reader, args=(i,)) for i in range(threads)] + [threading.Thread(target=writer)]
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(reads) / duration
+
+def run(directory, name, options, args):
+    orm = make_orm(directory, name, options)
+    user = orm.add_user('bench', None, None, 'gpt-3.5-turbo', {})
+    conversation = orm.add_conversation(user, 'Benchmark')
+    inserts = bench_inserts(orm, conversation, args.inserts)
+    reads = bench_concurrent_reads(orm, conversation, args.threads, args.duration)
+    engine_registry.dispose(orm.database)
+    return inserts, reads
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inserts", type=int, default=500, help="single message commits to time, default: 500")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="concurrent reader threads, default: 4")
+    parser.add_argument("-d", "--duration", type=float, default=3.0, help="seconds to run concurrent reads, default: 3")
+    args = parser.parse_args()
+    profile_options = constants.DEFAULT_CONFIG['database_options']
+    print(f"{'profile':>10} {'inserts/s':>12} {'reads/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, options in [('baseline', BASELINE_OPTIONS), ('tuned', profile_options)]:
+            inserts, reads = run(directory, name, options, args)
+            print(f"{name:>10} {inserts:>12.1f} {reads:>12.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import atexit
 import base64
 import json
@@ -7,6 +8,7 @@ import datetime
 import uuid
 import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List
 from playwright.sync_api import sync_playwright
 from playwright._impl._api_structures import ProxySettings
@@ -20,7 +22,7 @@ from langchain.schema import (
 )
 from langchain.chat_models.openai import _convert_dict_to_message
 
-from chatgpt_wrapper.core.backend import Backend
+from chatgpt_wrapper.core.backend import Backend, AsyncTokenStream
 from chatgpt_wrapper.core import util
 import chatgpt_wrapper.core.constants as constants
 
@@ -32,6 +34,8 @@ def make_llm_class(klass):
         model_name: str = "gpt-3.5-turbo"
         temperature: float = 0.7
         verbose: bool = False
+        title: Optional[str] = None
+        model_customizations: dict = {}
         chatgpt: Computed[ChatGPT]
 
         @computed('chatgpt')
@@ -44,33 +48,80 @@ def make_llm_class(klass):
             if model_name:
                 self.model_name = model_name
 
-        def _agenerate(self):
-            pass
-
-        def _generate(
-            self, messages: any, stop: Optional[List[str]] = None
-        ) -> ChatResult:
+        def _build_prompt(self, messages):
             prompts = []
             if isinstance(messages, str):
                 messages = [messages]
             for message in messages:
                 content = message.content if isinstance(message, BaseMessage) else message
                 prompts.append(content)
+            return "\n\n".join(prompts)
+
+        def _build_result(self, inner_completion, role="assistant"):
+            message = _convert_dict_to_message(
+                {"content": inner_completion, "role": role}
+            )
+            generation = ChatGeneration(message=message)
+            llm_output = {"model_name": self.model_name}
+            return ChatResult(generations=[generation], llm_output=llm_output)
+
+        def _ask_stream(self, messages):
+            return self.chatgpt._ask_stream(self._build_prompt(messages), title=self.title, model_customizations=self.model_customizations)
+
+        async def _agenerate(
+            self, messages: any, stop: Optional[List[str]] = None
+        ) -> ChatResult:
+            # The page is read by the blocking, polling generator on the
+            # browser thread, which hands the tokens to the event loop.
+            loop = asyncio.get_running_loop()
+            tokens = asyncio.Queue()
+            done = object()
+
+            def produce():
+                try:
+                    for token in self._ask_stream(messages):
+                        loop.call_soon_threadsafe(tokens.put_nowait, token)
+                finally:
+                    loop.call_soon_threadsafe(tokens.put_nowait, done)
+
+            producer = asyncio.wrap_future(self.chatgpt.run_in_browser_thread(produce))
+            inner_completion = ""
+            try:
+                while True:
+                    token = await tokens.get()
+                    if token is done:
+                        break
+                    inner_completion += token
+                    if self.streaming:
+                        if self.callback_manager.is_async:
+                            await self.callback_manager.on_llm_new_token(
+                                token,
+                                verbose=self.verbose,
+                            )
+                        else:
+                            self.callback_manager.on_llm_new_token(
+                                token,
+                                verbose=self.verbose,
+                            )
+                await producer
+            except asyncio.CancelledError:
+                # Interrupts the generator, the browser thread stays busy until it stops.
+                self.chatgpt.streaming = False
+                raise
+            return self._build_result(inner_completion)
+
+        def _generate(
+            self, messages: any, stop: Optional[List[str]] = None
+        ) -> ChatResult:
             inner_completion = ""
-            role = "assistant"
-            for token in self.chatgpt._ask_stream("\n\n".join(prompts)):
+            for token in self._ask_stream(messages):
                 inner_completion += token
                 if self.streaming:
                     self.callback_manager.on_llm_new_token(
                         token,
                         verbose=self.verbose,
                     )
-            message = _convert_dict_to_message(
-                {"content": inner_completion, "role": role}
-            )
-            generation = ChatGeneration(message=message)
-            llm_output = {"model_name": self.model_name}
-            return ChatResult(generations=[generation], llm_output=llm_output)
+            return self._build_result(inner_completion)
 
     return ChatGPTLLM
 
@@ -93,6 +144,7 @@ class ChatGPT(Backend):
         self.page = None
         self.browser = None
         self.session = None
+        self.browser_executor = None
         self.set_llm_class(make_llm_class(self))
         self.new_conversation()
 
@@ -141,6 +193,22 @@ class ChatGPT(Backend):
         self.log.info("ChatGPT browser initialized")
         return self
 
+    def run_in_browser_thread(self, func, *args, **kwargs):
+        """
+        Run func on the backend's browser thread, returns a concurrent.futures.Future.
+
+        Playwright's sync API only works on the thread that started it, and
+        never inside a running event loop, so async code launches the browser
+        with launch_browser_async(), and every call using it runs here.
+        """
+        if self.browser_executor is None:
+            self.browser_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chatgpt-browser")
+        return self.browser_executor.submit(func, *args, **kwargs)
+
+    async def launch_browser_async(self, timeout=60, proxy: Optional[ProxySettings] = None):
+        """launch_browser() on the browser thread, to use the backend from async code."""
+        return await asyncio.wrap_future(self.run_in_browser_thread(self.launch_browser, timeout, proxy))
+
     def destroy_primary_profile(self):
         primary_profile = self.get_primary_profile_directory()
         shutil.rmtree(primary_profile)
@@ -149,7 +217,14 @@ class ChatGPT(Backend):
         self.log.info(message)
 
     def _shutdown(self):
-        self.cleanup()
+        if self.browser_executor is None:
+            self.cleanup()
+            return
+        try:
+            self.run_in_browser_thread(self.cleanup).result()
+        except RuntimeError:
+            # The browser thread already stopped at interpreter exit.
+            pass
 
     def _start_browser(self):
         self.page.goto("https://chat.openai.com/")
@@ -566,6 +641,13 @@ class ChatGPT(Backend):
         ).replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
         self.page.evaluate(code)
 
+    def make_request_llm(self, title=None, model_customizations={}, args={}):
+        llm = self.make_llm(args)
+        # make_llm() returns a copy, these only apply to this request.
+        llm.title = title
+        llm.model_customizations = model_customizations
+        return llm
+
     def ask(self, message, title=None, model_customizations={}):
         """
         Send a message to chatGPT and return the response.
@@ -576,7 +658,7 @@ class ChatGPT(Backend):
         Returns:
             str: The response received from OpenAI.
         """
-        llm = self.make_llm()
+        llm = self.make_request_llm(title, model_customizations)
         try:
             response = llm(message)
         except ValueError as e:
@@ -593,14 +675,37 @@ class ChatGPT(Backend):
         Returns:
             str: The response received from OpenAI.
         """
-        args = self.streaming_args()
-        llm = self.make_llm(args)
+        llm = self.make_request_llm(title, model_customizations, self.streaming_args())
         try:
             response = llm(message)
         except ValueError as e:
             return False, message, e
         return True, response.content, "Response received"
 
+    async def _ask_llm_async(self, llm, message):
+        try:
+            result = await llm.agenerate([message])
+        except ValueError as e:
+            return False, message, e
+        return True, result.generations[0][0].message.content, "Response received"
+
+    async def ask_async(self, message, title=None, model_customizations={}):
+        """
+        Send a message to chatGPT and return the response, from a coroutine.
+
+        The browser is driven from the browser thread, launch it with
+        launch_browser_async() first, so the event loop never blocks.
+        """
+        return await self._ask_llm_async(self.make_request_llm(title, model_customizations), message)
+
+    def ask_stream_async(self, message, title=None, model_customizations={}, max_buffered_tokens=constants.DEFAULT_STREAM_MAX_BUFFERED_TOKENS):
+        """
+        Send a message to chatGPT, returns an AsyncTokenStream of the response.
+        """
+        stream = AsyncTokenStream(max_buffered_tokens)
+        llm = self.make_request_llm(title, model_customizations, self.async_streaming_args([stream.handler]))
+        return stream.start(self._ask_llm_async(llm, message))
+
     def new_conversation(self):
         super().new_conversation()
         self.parent_message_id = str(uuid.uuid4())
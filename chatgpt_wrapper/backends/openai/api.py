@@ -1,28 +1,41 @@
 import os
 import threading
 import openai
-import tiktoken
 
 from openai.error import OpenAIError
 
 from langchain.chat_models.openai import ChatOpenAI, _convert_dict_to_message
 
-from chatgpt_wrapper.core.backend import Backend
+from chatgpt_wrapper.core.backend import Backend, TokenStream, AsyncTokenStream
 import chatgpt_wrapper.core.constants as constants
 import chatgpt_wrapper.core.util as util
 from chatgpt_wrapper.backends.openai.user import UserManager
 from chatgpt_wrapper.backends.openai.conversation import ConversationManager
 from chatgpt_wrapper.backends.openai.message import MessageManager
+from chatgpt_wrapper.backends.openai.tokens import MESSAGE_OVERHEAD_TOKENS, encoding_registry, build_message_token_counts, get_num_tokens_from_messages_batch
+from chatgpt_wrapper.backends.openai.context import REPLY_PRIMING_TOKENS, strip_messages_over_max_tokens, get_context_strategy_class
+from chatgpt_wrapper.backends.openai.http_sessions import http_sessions
+
+# Columns needed to list conversation history.
+HISTORY_COLUMNS = (
+    'id',
+    'title',
+    'model',
+    'created_time',
+    'updated_time',
+    'hidden',
+)
 
 class OpenAIAPI(Backend):
     def __init__(self, config=None, default_user_id=None):
         super().__init__(config)
         self._configure_access_info()
         self.user_manager = UserManager(self.config)
-        self.conversation = ConversationManager(self.config)
-        self.message = MessageManager(self.config)
+        self.conversation = ConversationManager(self.config, self.user_manager.orm)
+        self.message = MessageManager(self.config, self.user_manager.orm)
         self.current_user = None
         self.conversation_tokens = 0
+        self.message_token_counts = {}
         self.set_llm_class(ChatOpenAI)
         self.set_model_system_message()
         self.set_model_temperature(self.config.get('chat.model_customizations.temperature'))
@@ -30,6 +43,7 @@ class OpenAIAPI(Backend):
         self.set_model_presence_penalty(self.config.get('chat.model_customizations.presence_penalty'))
         self.set_model_frequency_penalty(self.config.get('chat.model_customizations.frequency_penalty'))
         self.set_model_max_submission_tokens(self.config.get('chat.model_customizations.max_submission_tokens'))
+        self.set_model_context_strategy(self.config.get('chat.model_customizations.context_strategy.name'))
         if default_user_id is not None:
             success, user, user_message = self.user_manager.get_by_user_id(default_user_id)
             if not success:
@@ -53,43 +67,102 @@ class OpenAIAPI(Backend):
             self.log.error(message)
         return success, obj, message
 
-    def get_token_encoding(self, model="gpt-3.5-turbo"):
-        if model not in self.available_models.values():
-            raise NotImplementedError("Unsupported engine {self.engine}")
+    def get_token_encoding(self, model=None):
+        model = model or self.model
+        if model not in self.available_model_names:
+            raise NotImplementedError(f"Unsupported model {model}")
         try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
+            encoding, cached = encoding_registry.get(model)
         except Exception as e:
             raise Exception(f"Unable to get token encoding for model {model}: {str(e)}")
+        if not cached:
+            self.log.debug(f"Loaded token encoding for model {model}, encoding registry stats: {encoding_registry.stats()}")
         return encoding
 
-    def get_num_tokens_from_messages(self, messages, encoding=None):
+    def warm_token_encoding(self):
+        if not self.model:
+            return
+        try:
+            self.get_token_encoding()
+        except Exception as e:
+            self.log.warning(f"Unable to preload token encoding: {str(e)}")
+            return
+        self.log.debug(f"Token encoding ready for model {self.model}, encoding registry stats: {encoding_registry.stats()}")
+
+    def get_num_tokens_from_message(self, message, encoding=None):
+        """Returns the number of tokens used by a single message, excluding reply priming."""
         if not encoding:
             encoding = self.get_token_encoding()
+        num_tokens = MESSAGE_OVERHEAD_TOKENS
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
+
+    def get_num_tokens_from_messages(self, messages, encoding=None):
         """Returns the number of tokens used by a list of messages."""
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
+        if not encoding:
+            encoding = self.get_token_encoding()
+        num_tokens = sum(self.get_num_tokens_from_message(message, encoding) for message in messages)
+        num_tokens += REPLY_PRIMING_TOKENS
         return num_tokens
 
+    def get_num_tokens_from_messages_batch(self, messages, encoding=None):
+        """Returns an array of per-message token counts, encoded in parallel."""
+        if not encoding:
+            encoding = self.get_token_encoding()
+        return get_num_tokens_from_messages_batch(messages, encoding)
+
+    def _backfill_message_token_counts(self, messages):
+        if not messages:
+            return
+        counts = self.get_num_tokens_from_messages_batch([self.build_openai_message(m.role, m.message) for m in messages])
+        token_counts = [dict(id=m.id, **build_message_token_counts(m.role, token_count)) for m, token_count in zip(messages, counts)]
+        self.log.debug(f"Backfilling token counts for {len(token_counts)} messages")
+        success, _, user_message = self.message.edit_message_token_counts(token_counts)
+        if not success:
+            raise Exception(user_message)
+        for token_count in token_counts:
+            self.message_token_counts[token_count['id']] = token_count['prompt_tokens'] + token_count['completion_tokens']
+
+    def get_stored_message_token_counts(self, messages):
+        """Returns the per-message token counts for stored messages.
+
+        Counts are read from the in-memory cache or the message row, and only
+        messages that have never been counted are tokenized (once).
+        """
+        message_ids = [m.id for m in messages]
+        missing = []
+        for m in messages:
+            if m.id not in self.message_token_counts:
+                token_count = m.prompt_tokens + m.completion_tokens
+                if token_count:
+                    self.message_token_counts[m.id] = token_count
+                else:
+                    missing.append(m)
+        self._backfill_message_token_counts(missing)
+        return [self.message_token_counts[message_id] for message_id in message_ids]
+
     def switch_to_conversation(self, conversation_id, parent_message_id):
         super().switch_to_conversation(conversation_id, parent_message_id)
+        self.message_token_counts = {}
         tokens = self.get_conversation_token_count(conversation_id)
         self.conversation_tokens = tokens
 
-    def get_conversation_token_count(self, conversation_id=None):
-        conversation_id = conversation_id or self.conversation_id
-        success, old_messages, user_message = self.message.get_messages(conversation_id)
+    def _get_stored_token_count(self, conversation_id, target_id=None):
+        success, missing_messages, user_message = self.message.get_messages_without_token_counts(conversation_id)
         if not success:
             raise Exception(user_message)
-        token_messages = self.prepare_prompt_messsage_context(old_messages)
-        tokens = self.get_num_tokens_from_messages(token_messages)
+        self._backfill_message_token_counts(missing_messages)
+        success, tokens, user_message = self.message.get_conversation_token_count(conversation_id, target_id)
+        if not success:
+            raise Exception(user_message)
+        return tokens
+
+    def get_conversation_token_count(self, conversation_id=None):
+        conversation_id = conversation_id or self.conversation_id
+        tokens = self._get_stored_token_count(conversation_id) + REPLY_PRIMING_TOKENS
         return tokens
 
     def extract_system_message(self, model_customizations):
@@ -105,30 +178,42 @@ class OpenAIAPI(Backend):
     def _extract_message_content(self, message):
         return message.content
 
-    def gen_title_thread(self, conversation):
-        self.log.info(f"Generating title for conversation {conversation.id}")
-        # NOTE: This might need to be smarter in the future, but for now
-        # it should be reasonable to assume that the second record is the
-        # first user message we need for generating the title.
-        success, messages, user_message = self.message.get_messages(conversation.id, limit=2)
-        if success:
-            user_content = messages[1].message
-            new_messages = [
-                self.build_openai_message('system', constants.DEFAULT_TITLE_GENERATION_SYSTEM_PROMPT),
-                self.build_openai_message('user', "%s: %s" % (constants.DEFAULT_TITLE_GENERATION_USER_PROMPT, user_content)),
-            ]
-            success, completion, user_message = self._call_openai_non_streaming(new_messages, temperature=0)
+    def gen_title_thread(self, conversation_id, model=None, top_p=None, presence_penalty=None, frequency_penalty=None):
+        self.log.info(f"Generating title for conversation {conversation_id}")
+        try:
+            # NOTE: This might need to be smarter in the future, but for now
+            # it should be reasonable to assume that the second record is the
+            # first user message we need for generating the title.
+            success, messages, user_message = self.message.get_messages(conversation_id, limit=2)
             if success:
-                title = self._extract_message_content(completion)
-                self.log.info(f"Title generated for conversation {conversation.id}: {title}")
-                success, conversation, user_message = self.conversation.edit_conversation_title(conversation.id, title)
+                user_content = messages[1].message
+                new_messages = [
+                    self.build_openai_message('system', constants.DEFAULT_TITLE_GENERATION_SYSTEM_PROMPT),
+                    self.build_openai_message('user', "%s: %s" % (constants.DEFAULT_TITLE_GENERATION_USER_PROMPT, user_content)),
+                ]
+                success, completion, user_message = self._call_openai_non_streaming(new_messages, temperature=0, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, model=model)
                 if success:
-                    self.log.debug(f"Title saved for conversation {conversation.id}")
-                    return
-        self.log.info(f"Failed to generate title for conversation: {str(user_message)}")
+                    title = self._extract_message_content(completion)
+                    self.log.info(f"Title generated for conversation {conversation_id}: {title}")
+                    success, conversation, user_message = self.conversation.edit_conversation_title(conversation_id, title)
+                    if success:
+                        self.log.debug(f"Title saved for conversation {conversation_id}")
+                        return
+            self.log.info(f"Failed to generate title for conversation: {str(user_message)}")
+        finally:
+            self.conversation.orm.close_session()
 
     def gen_title(self, conversation):
-        thread = threading.Thread(target=self.gen_title_thread, args=(conversation,))
+        # Only the id is handed to the thread, ORM objects belong to this
+        # thread's session. The request settings are copied, a pooled
+        # backend is reset for the next request while the thread runs.
+        request_args = {
+            'model': self.model,
+            'top_p': self.model_top_p,
+            'presence_penalty': self.model_presence_penalty,
+            'frequency_penalty': self.model_frequency_penalty,
+        }
+        thread = threading.Thread(target=self.gen_title_thread, args=(conversation.id,), kwargs=request_args)
         thread.start()
 
     def get_backend_name(self):
@@ -136,6 +221,7 @@ class OpenAIAPI(Backend):
 
     def set_available_models(self):
         self.available_models = constants.OPENAPI_CHAT_RENDER_MODELS
+        self.available_model_names = set(self.available_models.values())
 
     def set_model_system_message(self, message=constants.SYSTEM_MESSAGE_DEFAULT):
         self.model_system_message = message
@@ -155,6 +241,12 @@ class OpenAIAPI(Backend):
     def set_model_max_submission_tokens(self, max_submission_tokens=constants.OPENAPI_DEFAULT_MAX_SUBMISSION_TOKENS):
         self.model_max_submission_tokens = max_submission_tokens
 
+    def set_model_context_strategy(self, context_strategy=constants.DEFAULT_CONTEXT_STRATEGY):
+        context_strategy = context_strategy or constants.DEFAULT_CONTEXT_STRATEGY
+        klass = get_context_strategy_class(context_strategy)
+        self.model_context_strategy = context_strategy
+        self.context_strategy = klass(self, self.config.get(f'chat.model_customizations.context_strategy.{context_strategy}'))
+
     def get_runtime_config(self):
         output = """
 * Model customizations:
@@ -164,8 +256,13 @@ class OpenAIAPI(Backend):
   * Presence penalty: %s
   * Frequency penalty: %s
   * Max submission tokens: %s
+  * Context strategy: %s
   * System message: %s
-""" % (self.model, self.model_temperature, self.model_top_p, self.model_presence_penalty, self.model_frequency_penalty, self.model_max_submission_tokens, self.model_system_message)
+""" % (self.model, self.model_temperature, self.model_top_p, self.model_presence_penalty, self.model_frequency_penalty, self.model_max_submission_tokens, self.model_context_strategy, self.model_system_message)
+        cache = self.message.orm.cache
+        if cache:
+            stats = cache.stats()
+            output += "* Conversation cache: %d hits, %d misses, %d evictions, %d/%d conversations\n" % (stats['hits'], stats['misses'], stats['evictions'], stats['conversations'], stats['max_conversations'])
         return output
 
     def get_system_message_aliases(self):
@@ -182,15 +279,13 @@ class OpenAIAPI(Backend):
 
     def prepare_prompt_conversation_messages(self, prompt, conversation_id=None, target_id=None, system_message=None):
         old_messages = []
-        new_messages = []
+        new_messages = [self.build_openai_message('user', prompt)]
         if conversation_id:
-            success, old_messages, message = self.message.get_messages(conversation_id, target_id=target_id)
-            if not success:
-                raise Exception(message)
+            reserved_tokens = self.get_num_tokens_from_message(new_messages[0])
+            old_messages = self.context_strategy.load_messages(conversation_id, target_id, reserved_tokens, self.model_max_submission_tokens)
         if len(old_messages) == 0:
             system_message = system_message or self.model_system_message
-            new_messages.append(self.build_openai_message('system', system_message))
-        new_messages.append(self.build_openai_message('user', prompt))
+            new_messages.insert(0, self.build_openai_message('system', system_message))
         return old_messages, new_messages
 
     def prepare_prompt_messsage_context(self, old_messages=[], new_messages=[]):
@@ -211,63 +306,106 @@ class OpenAIAPI(Backend):
         self.conversation_id = conversation.id
         return conversation
 
+    def _add_message_with_token_count(self, conversation_id, role, content, encoding):
+        token_count = self.get_num_tokens_from_message(self.build_openai_message(role, content), encoding)
+        success, message, user_message = self.message.add_message(conversation_id, role, content, **build_message_token_counts(role, token_count))
+        if not success:
+            raise Exception(user_message)
+        self.message_token_counts[message.id] = token_count
+        return message
+
     def add_new_messages_to_conversation(self, conversation_id, new_messages, response_message, title=None):
         conversation = self.create_new_conversation_if_needed(conversation_id, title)
-        for m in new_messages:
-            success, message, user_message = self.message.add_message(conversation.id, m['role'], m['content'])
-            if not success:
-                raise Exception(user_message)
-        success, last_message, user_message = self.message.add_message(conversation.id, 'assistant', response_message)
+        turn_messages = new_messages + [self.build_openai_message('assistant', response_message)]
+        token_counts = self.get_num_tokens_from_messages_batch(turn_messages)
+        success, messages, user_message = self.message.add_messages(conversation.id, [
+            dict(role=m['role'], message=m['content'], **build_message_token_counts(m['role'], token_count))
+            for m, token_count in zip(turn_messages, token_counts)
+        ])
         if not success:
             raise Exception(user_message)
+        for message, token_count in zip(messages, token_counts):
+            self.message_token_counts[message.id] = token_count
+        last_message = messages[-1]
         tokens = self.get_conversation_token_count()
         self.conversation_tokens = tokens
         return conversation, last_message
 
     def add_message(self, role, message, conversation_id=None):
         conversation_id = conversation_id or self.conversation_id
-        success, message, user_message = self.message.add_message(conversation_id, role, message)
-        if not success:
-            raise Exception(user_message)
-        return message
+        return self._add_message_with_token_count(conversation_id, role, message, self.get_token_encoding())
 
-    def _build_openai_chat_request(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None, stream=False):
+    def _build_openai_chat_request(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None, stream=False, stream_handlers=None, use_async=False, model=None):
+        model = model or self.model
         temperature = self.model_temperature if temperature is None else temperature
         top_p = self.model_top_p if top_p is None else top_p
         presence_penalty = self.model_presence_penalty if presence_penalty is None else presence_penalty
         frequency_penalty = self.model_frequency_penalty if frequency_penalty is None else frequency_penalty
-        self.log.debug(f"ChatCompletion.create with message count: {len(messages)}, model: {self.model}, temperature: {temperature}, top_p: {top_p}, presence_penalty: {presence_penalty}, frequency_penalty: {frequency_penalty}, stream: {stream})")
+        self.log.debug(f"ChatCompletion.create with message count: {len(messages)}, model: {model}, temperature: {temperature}, top_p: {top_p}, presence_penalty: {presence_penalty}, frequency_penalty: {frequency_penalty}, stream: {stream})")
         args = {
-            'model_name': self.model,
+            'model_name': model,
             'temperature': temperature,
             'top_p': top_p,
             'presence_penalty': presence_penalty,
             'frequency_penalty': frequency_penalty,
         }
-        if stream:
-            args.update(self.streaming_args(interrupt_handler=True))
+        if stream and use_async:
+            args.update(self.async_streaming_args(stream_handlers))
+        elif stream:
+            args.update(self.streaming_args(interrupt_handler=True, stream_handlers=stream_handlers))
         llm = self.make_llm(args)
+        if use_async:
+            http_sessions.install_async()
+        else:
+            http_sessions.install()
         messages = [_convert_dict_to_message(m) for m in messages]
         return llm, messages
 
-    def _call_openai_streaming(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None):
+    def _call_openai_streaming(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None, stream_handlers=None):
         self.log.debug(f"Initiated streaming request with message count: {len(messages)}")
-        llm, messages = self._build_openai_chat_request(messages, temperature=temperature, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, stream=True)
+        llm, messages = self._build_openai_chat_request(messages, temperature=temperature, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, stream=True, stream_handlers=stream_handlers)
         try:
             response = llm(messages)
         except ValueError as e:
             return False, messages, e
         return True, response, "Response received"
 
-    def _call_openai_non_streaming(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None):
+    def _call_openai_non_streaming(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None, model=None):
         self.log.debug(f"Initiated non-streaming request with message count: {len(messages)}")
-        llm, messages = self._build_openai_chat_request(messages, temperature=temperature, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty)
+        llm, messages = self._build_openai_chat_request(messages, temperature=temperature, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, model=model)
         try:
             response = llm(messages)
         except ValueError as e:
             return False, messages, e
         return True, response, "Response received"
 
+    async def _call_openai_async(self, messages, temperature=None, top_p=None, presence_penalty=None, frequency_penalty=None, stream_handlers=None):
+        self.log.debug(f"Initiated async request with message count: {len(messages)}, streaming: {bool(stream_handlers)}")
+        llm, messages = self._build_openai_chat_request(messages, temperature=temperature, top_p=top_p, presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, stream=bool(stream_handlers), stream_handlers=stream_handlers, use_async=True)
+        try:
+            result = await llm.agenerate([messages])
+        except ValueError as e:
+            return False, messages, e
+        return True, result.generations[0][0].message, "Response received"
+
+    async def _run_in_thread(self, func, *args, **kwargs):
+        """
+        Run blocking work, like database access, in a worker thread so it
+        does not block the event loop.
+
+        Worker threads are reused, so the thread's session is closed after.
+        """
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.user_manager.orm.close_session()
+        return await util.run_in_thread(run)
+
+    def set_active_model(self, model=None):
+        super().set_active_model(model)
+        self.warm_token_encoding()
+
     def set_current_user(self, user=None):
         self.current_user = user
         if self.current_user:
@@ -288,13 +426,91 @@ class OpenAIAPI(Backend):
         success, conversation, user_message = self.conversation.edit_conversation_title(conversation_id, title)
         return self._handle_response(success, conversation, user_message)
 
-    def get_history(self, limit=20, offset=0, user_id=None):
+    def edit_message(self, message_id, **kwargs):
+        success, message, user_message = self.message.edit_message(message_id, **kwargs)
+        if success:
+            self.message_token_counts.pop(message_id, None)
+            if message.conversation_id == self.conversation_id:
+                self.conversation_tokens = self.get_conversation_token_count()
+        return self._handle_response(success, message, user_message)
+
+    def get_history(self, limit=20, offset=0, user_id=None, cursor=None):
+        """
+        Get conversation history, newest first.
+
+        Pass the cursor from get_history_next_cursor() to fetch the next page,
+        offset is ignored when a cursor is given.
+        """
         user_id = user_id if user_id else self.current_user.id
-        success, conversations, message = self.conversation.get_conversations(user_id, limit=limit, offset=offset)
+        before_id = None
+        if cursor:
+            try:
+                before_id = int(util.decode_cursor(cursor)['before_id'])
+            except (ValueError, KeyError, TypeError):
+                return False, None, "Invalid history cursor"
+            offset = None
+        success, rows, message = self.conversation.get_conversation_rows(user_id, HISTORY_COLUMNS, limit=limit, offset=offset, before_id=before_id)
         if success:
-            history = {m.id: self.conversation.orm.object_as_dict(m) for m in conversations}
+            history = {row.id: row._asdict() for row in rows}
             return success, history, message
-        return self._handle_response(success, conversations, message)
+        return self._handle_response(success, rows, message)
+
+    def get_history_next_cursor(self, history, limit):
+        """Returns the opaque cursor for the page after history, or None on the last page."""
+        if history and len(history) >= int(limit):
+            return util.encode_cursor({'before_id': list(history.keys())[-1]})
+        return None
+
+    def semantic_search(self, query, limit=constants.DEFAULT_SEARCH_LIMIT, user_id=None):
+        """
+        Find the conversations that best match the meaning of query.
+
+        Messages stored since the last search are indexed first.
+
+        Returns a list of dicts with the best matching message of each
+        conversation, best first.
+        """
+        # Imported here, only semantic search needs numpy.
+        from chatgpt_wrapper.backends.openai.semantic import get_semantic_index
+        user_id = user_id if user_id else self.current_user.id
+        if not query or not query.strip():
+            return False, None, "Search query cannot be empty"
+        try:
+            index = get_semantic_index(self.config)
+            index.sync(self.message)
+            # Over-fetch, several hits usually come from the same conversation.
+            matches = index.search(query, limit=limit * constants.SEMANTIC_SEARCH_CANDIDATES_PER_RESULT, user_id=user_id)
+        except Exception as e:
+            return False, None, f"Semantic search failed: {str(e)}"
+        rows = {}
+        if matches:
+            success, message_rows, user_message = self.message.get_message_rows([m[0] for m in matches])
+            if not success:
+                return False, None, user_message
+            rows = {row.id: row for row in message_rows}
+        # Deleted since the last sync, drop them from the index.
+        deleted = [m[0] for m in matches if m[0] not in rows]
+        if deleted:
+            index.remove(deleted)
+        results = []
+        seen = set()
+        for message_id, conversation_id, score in matches:
+            if message_id not in rows or conversation_id in seen:
+                continue
+            seen.add(conversation_id)
+            row = rows[message_id]
+            results.append({
+                'conversation_id': conversation_id,
+                'title': row.title,
+                'message_id': message_id,
+                'role': row.role,
+                'message': row.message,
+                'created_time': row.created_time,
+                'score': score,
+            })
+            if len(results) >= limit:
+                break
+        return True, results, "Semantic search completed"
 
     def get_conversation(self, id=None):
         id = id if id else self.conversation_id
@@ -312,29 +528,29 @@ class OpenAIAPI(Backend):
     def new_conversation(self):
         super().new_conversation()
         self.conversation_tokens = 0
-
-    def _strip_out_messages_over_max_tokens(self, messages, token_count, max_tokens):
-        stripped_messages_count = 0
-        while token_count > max_tokens and len(messages) > 1:
-            message = messages.pop(0)
-            token_count = self.get_num_tokens_from_messages(messages)
-            self.log.debug(f"Stripping message: {message['role']}, {message['content']} -- new token count: {token_count}")
-            stripped_messages_count += 1
-        token_count = self.get_num_tokens_from_messages(messages)
-        if token_count > max_tokens:
-            raise Exception(f"No messages to send, all messages have been stripped, still over max submission tokens: {max_tokens}")
-        if stripped_messages_count > 0:
-            max_tokens_exceeded_warning = f"Conversation exceeded max submission tokens ({max_tokens}), stripped out {stripped_messages_count} oldest messages before sending, sent {token_count} tokens instead"
+        self.message_token_counts = {}
+
+    def _strip_out_messages_over_max_tokens(self, messages, token_counts, max_tokens):
+        messages, token_count, stripped_messages = strip_messages_over_max_tokens(messages, token_counts, max_tokens)
+        for message in stripped_messages:
+            self.log.debug(f"Stripped message: {message['role']}, {message['content']}")
+        stripped_count = len(stripped_messages)
+        if stripped_count > 0:
+            max_tokens_exceeded_warning = f"Conversation exceeded max submission tokens ({max_tokens}), stripped out {stripped_count} oldest messages before sending, sent {token_count} tokens instead"
             self.log.warning(max_tokens_exceeded_warning)
             util.print_status_message(False, max_tokens_exceeded_warning)
-        return messages
+        return messages, token_count
 
     def _prepare_ask_request(self, prompt, system_message=None):
+        # Makes sure stored token counts are complete before the context
+        # strategy selects messages by token count.
+        stored_tokens = self._get_stored_token_count(self.conversation_id, self.parent_message_id) if self.conversation_id else 0
         old_messages, new_messages = self.prepare_prompt_conversation_messages(prompt, self.conversation_id, self.parent_message_id, system_message=system_message)
-        messages = self.prepare_prompt_messsage_context(old_messages, new_messages)
-        tokens = self.get_num_tokens_from_messages(messages)
-        self.conversation_tokens = tokens
-        messages = self._strip_out_messages_over_max_tokens(messages, self.conversation_tokens, self.model_max_submission_tokens)
+        encoding = self.get_token_encoding()
+        new_token_counts = [self.get_num_tokens_from_message(m, encoding) for m in new_messages]
+        self.conversation_tokens = stored_tokens + sum(new_token_counts) + REPLY_PRIMING_TOKENS
+        token_counts = self.get_stored_message_token_counts(old_messages) + new_token_counts
+        messages, _token_count = self.context_strategy.build_context(self.conversation_id, self.parent_message_id, old_messages, new_messages, token_counts, self.model_max_submission_tokens)
         return new_messages, messages
 
     def _ask_request_post(self, conversation_id, new_messages, response_message, title=None):
@@ -352,7 +568,7 @@ class OpenAIAPI(Backend):
                 return True, response_message, "No current user, conversation not saved"
         return False, None, "Conversation not updated with new messages"
 
-    def ask_stream(self, prompt, title=None, model_customizations={}):
+    def ask_stream(self, prompt, title=None, model_customizations={}, stream_handlers=None):
         system_message, model_customizations = self.extract_system_message(model_customizations)
         new_messages, messages = self._prepare_ask_request(prompt, system_message=system_message)
         # Streaming loop.
@@ -360,20 +576,71 @@ class OpenAIAPI(Backend):
         #    if not self.streaming:
         #        self.log.info("Request to interrupt streaming")
         #        break
-        self.log.debug(f"Started streaming response at {util.current_datetime().isoformat()}")
-        success, response_obj, user_message = self._call_openai_streaming(messages, **model_customizations)
+        try:
+            self.log.debug(f"Started streaming response at {util.current_datetime().isoformat()}")
+            success, response_obj, user_message = self._call_openai_streaming(messages, stream_handlers=stream_handlers, **model_customizations)
+            if success:
+                self.log.debug(f"Stopped streaming response at {util.current_datetime().isoformat()}")
+                response_message = self._extract_message_content(response_obj)
+                self.message_clipboard = response_message
+                if not self.streaming:
+                    util.print_status_message(False, "Generation stopped")
+                success, response_obj, user_message = self._ask_request_post(self.conversation_id, new_messages, response_message, title)
+                if success:
+                    response_obj = response_message
+        finally:
+            # End streaming loop.
+            self.streaming = False
+        return self._handle_response(success, response_obj, user_message)
+
+    def ask_stream_iter(self, prompt, title=None, model_customizations={}, max_buffered_tokens=constants.DEFAULT_STREAM_MAX_BUFFERED_TOKENS):
+        """
+        Like ask_stream(), but returns a TokenStream to iterate over the
+        response tokens as they arrive, instead of printing them.
+
+        The request runs in a worker thread. Closing the stream, for example
+        when a client disconnects, stops generation, and nothing is saved.
+        """
+        stream = TokenStream(max_buffered_tokens)
+
+        def run():
+            try:
+                return self.ask_stream(prompt, title=title, model_customizations=model_customizations, stream_handlers=[stream.handler])
+            finally:
+                self.user_manager.orm.close_session()
+        return stream.start(run)
+
+    async def _ask_async(self, prompt, title=None, model_customizations={}, stream_handlers=None):
+        system_message, model_customizations = self.extract_system_message(model_customizations)
+        new_messages, messages = await self._run_in_thread(self._prepare_ask_request, prompt, system_message=system_message)
+        success, response, user_message = await self._call_openai_async(messages, stream_handlers=stream_handlers, **model_customizations)
         if success:
-            self.log.debug(f"Stopped streaming response at {util.current_datetime().isoformat()}")
-            response_message = self._extract_message_content(response_obj)
+            response_message = self._extract_message_content(response)
             self.message_clipboard = response_message
-            if not self.streaming:
-                util.print_status_message(False, "Generation stopped")
-            success, response_obj, user_message = self._ask_request_post(self.conversation_id, new_messages, response_message, title)
+            success, conversation, user_message = await self._run_in_thread(self._ask_request_post, self.conversation_id, new_messages, response_message, title)
             if success:
-                response_obj = response_message
-        # End streaming loop.
-        self.streaming = False
-        return self._handle_response(success, response_obj, user_message)
+                return self._handle_response(success, response_message, user_message)
+            return self._handle_response(success, conversation, user_message)
+        return self._handle_response(success, response, user_message)
+
+    async def ask_async(self, prompt, title=None, model_customizations={}):
+        """
+        Like ask(), without blocking the event loop.
+
+        The request uses OpenAI's async client, and database work runs in
+        worker threads. A backend holds the state of one conversation, so
+        concurrent conversations each need a backend.
+        """
+        return await self._ask_async(prompt, title=title, model_customizations=model_customizations)
+
+    def ask_stream_async(self, prompt, title=None, model_customizations={}, max_buffered_tokens=constants.DEFAULT_STREAM_MAX_BUFFERED_TOKENS):
+        """
+        Like ask_async(), but returns an AsyncTokenStream to iterate over the
+        response tokens as they arrive. Closing the stream cancels the
+        request, and nothing is saved.
+        """
+        stream = AsyncTokenStream(max_buffered_tokens)
+        return stream.start(self._ask_async(prompt, title=title, model_customizations=model_customizations, stream_handlers=[stream.handler]))
 
     def ask(self, prompt, title=None, model_customizations={}):
         """
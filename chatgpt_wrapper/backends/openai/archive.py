@@ -0,0 +1,207 @@
+import json
+import datetime
+
+from chatgpt_wrapper.backends.openai.orm import create_storage, Conversation, Message
+from chatgpt_wrapper.core.logger import Logger
+from chatgpt_wrapper.core.config import Config
+
+DEFAULT_ARCHIVE_BATCH_SIZE = 10000
+ARCHIVE_FORMATS = ['jsonl', 'parquet', 'arrow']
+# One row per message, with its conversation's columns repeated. A
+# conversation without messages is a single row with empty message columns.
+ARCHIVE_COLUMNS = [
+    ('conversation_id', Conversation.id),
+    ('conversation_title', Conversation.title),
+    ('conversation_model', Conversation.model),
+    ('conversation_created_time', Conversation.created_time),
+    ('conversation_updated_time', Conversation.updated_time),
+    ('conversation_hidden', Conversation.hidden),
+    ('message_id', Message.id),
+    ('role', Message.role),
+    ('message', Message.message),
+    ('created_time', Message.created_time),
+    ('prompt_tokens', Message.prompt_tokens),
+    ('completion_tokens', Message.completion_tokens),
+]
+ARCHIVE_DATETIME_COLUMNS = ['conversation_created_time', 'conversation_updated_time', 'created_time']
+
+def get_archive_format(path, archive_format=None):
+    archive_format = archive_format or path.rsplit('.', 1)[-1].lower()
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Invalid archive format '{archive_format}', must be one of: {', '.join(ARCHIVE_FORMATS)}")
+    return archive_format
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Parquet and Arrow archives require pyarrow, install it with: pip install chatGPT[archive]")
+    return pyarrow
+
+def arrow_schema(pa):
+    return pa.schema([
+        ('conversation_id', pa.int64()),
+        ('conversation_title', pa.string()),
+        ('conversation_model', pa.string()),
+        ('conversation_created_time', pa.timestamp('us')),
+        ('conversation_updated_time', pa.timestamp('us')),
+        ('conversation_hidden', pa.bool_()),
+        ('message_id', pa.int64()),
+        ('role', pa.string()),
+        ('message', pa.string()),
+        ('created_time', pa.timestamp('us')),
+        ('prompt_tokens', pa.int64()),
+        ('completion_tokens', pa.int64()),
+    ])
+
+class Archive:
+    """
+    Streaming export and import of all of a user's conversations.
+
+    Rows are read with a server side cursor and written in batches, so memory
+    use stays flat however large the history is. Supports JSONL, and Parquet
+    or Arrow IPC files for analytics (requires pyarrow).
+    """
+
+    def __init__(self, config=None, orm=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.orm = orm or create_storage(self.config)
+
+    def iter_rows(self, user=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE, conversation_ids=None):
+        columns = [column.label(name) for name, column in ARCHIVE_COLUMNS]
+        query = self.orm.session.query(*columns).select_from(Conversation).outerjoin(Message, Message.conversation_id == Conversation.id)
+        if user:
+            query = query.filter(Conversation.user_id == user.id)
+        if conversation_ids is not None:
+            query = query.filter(Conversation.id.in_(conversation_ids))
+        query = query.order_by(Conversation.id, Message.id)
+        for row in query.yield_per(batch_size):
+            yield row._asdict()
+
+    def iter_batches(self, user, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        batch = []
+        for row in self.iter_rows(user, batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def export(self, user, path, archive_format=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        """
+        Export a user's conversations to path.
+
+        Returns:
+            int: The number of rows written.
+        """
+        archive_format = get_archive_format(path, archive_format)
+        self.log.info(f"Exporting conversations for User {user.username} to {path} as {archive_format}")
+        if archive_format == 'jsonl':
+            return self.export_jsonl(user, path, batch_size)
+        return self.export_arrow(user, path, archive_format, batch_size)
+
+    def export_jsonl(self, user, path, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        with open(path, 'w', encoding='utf-8') as f:
+            return self.write_jsonl(f, self.iter_rows(user, batch_size))
+
+    def write_jsonl(self, f, rows):
+        total = 0
+        for row in rows:
+            for column in ARCHIVE_DATETIME_COLUMNS:
+                if row[column] is not None:
+                    row[column] = row[column].isoformat()
+            f.write(json.dumps(row, ensure_ascii=False))
+            f.write("\n")
+            total += 1
+        return total
+
+    def export_arrow(self, user, path, archive_format, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        pa = import_pyarrow()
+        schema = arrow_schema(pa)
+        total = 0
+        # Both writers accept record batches, one Parquet row group per batch.
+        if archive_format == 'parquet':
+            writer = pa.parquet.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        try:
+            for batch in self.iter_batches(user, batch_size):
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                total += len(batch)
+        finally:
+            writer.close()
+        return total
+
+    def read_batches(self, path, archive_format=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        archive_format = get_archive_format(path, archive_format)
+        if archive_format == 'jsonl':
+            batch = []
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    for column in ARCHIVE_DATETIME_COLUMNS:
+                        if row[column] is not None:
+                            row[column] = datetime.datetime.fromisoformat(row[column])
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+            if batch:
+                yield batch
+        elif archive_format == 'parquet':
+            pa = import_pyarrow()
+            for record_batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+                yield record_batch.to_pylist()
+        else:
+            pa = import_pyarrow()
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield reader.get_batch(i).to_pylist()
+
+    def import_archive(self, user, path, archive_format=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        """
+        Import an archive into a user's conversations with the storage's bulk inserts.
+
+        Conversations and messages get new ids, so an archive can be imported
+        into any database, or more than once. The import runs in a single
+        transaction, so it is either imported whole or not at all.
+
+        Returns:
+            tuple: (conversations imported, messages imported)
+        """
+        self.log.info(f"Importing conversations for User {user.username} from {path}")
+        return self.orm.import_conversations(self.iter_import_batches(user, path, archive_format, batch_size))
+
+    def iter_import_batches(self, user, path, archive_format=None, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE):
+        seen = set()
+        for batch in self.read_batches(path, archive_format, batch_size):
+            conversations = {}
+            messages = []
+            for row in batch:
+                if row['conversation_id'] not in seen:
+                    seen.add(row['conversation_id'])
+                    conversations[row['conversation_id']] = dict(
+                        user_id=user.id,
+                        title=row['conversation_title'],
+                        model=row['conversation_model'],
+                        created_time=row['conversation_created_time'],
+                        updated_time=row['conversation_updated_time'],
+                        hidden=row['conversation_hidden'],
+                    )
+                if row['message_id'] is not None:
+                    messages.append(dict(
+                        conversation_key=row['conversation_id'],
+                        role=row['role'],
+                        message=row['message'],
+                        created_time=row['created_time'],
+                        prompt_tokens=row['prompt_tokens'] or 0,
+                        completion_tokens=row['completion_tokens'] or 0,
+                    ))
+            yield conversations, messages
@@ -0,0 +1,206 @@
+import threading
+from collections import OrderedDict
+
+import chatgpt_wrapper.core.constants as constants
+
+class ConversationCacheEntry:
+    def __init__(self):
+        self.conversation = None
+        # The most recent messages, oldest first, and whether they are all of
+        # the conversation's messages.
+        self.messages = None
+        self.complete = False
+        # Totals over all of the conversation's messages.
+        self.token_count = None
+        self.uncounted = None
+
+class ConversationCache:
+    """
+    Bounded LRU cache of conversations and their most recent messages.
+
+    Holds detached copies, safe to share between threads and sessions. The
+    Orm writes through it, appending new messages to cached windows and
+    invalidating entries it edits or deletes, so a conversation in steady
+    use only touches the database to store new messages.
+
+    Only writes made through this process are seen, other processes writing
+    to the same database should disable the cache.
+    """
+
+    def __init__(self, max_conversations=constants.DEFAULT_CONVERSATION_CACHE_SIZE, window_messages=constants.DEFAULT_CONVERSATION_CACHE_WINDOW):
+        self.max_conversations = max_conversations
+        self.window_messages = window_messages
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped by every write, so a read that raced a write never stores
+        # what it loaded.
+        self.generation = 0
+
+    def _entry(self, conversation_id, create=False):
+        entry = self.entries.get(conversation_id)
+        if entry is not None:
+            self.entries.move_to_end(conversation_id)
+        elif create:
+            entry = self.entries[conversation_id] = ConversationCacheEntry()
+            while len(self.entries) > self.max_conversations:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def record(self, hit):
+        """Count a read as a hit or a miss, returns hit."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+    def _trim(self, entry):
+        if len(entry.messages) > self.window_messages:
+            del entry.messages[:len(entry.messages) - self.window_messages]
+            entry.complete = False
+
+    def get_conversation(self, conversation_id):
+        with self.lock:
+            entry = self._entry(conversation_id)
+            if self.record(entry is not None and entry.conversation is not None):
+                return entry.conversation
+            return None
+
+    def put_conversation(self, conversation, generation=None):
+        with self.lock:
+            if generation is None or generation == self.generation:
+                self._entry(conversation.id, create=True).conversation = conversation
+
+    def update_conversation(self, conversation_id, **kwargs):
+        with self.lock:
+            self.generation += 1
+            entry = self._entry(conversation_id)
+            if entry is not None and entry.conversation is not None:
+                for key, value in kwargs.items():
+                    setattr(entry.conversation, key, value)
+
+    def get_window(self, conversation_id):
+        """
+        Returns (messages, complete), or None if no window is cached.
+
+        Does not count a hit or miss, that depends on whether the window can
+        answer the caller's query.
+        """
+        with self.lock:
+            entry = self._entry(conversation_id)
+            if entry is not None and entry.messages is not None:
+                return list(entry.messages), entry.complete
+            return None
+
+    def put_window(self, conversation_id, messages, complete, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            entry = self._entry(conversation_id, create=True)
+            entry.messages = list(messages)
+            entry.complete = complete
+            self._trim(entry)
+            if complete:
+                entry.token_count = sum(m.prompt_tokens + m.completion_tokens for m in messages)
+                entry.uncounted = sum(1 for m in messages if not m.prompt_tokens and not m.completion_tokens)
+
+    def get_totals(self, conversation_id):
+        """Returns (token count, uncounted messages), either may be None."""
+        with self.lock:
+            entry = self._entry(conversation_id)
+            if entry is None:
+                return None, None
+            return entry.token_count, entry.uncounted
+
+    def put_totals(self, conversation_id, token_count=None, uncounted=None, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            entry = self._entry(conversation_id, create=True)
+            if token_count is not None:
+                entry.token_count = token_count
+            if uncounted is not None:
+                entry.uncounted = uncounted
+
+    def add_conversation(self, conversation):
+        """A new conversation, known to have no messages."""
+        with self.lock:
+            self.generation += 1
+            entry = self._entry(conversation.id, create=True)
+            entry.conversation = conversation
+            entry.messages = []
+            entry.complete = True
+            entry.token_count = 0
+            entry.uncounted = 0
+
+    def append_messages(self, conversation_id, messages, updated_time=None):
+        with self.lock:
+            self.generation += 1
+            entry = self._entry(conversation_id)
+            if entry is None:
+                return
+            if entry.messages is not None:
+                entry.messages.extend(messages)
+                self._trim(entry)
+            if entry.token_count is not None:
+                entry.token_count += sum(m.prompt_tokens + m.completion_tokens for m in messages)
+            if entry.uncounted is not None:
+                entry.uncounted += sum(1 for m in messages if not m.prompt_tokens and not m.completion_tokens)
+            if updated_time and entry.conversation is not None:
+                entry.conversation.updated_time = updated_time
+
+    def update_token_counts(self, token_counts):
+        with self.lock:
+            self.generation += 1
+            remaining = {token_count['id']: token_count for token_count in token_counts}
+            for entry in self.entries.values():
+                for message in entry.messages or []:
+                    token_count = remaining.pop(message.id, None)
+                    if token_count is None:
+                        continue
+                    old_tokens = message.prompt_tokens + message.completion_tokens
+                    message.prompt_tokens = token_count['prompt_tokens']
+                    message.completion_tokens = token_count['completion_tokens']
+                    new_tokens = message.prompt_tokens + message.completion_tokens
+                    if entry.token_count is not None:
+                        entry.token_count += new_tokens - old_tokens
+                    if entry.uncounted is not None and bool(old_tokens) != bool(new_tokens):
+                        entry.uncounted += -1 if new_tokens else 1
+            if remaining:
+                # Messages older than a window, their conversations are unknown.
+                for entry in self.entries.values():
+                    if not entry.complete:
+                        entry.token_count = entry.uncounted = None
+
+    def invalidate_messages(self, conversation_id):
+        with self.lock:
+            self.generation += 1
+            entry = self._entry(conversation_id)
+            if entry is not None:
+                entry.messages = entry.token_count = entry.uncounted = None
+                entry.complete = False
+
+    def invalidate(self, conversation_id):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(conversation_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'conversations': len(self.entries),
+                'max_conversations': self.max_conversations,
+                'window_messages': self.window_messages,
+            }
@@ -0,0 +1,263 @@
+from abc import ABC, abstractmethod
+
+from chatgpt_wrapper.core.logger import Logger
+import chatgpt_wrapper.core.constants as constants
+
+REPLY_PRIMING_TOKENS = 2  # every reply is primed with <im_start>assistant
+
+def strip_messages_over_max_tokens(messages, token_counts, max_tokens, preserve_system_message=True):
+    """
+    Strip the oldest messages from a conversation until it fits in max_tokens.
+
+    Works over precomputed per-message token counts, so the cut point is found
+    in a single pass without re-tokenizing anything.
+
+    Args:
+        messages (list): Message dicts, oldest first.
+        token_counts (list): Token count of each message, same order as messages.
+        max_tokens (int): Maximum tokens allowed in the submission.
+        preserve_system_message (bool): Never strip a leading system message.
+
+    Returns:
+        tuple: (kept messages, token count of kept messages, stripped messages)
+    """
+    if len(messages) != len(token_counts):
+        raise ValueError("messages and token_counts must be the same length")
+    token_count = sum(token_counts) + REPLY_PRIMING_TOKENS
+    start = 1 if preserve_system_message and messages and messages[0]['role'] == 'system' else 0
+    cut = start
+    # Always leave at least the most recent message.
+    last = len(messages) - 1
+    while token_count > max_tokens and cut < last:
+        token_count -= token_counts[cut]
+        cut += 1
+    if token_count > max_tokens:
+        raise Exception(f"No messages to send, all messages have been stripped, still over max submission tokens: {max_tokens}")
+    kept_messages = messages[:start] + messages[cut:]
+    stripped_messages = messages[start:cut]
+    return kept_messages, token_count, stripped_messages
+
+class ContextStrategy(ABC):
+    """
+    Base class for strategies that fit a conversation into the context window.
+    """
+
+    def __init__(self, backend, config=None):
+        self.backend = backend
+        self.config = config or {}
+        self.log = Logger(self.__class__.__name__, self.backend.config)
+
+    def _call_message_manager(self, method, *args, **kwargs):
+        success, result, user_message = getattr(self.backend.message, method)(*args, **kwargs)
+        if not success:
+            raise Exception(user_message)
+        return result
+
+    def get_pinned_messages(self, conversation_id):
+        first_message = self._call_message_manager('get_first_message', conversation_id)
+        if first_message and first_message.role == 'system':
+            return [first_message]
+        return []
+
+    def load_messages(self, conversation_id, target_id, reserved_tokens, max_tokens):
+        """
+        Load the stored messages that may be part of the context.
+
+        Strategies should avoid loading messages they would only discard.
+
+        Args:
+            conversation_id (int): The conversation.
+            target_id (int): Only messages up to and including this message.
+            reserved_tokens (int): Tokens needed by the messages not yet stored.
+            max_tokens (int): Maximum tokens allowed in the submission.
+
+        Returns:
+            list: Stored Message objects, oldest first.
+        """
+        return self._call_message_manager('get_messages', conversation_id, target_id=target_id)
+
+    @abstractmethod
+    def build_context(self, conversation_id, target_id, old_messages, new_messages, token_counts, max_tokens):
+        """
+        Build the list of messages to submit for a request.
+
+        Args:
+            conversation_id (int): The conversation, None for a new conversation.
+            target_id (int): The message the new messages follow.
+            old_messages (list): Stored Message objects from load_messages(), oldest first.
+            new_messages (list): Message dicts not yet stored.
+            token_counts (list): Token count of each old message, then each new message.
+            max_tokens (int): Maximum tokens allowed in the submission.
+
+        Returns:
+            tuple: (message dicts to submit, token count of those messages)
+        """
+        pass
+
+class DropOldestStrategy(ContextStrategy):
+    """
+    Drop the oldest messages (keeping the system message) until under max tokens.
+    """
+
+    def load_messages(self, conversation_id, target_id, reserved_tokens, max_tokens):
+        pinned_messages = self.get_pinned_messages(conversation_id)
+        after_id = pinned_messages[0].id if pinned_messages else None
+        max_window_tokens = max_tokens - reserved_tokens - sum(self.backend.get_stored_message_token_counts(pinned_messages)) - REPLY_PRIMING_TOKENS
+        messages = self._call_message_manager('get_last_messages', conversation_id, max_tokens=max(max_window_tokens, 0), target_id=target_id, after_id=after_id)
+        return pinned_messages + messages
+
+    def build_context(self, conversation_id, target_id, old_messages, new_messages, token_counts, max_tokens):
+        # Messages outside the loaded window are not counted in the warning,
+        # counting them would cost a query every turn.
+        messages = self.backend.prepare_prompt_messsage_context(old_messages, new_messages)
+        return self.backend._strip_out_messages_over_max_tokens(messages, token_counts, max_tokens)
+
+class KeepLastStrategy(ContextStrategy):
+    """
+    Keep the system message plus the last N messages, then drop the oldest of
+    those if still over max tokens.
+    """
+
+    def get_num_messages(self):
+        return self.config.get('messages') or constants.DEFAULT_CONTEXT_KEEP_LAST_MESSAGES
+
+    def load_messages(self, conversation_id, target_id, reserved_tokens, max_tokens):
+        pinned_messages = self.get_pinned_messages(conversation_id)
+        after_id = pinned_messages[0].id if pinned_messages else None
+        # Leave room for the new prompt.
+        limit = max(self.get_num_messages() - 1, 0)
+        messages = self._call_message_manager('get_last_messages', conversation_id, limit=limit, target_id=target_id, after_id=after_id)
+        return pinned_messages + messages
+
+    def build_context(self, conversation_id, target_id, old_messages, new_messages, token_counts, max_tokens):
+        messages = self.backend.prepare_prompt_messsage_context(old_messages, new_messages)
+        num_messages = self.get_num_messages()
+        start = 1 if messages and messages[0]['role'] == 'system' else 0
+        cut = max(start, len(messages) - num_messages)
+        if cut > start:
+            self.log.debug(f"Keeping last {num_messages} messages, skipped {cut - start} older messages")
+            messages = messages[:start] + messages[cut:]
+            token_counts = token_counts[:start] + token_counts[cut:]
+        return self.backend._strip_out_messages_over_max_tokens(messages, token_counts, max_tokens)
+
+class RollingSummaryStrategy(ContextStrategy):
+    """
+    Compact the oldest messages into a summary message stored with the
+    conversation.
+
+    The summary is only regenerated when newer messages no longer fit next to
+    it, at which point the overflow is folded into the existing summary.
+    """
+
+    def get_max_summary_tokens(self):
+        return self.config.get('max_summary_tokens') or constants.DEFAULT_CONTEXT_SUMMARY_MAX_TOKENS
+
+    def get_summary(self, conversation_id, target_id):
+        if not conversation_id:
+            return None
+        success, summary, user_message = self.backend.conversation.get_summary(conversation_id)
+        if not success:
+            raise Exception(user_message)
+        # The summary only applies to the branch that includes its last message.
+        if summary and target_id and summary.message_id > target_id:
+            self.log.debug(f"Ignoring summary for conversation {conversation_id}, it extends past the current branch")
+            return None
+        return summary
+
+    def build_summary_message(self, summary):
+        return self.backend.build_openai_message('system', "%s\n\n%s" % (constants.CONTEXT_SUMMARY_MESSAGE_PREFIX, summary))
+
+    def _chunk_messages(self, messages, token_counts, max_tokens):
+        chunk = []
+        chunk_tokens = 0
+        for message, token_count in zip(messages, token_counts):
+            if chunk and chunk_tokens + token_count > max_tokens:
+                yield chunk
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(message)
+            chunk_tokens += token_count
+        if chunk:
+            yield chunk
+
+    def summarize(self, summary, messages, token_counts, max_tokens):
+        max_summary_tokens = self.get_max_summary_tokens()
+        # Leave room for the previous summary and the summarization prompt.
+        chunk_tokens = max(max_tokens - (max_summary_tokens * 2), max_summary_tokens)
+        for chunk in self._chunk_messages(messages, token_counts, chunk_tokens):
+            transcript = "\n\n".join(["%s: %s" % (m['role'], m['content']) for m in chunk])
+            content = constants.CONTEXT_SUMMARY_USER_PROMPT % (summary or constants.CONTEXT_SUMMARY_EMPTY, transcript)
+            summary_messages = [
+                self.backend.build_openai_message('system', constants.CONTEXT_SUMMARY_SYSTEM_PROMPT % max_summary_tokens),
+                self.backend.build_openai_message('user', content),
+            ]
+            success, completion, user_message = self.backend._call_openai_non_streaming(summary_messages, temperature=0)
+            if not success:
+                raise Exception(f"Failed to summarize conversation: {str(user_message)}")
+            summary = self.backend._extract_message_content(completion)
+        return summary
+
+    def load_messages(self, conversation_id, target_id, reserved_tokens, max_tokens):
+        summary = self.get_summary(conversation_id, target_id)
+        if not summary:
+            return super().load_messages(conversation_id, target_id, reserved_tokens, max_tokens)
+        # Messages already compacted into the summary are not needed.
+        messages = self._call_message_manager('get_messages', conversation_id, target_id=target_id, after_id=summary.message_id)
+        return self.get_pinned_messages(conversation_id) + messages
+
+    def build_context(self, conversation_id, target_id, old_messages, new_messages, token_counts, max_tokens):
+        messages = self.backend.prepare_prompt_messsage_context(old_messages, new_messages)
+        message_ids = [m.id for m in old_messages] + [None] * len(new_messages)
+        start = 1 if messages and messages[0]['role'] == 'system' else 0
+        pinned_messages = messages[:start]
+        pinned_token_counts = token_counts[:start]
+        summary = self.get_summary(conversation_id, target_id) if old_messages else None
+        cut = start
+        if summary:
+            # Skip messages already compacted into the summary.
+            while cut < len(messages) and message_ids[cut] is not None and message_ids[cut] <= summary.message_id:
+                cut += 1
+            pinned_messages = pinned_messages + [self.build_summary_message(summary.summary)]
+            pinned_token_counts = pinned_token_counts + [summary.token_count]
+        recent_messages = messages[cut:]
+        recent_token_counts = token_counts[cut:]
+        token_count = sum(pinned_token_counts) + sum(recent_token_counts) + REPLY_PRIMING_TOKENS
+        if token_count > max_tokens:
+            # Keep as many recent messages as fit next to a new summary, and
+            # fold the rest into it.
+            recent_max_tokens = max_tokens - sum(token_counts[:start]) - self.get_max_summary_tokens()
+            if not recent_messages or recent_token_counts[-1] + REPLY_PRIMING_TOKENS > recent_max_tokens:
+                # The newest message leaves no room for a summary, drop the
+                # oldest messages instead.
+                self.log.debug("Newest message does not fit next to a conversation summary, dropping oldest messages")
+                return self.backend._strip_out_messages_over_max_tokens(messages, token_counts, max_tokens)
+            recent_messages, _, compact_messages = strip_messages_over_max_tokens(recent_messages, recent_token_counts, recent_max_tokens, preserve_system_message=False)
+            if not compact_messages and summary is None:
+                return self.backend._strip_out_messages_over_max_tokens(messages, token_counts, max_tokens)
+            compact_token_counts = recent_token_counts[:len(compact_messages)]
+            recent_token_counts = recent_token_counts[len(compact_messages):]
+            self.log.debug(f"Compacting {len(compact_messages)} messages into conversation summary")
+            summary_text = self.summarize(summary.summary if summary else None, compact_messages, compact_token_counts, max_tokens)
+            summary_message = self.build_summary_message(summary_text)
+            summary_token_count = self.backend.get_num_tokens_from_message(summary_message)
+            last_message_id = message_ids[cut + len(compact_messages) - 1] if compact_messages else summary.message_id
+            if conversation_id:
+                success, summary, user_message = self.backend.conversation.set_summary(conversation_id, last_message_id, summary_text, summary_token_count)
+                if not success:
+                    raise Exception(user_message)
+            pinned_messages = messages[:start] + [summary_message]
+            pinned_token_counts = token_counts[:start] + [summary_token_count]
+        messages = pinned_messages + recent_messages
+        token_counts = pinned_token_counts + recent_token_counts
+        return self.backend._strip_out_messages_over_max_tokens(messages, token_counts, max_tokens)
+
+CONTEXT_STRATEGIES = {
+    'drop_oldest': DropOldestStrategy,
+    'keep_last': KeepLastStrategy,
+    'rolling_summary': RollingSummaryStrategy,
+}
+
+def get_context_strategy_class(name):
+    if name not in CONTEXT_STRATEGIES:
+        raise ValueError(f"Invalid context strategy '{name}', must be one of: {', '.join(CONTEXT_STRATEGIES.keys())}")
+    return CONTEXT_STRATEGIES[name]
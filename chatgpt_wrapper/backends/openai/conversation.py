@@ -3,14 +3,22 @@ from sqlalchemy.exc import SQLAlchemyError
 from chatgpt_wrapper.backends.openai.orm import Manager
 
 class ConversationManager(Manager):
-    def get_conversations(self, user_id, limit=None, offset=None, order_desc=True):
+    def get_conversations(self, user_id, limit=None, offset=None, order_desc=True, before_id=None, after_id=None):
         try:
             user = self.orm.get_user(user_id)
-            conversations = self.orm.get_conversations(user, limit, offset, order_desc)
+            conversations = self.orm.get_conversations(user, limit, offset, order_desc, before_id, after_id)
             return True, conversations, "Conversations retrieved successfully."
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to retrieve conversations: {str(e)}")
 
+    def get_conversation_rows(self, user_id, columns, limit=None, offset=None, order_desc=True, before_id=None, after_id=None):
+        try:
+            user = self.orm.get_user(user_id)
+            rows = self.orm.get_conversation_rows(user, columns, limit, offset, order_desc, before_id, after_id)
+            return True, rows, "Conversations retrieved successfully."
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve conversations: {str(e)}")
+
     def add_conversation(self, user_id, title=None, model="default", hidden=False):
         try:
             user = self.orm.get_user(user_id)
@@ -29,6 +37,26 @@ class ConversationManager(Manager):
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to retrieve conversation: {str(e)}")
 
+    def get_summary(self, conversation_id):
+        success, conversation, message = self.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            conversation_summary = self.orm.get_conversation_summary(conversation)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve conversation summary: {str(e)}")
+        return True, conversation_summary, "Conversation summary retrieved successfully."
+
+    def set_summary(self, conversation_id, message_id, summary, token_count):
+        success, conversation, message = self.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            conversation_summary = self.orm.save_conversation_summary(conversation, message_id, summary, token_count)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to save conversation summary: {str(e)}")
+        return True, conversation_summary, "Conversation summary saved successfully."
+
     def edit_conversation(self, conversation_id, **kwargs):
         success, conversation, message = self.get_conversation(conversation_id)
         if not success:
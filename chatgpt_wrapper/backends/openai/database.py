@@ -2,49 +2,155 @@
 
 import names
 import argparse
+import datetime
+import math
+import random
 
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import inspect, func, select, text
 
-from chatgpt_wrapper.backends.openai.orm import Base, Orm
+from chatgpt_wrapper.backends.openai.orm import Base, create_storage, User, Conversation, Message, SEARCH_INDEX_TABLE, SEARCH_INDEX_DDL
+from chatgpt_wrapper.backends.openai.archive import Archive, ARCHIVE_FORMATS
+from chatgpt_wrapper.backends.openai.maintenance import Maintenance
+from chatgpt_wrapper.backends.openai.migrations import SchemaMigrations, schema_version
+from chatgpt_wrapper.backends.openai.tokens import encoding_registry, build_message_token_counts, get_num_tokens_from_messages_batch
 from chatgpt_wrapper.core.logger import Logger
 from chatgpt_wrapper.core.config import Config
+import chatgpt_wrapper.core.constants as constants
 import chatgpt_wrapper.core.util as util
 
 DEFAULT_NUM_USERS = 5
 DEFAULT_NUM_CONVERSATIONS = 5
 DEFAULT_NUM_MESSAGES = 10
+DEFAULT_BACKFILL_BATCH_SIZE = 10000
+DEFAULT_BULK_CHUNK_SIZE = 10000
+DEFAULT_MESSAGE_WORDS = 60
+DEFAULT_MESSAGE_LENGTH_DISTRIBUTION = 'lognormal'
+DEFAULT_MESSAGE_ROLES = 'user,assistant'
+MESSAGE_LENGTH_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+# Spread of the lognormal message length distribution, mostly short messages
+# with a long tail of much longer ones.
+MESSAGE_LENGTH_LOGNORMAL_SIGMA = 1.0
+TEST_DATA_WORDS = """
+the of and to in is you that it he was for on are as with his they at be this have from or one had by word but not
+what all were we when your can said there use an each which she do how their if will up other about out many then
+them these so some her would make like him into time has look two more write go see number no way could people my
+than first water been call who oil its now find long down day did get come made may part model token prompt answer
+question context window database query index cache thread stream server request response summary message history
+python function class method module error value result return string list dict array memory disk latency throughput
+""".split()
 
 class Database:
 
-    def __init__(self, config):
+    def __init__(self, config, orm=None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
-        self.orm = Orm(self.config)
+        self.orm = orm or create_storage(self.config)
+        self.migrations = SchemaMigrations(self.config, self.orm)
 
     def schema_exists(self):
-        # Necessary to create a new engine/metadata here, as the tables are cached,
-        # and we need to know the current state.
-        _, metadata = self.orm.create_engine_and_metadata()
-        try:
-            if len(metadata.tables.keys()) > 0:
-                self.log.debug("The database schema exists.")
-                return True
-        except OperationalError:
-            self.log.warning("The database schema does not exist.")
-            return False
+        if self.migrations.get_version() > 0 or len(inspect(self.orm.engine).get_table_names()) > 0:
+            self.log.debug("The database schema exists.")
+            return True
+        self.log.warning("The database schema does not exist.")
+        return False
+
+    def create_schema(self, dry_run=False):
+        """
+        Install the schema, or upgrade it by applying any pending migrations.
+
+        Returns:
+            list: (migration, statements) for each migration applied.
+        """
+        current = self.migrations.get_version()
+        results = self.migrations.upgrade(dry_run=dry_run)
+        if dry_run:
+            self.print_migrations(results)
+        elif results:
+            version = results[-1][0].version
+            if current:
+                util.print_status_message(True, f"Database schema for {self.orm.database} upgraded from version {current} to {version}")
+            else:
+                util.print_status_message(True, f"Database schema for {self.orm.database} installed at version {version}")
+        return results
 
-    def create_schema(self):
-        if not self.schema_exists():
-            util.print_status_message(True, f"Creating database schema for: {self.orm.database}")
-            Base.metadata.create_all(bind=self.orm.engine)
-            util.print_status_message(True, "Database schema installed")
+    def print_migrations(self, results):
+        for migration, statements in results:
+            util.print_status_message(True, f"Migration {migration.version}: {migration.name}")
+            for statement in statements:
+                print(f"{statement};")
 
     def remove_schema(self):
         if self.schema_exists():
             util.print_status_message(False, f"Removing old database schema for: {self.orm.database}")
+            self.drop_search_index()
             Base.metadata.drop_all(bind=self.orm.engine)
+            schema_version.drop(bind=self.orm.engine, checkfirst=True)
             util.print_status_message(True, "Removed old database schema")
 
+    def search_index_supported(self):
+        return self.orm.engine.dialect.name == 'sqlite'
+
+    def search_index_exists(self):
+        return SEARCH_INDEX_TABLE in inspect(self.orm.engine).get_table_names()
+
+    def create_search_index(self):
+        """
+        Create the full text search index if it does not exist, indexing any
+        messages already stored.
+        """
+        if not self.search_index_supported() or self.search_index_exists():
+            return False
+        with self.orm.engine.begin() as conn:
+            for statement in SEARCH_INDEX_DDL:
+                conn.execute(text(statement))
+            has_messages = conn.execute(select(Message.id).limit(1)).first() is not None
+        if has_messages:
+            self.rebuild_search_index()
+        return True
+
+    def rebuild_search_index(self):
+        util.print_status_message(True, "Rebuilding message search index...")
+        with self.orm.engine.begin() as conn:
+            conn.execute(text(f"INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}) VALUES ('rebuild')"))
+        util.print_status_message(True, "Message search index rebuilt")
+
+    def drop_search_index(self):
+        if self.search_index_supported() and self.search_index_exists():
+            with self.orm.engine.begin() as conn:
+                for trigger in ['insert', 'delete', 'update']:
+                    conn.execute(text(f"DROP TRIGGER IF EXISTS {SEARCH_INDEX_TABLE}_{trigger}"))
+                conn.execute(text(f"DROP TABLE {SEARCH_INDEX_TABLE}"))
+
+    def get_model_token_encoding(self, model):
+        # Conversations store either a model alias or the full model name.
+        model = constants.OPENAPI_CHAT_RENDER_MODELS.get(model, model)
+        if model not in constants.OPENAPI_CHAT_RENDER_MODELS.values():
+            model = constants.OPENAPI_CHAT_RENDER_MODELS['default']
+        encoding, _ = encoding_registry.get(model)
+        return encoding
+
+    def backfill_token_counts(self, batch_size=DEFAULT_BACKFILL_BATCH_SIZE):
+        util.print_status_message(True, "Backfilling message token counts...")
+        after_id = 0
+        total = 0
+        while True:
+            rows = self.orm.get_all_messages_without_token_counts(after_id, batch_size)
+            if not rows:
+                break
+            rows_by_model = {}
+            for row in rows:
+                rows_by_model.setdefault(row.model, []).append(row)
+            token_counts = []
+            for model, model_rows in rows_by_model.items():
+                encoding = self.get_model_token_encoding(model)
+                counts = get_num_tokens_from_messages_batch([{'role': r.role, 'content': r.message} for r in model_rows], encoding)
+                token_counts.extend(dict(id=r.id, **build_message_token_counts(r.role, c)) for r, c in zip(model_rows, counts))
+            self.orm.edit_message_token_counts(token_counts)
+            after_id = rows[-1].id
+            total += len(rows)
+            util.print_status_message(True, f"Backfilled token counts for {total} messages", style="white")
+        return total
+
 class DatabaseDevel(Database):
 
     def __init__(self, config, args):
@@ -55,6 +161,29 @@ class DatabaseDevel(Database):
         self.create = args.create
         self.force = args.force
         self.test_data = args.test_data
+        self.bulk = args.bulk
+        self.chunk_size = args.chunk_size or DEFAULT_BULK_CHUNK_SIZE
+        self.message_words = args.message_words or DEFAULT_MESSAGE_WORDS
+        self.length_distribution = args.length_distribution or DEFAULT_MESSAGE_LENGTH_DISTRIBUTION
+        self.roles = [role.strip() for role in (args.roles or DEFAULT_MESSAGE_ROLES).split(',')]
+        self.count_tokens = args.count_tokens
+        self.random = random.Random(args.seed)
+        self.backfill_tokens = args.backfill_tokens
+        self.rebuild_search = args.rebuild_search
+        self.export_path = args.export
+        self.import_path = args.import_path
+        self.username = args.username
+        self.archive_format = args.archive_format
+        self.migrate = args.migrate
+        self.maintenance = args.maintenance
+        self.dry_run = args.dry_run
+        self.vacuum_full = args.vacuum_full
+        self.maintenance_policy = dict(
+            max_age_days=args.max_age_days,
+            purge_hidden=args.purge_hidden or None,
+            max_conversations_per_user=args.max_conversations_per_user,
+            archive_directory=args.archive_dir,
+        )
         self.print = args.print
 
     def create_test_data(self):
@@ -77,6 +206,81 @@ class DatabaseDevel(Database):
                     message = f'This is message {k+1} in conversation {j+1} for user {i+1}'
                     message = self.orm.add_message(conversation, role, message)
 
+    def get_message_word_count(self):
+        if self.length_distribution == 'fixed':
+            return self.message_words
+        if self.length_distribution == 'uniform':
+            return self.random.randint(1, self.message_words * 2)
+        # Centered so the mean length is message_words.
+        mu = math.log(self.message_words) - (MESSAGE_LENGTH_LOGNORMAL_SIGMA ** 2) / 2
+        return max(1, int(self.random.lognormvariate(mu, MESSAGE_LENGTH_LOGNORMAL_SIGMA)))
+
+    def make_message_text(self):
+        return ' '.join(self.random.choices(TEST_DATA_WORDS, k=self.get_message_word_count()))
+
+    def get_next_id(self, model):
+        with self.orm.engine.connect() as conn:
+            return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+    def bulk_insert(self, model, rows):
+        # Each chunk in its own transaction.
+        self.orm.bulk_insert([(model.__table__, rows)])
+
+    def insert_message_chunk(self, rows, encoding):
+        if encoding:
+            counts = get_num_tokens_from_messages_batch([{'role': r['role'], 'content': r['message']} for r in rows], encoding)
+            for row, count in zip(rows, counts):
+                row.update(build_message_token_counts(row['role'], count))
+        self.bulk_insert(Message, rows)
+
+    def create_bulk_test_data(self):
+        """
+        Seed large amounts of test data with the storage's bulk inserts.
+
+        Ids are assigned up front, so no rows need to be read back.
+        """
+        total_messages = self.num_users * self.num_conversations * self.num_messages
+        util.print_status_message(True, f"Bulk creating {self.num_users} users, {self.num_users * self.num_conversations} conversations and {total_messages} messages...")
+        encoding = self.get_model_token_encoding('default') if self.count_tokens else None
+        now = datetime.datetime.now()
+        user_id = self.get_next_id(User)
+        conversation_id = self.get_next_id(Conversation)
+        users = []
+        for i in range(self.num_users):
+            username = "%s.%d" % (names.get_full_name().lower().replace(" ", "."), user_id + i)
+            users.append(dict(id=user_id + i, username=username, password=None, email=f'{username}@example.com', default_model='default', created_time=now, last_login_time=now, preferences={}))
+        self.bulk_insert(User, users)
+        conversations = []
+        messages = []
+        inserted = 0
+        for user in users:
+            for j in range(self.num_conversations):
+                created_time = now - datetime.timedelta(minutes=self.random.randint(0, 525600))
+                conversations.append(dict(id=conversation_id, user_id=user['id'], title=f"Conversation {j+1} for {user['username']}", model='default', created_time=created_time, updated_time=created_time + datetime.timedelta(seconds=self.num_messages), hidden=False))
+                for k in range(self.num_messages):
+                    role = self.roles[k % len(self.roles)]
+                    messages.append(dict(conversation_id=conversation_id, role=role, message=self.make_message_text(), created_time=created_time + datetime.timedelta(seconds=k), prompt_tokens=0, completion_tokens=0))
+                conversation_id += 1
+                if len(conversations) >= self.chunk_size:
+                    self.bulk_insert(Conversation, conversations)
+                    conversations = []
+                while len(messages) >= self.chunk_size:
+                    # Messages reference conversations, so those go first.
+                    if conversations:
+                        self.bulk_insert(Conversation, conversations)
+                        conversations = []
+                    self.insert_message_chunk(messages[:self.chunk_size], encoding)
+                    messages = messages[self.chunk_size:]
+                    inserted += self.chunk_size
+                    util.print_status_message(True, f"Inserted {inserted} of {total_messages} messages", style="white")
+        if conversations:
+            self.bulk_insert(Conversation, conversations)
+        if messages:
+            self.insert_message_chunk(messages, encoding)
+            inserted += len(messages)
+        util.print_status_message(True, f"Inserted {inserted} messages")
+        return inserted
+
     def print_data(self):
         output = ['# Users']
         users = self.orm.get_users()
@@ -99,15 +303,57 @@ class DatabaseDevel(Database):
                     self.create_schema()
             else:
                 self.create_schema()
+        if self.migrate:
+            if not self.create_schema(dry_run=self.dry_run):
+                util.print_status_message(True, f"Database schema is up to date at version {self.migrations.get_version()}")
         if self.test_data:
             if self.schema_exists():
-                self.create_test_data()
+                if self.bulk:
+                    self.create_bulk_test_data()
+                else:
+                    self.create_test_data()
             else:
                 util.print_status_message(False, "Cannot create test data, database not created, use --create to create it")
+        if self.backfill_tokens:
+            total = self.backfill_token_counts()
+            util.print_status_message(True, f"Token counts backfilled for {total} messages")
+        if self.rebuild_search:
+            if not self.search_index_supported():
+                util.print_status_message(False, "Message search requires an SQLite database")
+            elif not self.create_search_index():
+                self.rebuild_search_index()
+        if self.export_path or self.import_path:
+            self.run_archive()
+        if self.maintenance:
+            self.run_maintenance()
         if self.print:
             self.print_data()
 
-def main():
+    def run_maintenance(self):
+        maintenance = Maintenance(self.config, self.orm)
+        policy = maintenance.get_policy(**self.maintenance_policy)
+        if self.dry_run:
+            util.print_status_message(True, f"Would purge {maintenance.count_purgeable(policy)} conversations")
+            return
+        report = maintenance.run(policy, full_vacuum=self.vacuum_full)
+        util.print_status_message(True, f"Purged {report['purged']} conversations")
+        if report['reclaimed'] is not None:
+            util.print_status_message(True, f"Database size: {report['size_before']} -> {report['size_after']} bytes, reclaimed {report['reclaimed']} bytes, {report['free']} bytes still free")
+
+    def run_archive(self):
+        user = self.orm.find_user([self.username], match_email=False)
+        if not user:
+            util.print_status_message(False, f"User not found: {self.username}")
+            return
+        archive = Archive(self.config, self.orm)
+        if self.export_path:
+            total = archive.export(user, self.export_path, self.archive_format)
+            util.print_status_message(True, f"Exported {total} rows to {self.export_path}")
+        if self.import_path:
+            conversations, messages = archive.import_archive(user, self.import_path, self.archive_format)
+            util.print_status_message(True, f"Imported {conversations} conversations and {messages} messages from {self.import_path}")
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c",
@@ -121,6 +367,93 @@ def main():
         action="store_true",
         help="populate the database tables with test data",
     )
+    parser.add_argument(
+        "-s",
+        "--bulk",
+        action="store_true",
+        help="with --test-data, seed data with chunked bulk inserts, for large load testing databases",
+    )
+    parser.add_argument(
+        "-b",
+        "--backfill-tokens",
+        action="store_true",
+        help="compute and store token counts for messages that have none",
+    )
+    parser.add_argument(
+        "-r",
+        "--rebuild-search",
+        action="store_true",
+        help="create the message search index if needed, and index all stored messages",
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        action="store",
+        metavar="PATH",
+        help="export all conversations of --username to PATH",
+    )
+    parser.add_argument(
+        "-i",
+        "--import",
+        dest="import_path",
+        action="store",
+        metavar="PATH",
+        help="import conversations from the archive at PATH for --username",
+    )
+    parser.add_argument(
+        "--username",
+        action="store",
+        help="user to export or import conversations for",
+    )
+    parser.add_argument(
+        "--archive-format",
+        action="store",
+        choices=ARCHIVE_FORMATS,
+        help="export/import format, default: from the file extension",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="apply pending schema migrations, with --dry-run only print their DDL",
+    )
+    parser.add_argument(
+        "-M",
+        "--maintenance",
+        action="store_true",
+        help="purge conversations per the maintenance config and options below, then compact the database",
+    )
+    parser.add_argument(
+        "--max-age-days",
+        action="store",
+        type=int,
+        help="maintenance, purge conversations not updated in this many days",
+    )
+    parser.add_argument(
+        "--purge-hidden",
+        action="store_true",
+        help="maintenance, purge hidden conversations",
+    )
+    parser.add_argument(
+        "--max-conversations-per-user",
+        action="store",
+        type=int,
+        help="maintenance, keep only each user's most recently updated conversations",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        action="store",
+        help="maintenance, save purged conversations as JSONL in this directory first",
+    )
+    parser.add_argument(
+        "--vacuum-full",
+        action="store_true",
+        help="maintenance, run a full VACUUM, enables incremental vacuum on older SQLite databases",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the DDL --migrate would run, or report how many conversations --maintenance would purge",
+    )
     parser.add_argument(
         "-p",
         "--print",
@@ -143,24 +476,67 @@ def main():
         "-u",
         "--users",
         action="store",
+        type=int,
         help="number of users to create, default: %s" % DEFAULT_NUM_USERS,
     )
     parser.add_argument(
         "-n",
         "--conversations",
         action="store",
+        type=int,
         help="number of conversations per user to create, default: %s" % DEFAULT_NUM_CONVERSATIONS,
     )
     parser.add_argument(
         "-m",
         "--messages",
         action="store",
+        type=int,
         help="number of messages per conversation to create, default: %s" % DEFAULT_NUM_MESSAGES,
     )
+    parser.add_argument(
+        "--chunk-size",
+        action="store",
+        type=int,
+        help="bulk mode, rows per insert transaction, default: %s" % DEFAULT_BULK_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        "--message-words",
+        action="store",
+        type=int,
+        help="bulk mode, mean words per message, default: %s" % DEFAULT_MESSAGE_WORDS,
+    )
+    parser.add_argument(
+        "--length-distribution",
+        action="store",
+        choices=MESSAGE_LENGTH_DISTRIBUTIONS,
+        help="bulk mode, distribution of message lengths, default: %s" % DEFAULT_MESSAGE_LENGTH_DISTRIBUTION,
+    )
+    parser.add_argument(
+        "--roles",
+        action="store",
+        help="bulk mode, comma separated message roles to cycle through, default: %s" % DEFAULT_MESSAGE_ROLES,
+    )
+    parser.add_argument(
+        "--count-tokens",
+        action="store_true",
+        help="bulk mode, store token counts with each message",
+    )
+    parser.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        help="bulk mode, random seed for reproducible data",
+    )
+    return parser
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
 
-    if not (args.create or args.test_data or args.print):
-        parser.error("At least one of --create, --test-data, --print must be set")
+    if not (args.create or args.migrate or args.test_data or args.backfill_tokens or args.rebuild_search or args.export or args.import_path or args.maintenance or args.print):
+        parser.error("At least one of --create, --migrate, --test-data, --backfill-tokens, --rebuild-search, --export, --import, --maintenance, --print must be set")
+    if (args.export or args.import_path) and not args.username:
+        parser.error("--username is required for --export and --import")
 
     config = Config()
     config.load_from_file()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import weakref
+
+import aiohttp
+import openai
+import requests
+from openai import api_requestor
+
+import chatgpt_wrapper.core.constants as constants
+
+def build_requests_proxies(proxy):
+    """Convert openai.proxy to the proxies argument for requests."""
+    if proxy is None:
+        return {}
+    if isinstance(proxy, str):
+        return {"http": proxy, "https": proxy}
+    return dict(proxy)
+
+class HttpSessionRegistry:
+    """
+    Per-process HTTP connection pools for the OpenAI API, so requests reuse
+    open keep-alive connections.
+
+    The openai library keeps a requests session per thread, which servers
+    that start a thread per request throw away each time, and opens a new
+    aiohttp session for every async request. Instead, each thread gets its
+    own requests session, as requests does not promise a session is safe to
+    share between threads, but all of them mount one HTTPAdapter whose
+    urllib3 pool is thread safe, and every async request on an event loop
+    shares that loop's aiohttp session.
+
+    openai 0.27 has no public way to pass a session to synchronous requests,
+    it reads the private api_requestor._thread_context.session, so that is
+    the only private attribute set here. If a later openai release removes
+    it, requests fall back to openai's own per thread sessions.
+
+    aiohttp sessions must be closed on the loop that opened them, so they are
+    opened and closed by the application, see open_async() and close_async().
+    Without one, async requests use openai's session per request.
+    """
+
+    def __init__(self, pool_size=constants.DEFAULT_OPENAI_HTTP_POOL_SIZE, max_retries=constants.DEFAULT_OPENAI_HTTP_MAX_RETRIES):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.adapter = None
+        self.local = threading.local()
+        self.aiohttp_sessions = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_adapter(self):
+        if self.adapter is None:
+            with self.lock:
+                if self.adapter is None:
+                    self.adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size, max_retries=self.max_retries)
+        return self.adapter
+
+    def get_session(self):
+        """Get the current thread's session."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.mount("https://", self.get_adapter())
+        # Read on every request, so changes to openai.proxy apply.
+        session.proxies = build_requests_proxies(openai.proxy)
+        return session
+
+    def install(self):
+        """Use the current thread's session for its openai requests."""
+        thread_context = getattr(api_requestor, '_thread_context', None)
+        if thread_context is not None:
+            thread_context.session = self.get_session()
+
+    async def open_async(self):
+        """Open a shared aiohttp session for the running event loop."""
+        loop = asyncio.get_running_loop()
+        session = self.aiohttp_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            session = self.aiohttp_sessions[loop] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    def install_async(self):
+        """Use the running event loop's shared session, if open, for the current task's openai requests."""
+        session = self.aiohttp_sessions.get(asyncio.get_running_loop())
+        if session is not None and not session.closed:
+            openai.aiosession.set(session)
+
+    async def close_async(self):
+        session = self.aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close(self):
+        with self.lock:
+            if self.adapter is not None:
+                self.adapter.close()
+                self.adapter = None
+            # Sessions mounting the closed adapter are replaced on next use.
+            self.local = threading.local()
+
+http_sessions = HttpSessionRegistry()
@@ -0,0 +1,204 @@
+import os
+import datetime
+import threading
+
+from sqlalchemy import select, delete, func, desc, or_
+
+from chatgpt_wrapper.backends.openai.orm import create_storage, Conversation
+from chatgpt_wrapper.backends.openai.archive import Archive
+from chatgpt_wrapper.core.logger import Logger
+from chatgpt_wrapper.core.config import Config
+import chatgpt_wrapper.core.constants as constants
+
+class Maintenance:
+    """
+    Retention and compaction for the conversation database.
+
+    Conversations are purged by age, hidden flag, or a per user quota, in
+    batches. Deleting a conversation cascades to its messages through the
+    foreign keys. Purged conversations can be archived to JSONL first.
+
+    Afterwards the database is compacted (incremental vacuum on SQLite) and
+    its statistics refreshed.
+    """
+
+    def __init__(self, config=None, orm=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.orm = orm or create_storage(self.config)
+
+    def get_policy(self, **overrides):
+        policy = dict(self.config.get('maintenance') or {})
+        policy.update({key: value for key, value in overrides.items() if value is not None})
+        return policy
+
+    def _purge_filters(self, policy):
+        filters = []
+        if policy.get('max_age_days'):
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=policy['max_age_days'])
+            filters.append(Conversation.updated_time < cutoff)
+        if policy.get('purge_hidden'):
+            filters.append(Conversation.hidden == True)  # noqa: E712
+        if policy.get('max_conversations_per_user'):
+            # Rank each user's conversations newest first, anything ranked
+            # past the quota goes.
+            rank = func.row_number().over(partition_by=Conversation.user_id, order_by=(desc(Conversation.updated_time), desc(Conversation.id))).label('rank')
+            ranked = select(Conversation.id, rank).subquery()
+            filters.append(Conversation.id.in_(select(ranked.c.id).where(ranked.c.rank > policy['max_conversations_per_user'])))
+        return filters
+
+    def get_purge_conversation_ids(self, policy, limit=None):
+        filters = self._purge_filters(policy)
+        if not filters:
+            return []
+        query = select(Conversation.id).where(or_(*filters)).order_by(Conversation.id)
+        if limit:
+            query = query.limit(limit)
+        with self.orm.engine.connect() as conn:
+            return [row.id for row in conn.execute(query)]
+
+    def count_purgeable(self, policy):
+        filters = self._purge_filters(policy)
+        if not filters:
+            return 0
+        with self.orm.engine.connect() as conn:
+            return conn.execute(select(func.count(Conversation.id)).where(or_(*filters))).scalar()
+
+    def purge(self, policy=None, batch_size=None, archive_dir=None):
+        """
+        Delete the conversations matching policy, batch_size at a time.
+
+        Returns:
+            int: The number of conversations deleted.
+        """
+        policy = policy or self.get_policy()
+        batch_size = batch_size or policy.get('batch_size') or constants.DEFAULT_MAINTENANCE_BATCH_SIZE
+        archive_dir = archive_dir or policy.get('archive_directory')
+        archive = Archive(self.config, self.orm)
+        archive_file = None
+        total = 0
+        try:
+            while True:
+                conversation_ids = self.get_purge_conversation_ids(policy, batch_size)
+                if not conversation_ids:
+                    break
+                if archive_dir:
+                    if not archive_file:
+                        os.makedirs(archive_dir, exist_ok=True)
+                        archive_path = os.path.join(archive_dir, "purged-%s.jsonl" % datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+                        archive_file = open(archive_path, 'a', encoding='utf-8')
+                        self.log.info(f"Archiving purged conversations to {archive_path}")
+                    archive.write_jsonl(archive_file, archive.iter_rows(conversation_ids=conversation_ids))
+                    archive_file.flush()
+                    os.fsync(archive_file.fileno())
+                # Messages and summaries go with their conversation via ON DELETE CASCADE.
+                with self.orm.engine.begin() as conn:
+                    conn.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids)))
+                total += len(conversation_ids)
+                self.log.info(f"Purged {len(conversation_ids)} conversations, {total} total")
+        finally:
+            if archive_file:
+                archive_file.close()
+        # Drop any purged rows cached in this thread's session, and the cache.
+        self.orm.session.expire_all()
+        if self.orm.cache:
+            self.orm.cache.clear()
+        return total
+
+    def _sqlite_size(self, conn):
+        page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+        page_count = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        freelist_count = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return page_size * page_count, page_size * freelist_count
+
+    def compact(self, full=False, pages=None):
+        """
+        Reclaim free space and refresh query planner statistics.
+
+        On PostgreSQL, runs VACUUM ANALYZE, which makes dead rows reusable
+        but does not shrink the files. On SQLite, runs an incremental vacuum when the database supports it,
+        or a full VACUUM when full is set, which also switches the database
+        to incremental vacuum for next time.
+
+        Returns:
+            dict: Database size before and after, and bytes reclaimed.
+        """
+        with self.orm.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            if self.orm.engine.dialect.name == 'postgresql':
+                conn.exec_driver_sql("VACUUM ANALYZE")
+                return {'size_before': None, 'size_after': None, 'reclaimed': None, 'free': None}
+            if self.orm.engine.dialect.name != 'sqlite':
+                conn.exec_driver_sql("ANALYZE")
+                return {'size_before': None, 'size_after': None, 'reclaimed': None, 'free': None}
+            size_before, _ = self._sqlite_size(conn)
+            incremental = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == constants.SQLITE_AUTO_VACUUM_INCREMENTAL
+            # Rewriting the statistics can free pages too, so analyze first.
+            conn.exec_driver_sql("ANALYZE")
+            if full:
+                self.log.info("Running full VACUUM")
+                conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.exec_driver_sql("VACUUM")
+            elif incremental:
+                self.log.info("Running incremental vacuum")
+                # Frees one page per step, and a plain execute only steps once
+                # as the pragma returns no columns. executescript() steps
+                # each statement to completion.
+                conn.connection.executescript("PRAGMA incremental_vacuum(%d)" % pages if pages else "PRAGMA incremental_vacuum")
+            else:
+                self.log.warning("Database does not support incremental vacuum, run a full vacuum once to enable it")
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            size_after, free = self._sqlite_size(conn)
+        return {'size_before': size_before, 'size_after': size_after, 'reclaimed': size_before - size_after, 'free': free}
+
+    def run(self, policy=None, full_vacuum=False):
+        """Purge per policy, then compact. Returns a report dict."""
+        policy = policy or self.get_policy()
+        purged = self.purge(policy)
+        report = self.compact(full=full_vacuum, pages=policy.get('vacuum_pages'))
+        report['purged'] = purged
+        self.log.info(f"Maintenance complete: purged {purged} conversations, reclaimed {report['reclaimed']} bytes")
+        return report
+
+class MaintenanceScheduler:
+    """
+    Runs maintenance every interval seconds on a daemon thread, for long
+    lived processes like the API server.
+    """
+
+    def __init__(self, maintenance, interval):
+        self.maintenance = maintenance
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_report = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.last_report = self.maintenance.run()
+            except Exception as e:
+                self.maintenance.log.error(f"Scheduled maintenance failed: {str(e)}")
+            finally:
+                self.maintenance.orm.close_session()
+
+def start_maintenance_scheduler(config, orm=None):
+    """Start scheduled maintenance if maintenance.interval_hours is configured."""
+    interval_hours = config.get('maintenance.interval_hours')
+    if not interval_hours:
+        return None
+    scheduler = MaintenanceScheduler(Maintenance(config, orm), interval_hours * 3600)
+    scheduler.start()
+    return scheduler
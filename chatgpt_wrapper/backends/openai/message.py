@@ -1,46 +1,157 @@
 from sqlalchemy.exc import SQLAlchemyError
 
-from chatgpt_wrapper.backends.openai.orm import Manager, Message
+import chatgpt_wrapper.core.constants as constants
+
+from chatgpt_wrapper.backends.openai.orm import Manager
 from chatgpt_wrapper.backends.openai.conversation import ConversationManager
 
 class MessageManager(Manager):
-    def __init__(self, config=None):
-        super().__init__(config)
-        self.conversation_manager = ConversationManager(self.config)
+    def __init__(self, config=None, orm=None):
+        super().__init__(config, orm)
+        self.conversation_manager = ConversationManager(self.config, self.orm)
 
     def get_message(self, message_id):
         try:
-            message = self.orm.session.query(Message).get(message_id)
+            message = self.orm.get_message(message_id)
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to retrieve message: {str(e)}")
         if not message:
             return False, None, "Message not found"
         return True, message, "Message retrieved successfully"
 
-    def get_messages(self, conversation_id, limit=None, offset=None, target_id=None):
+    def get_messages(self, conversation_id, limit=None, offset=None, target_id=None, after_id=None):
         success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
         if not success:
             return success, conversation, message
         if not conversation:
             return False, None, "Conversation not found"
         try:
-            messages = self.orm.get_messages(conversation, limit=limit, offset=offset, target_id=None)
+            messages = self.orm.get_messages(conversation, limit=limit, offset=offset, target_id=target_id, after_id=after_id)
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to retrieve messages: {str(e)}")
         return True, messages, "Messages retrieved successfully"
 
-    def add_message(self, conversation_id, role, message):
+    def get_last_messages(self, conversation_id, limit=None, max_tokens=None, target_id=None, after_id=None):
+        success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            messages = self.orm.get_last_messages(conversation, limit=limit, max_tokens=max_tokens, target_id=target_id, after_id=after_id)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve last messages: {str(e)}")
+        return True, messages, "Messages retrieved successfully"
+
+    def get_first_message(self, conversation_id):
+        success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            message = self.orm.get_first_message(conversation)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve first message: {str(e)}")
+        return True, message, "Message retrieved successfully"
+
+    def get_message_count(self, conversation_id, target_id=None, after_id=None):
+        success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            count = self.orm.get_message_count(conversation, target_id=target_id, after_id=after_id)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve message count: {str(e)}")
+        return True, count, "Message count retrieved successfully"
+
+    def get_messages_without_token_counts(self, conversation_id):
+        success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            messages = self.orm.get_messages_without_token_counts(conversation)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve messages without token counts: {str(e)}")
+        return True, messages, "Messages retrieved successfully"
+
+    def get_conversation_token_count(self, conversation_id, target_id=None):
+        success, conversation, message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, message
+        try:
+            token_count = self.orm.get_conversation_token_count(conversation, target_id=target_id)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve conversation token count: {str(e)}")
+        return True, token_count, "Conversation token count retrieved successfully"
+
+    def search_messages(self, user_id, query, limit=constants.DEFAULT_SEARCH_LIMIT, offset=None):
+        if not query or not query.strip():
+            return False, None, "Search query cannot be empty"
+        try:
+            user = self.orm.get_user(user_id)
+            if not user:
+                return False, None, "User not found"
+            results = self.orm.search_messages(user, query, limit=limit, offset=offset)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to search messages: {str(e)}")
+        return True, results, "Messages searched successfully"
+
+    def get_message_rows(self, message_ids):
+        try:
+            rows = self.orm.get_message_rows(message_ids)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve message rows: {str(e)}")
+        return True, rows, "Message rows retrieved successfully"
+
+    def get_messages_for_indexing(self, after_id=0, limit=None):
+        try:
+            messages = self.orm.get_messages_for_indexing(after_id, limit)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve messages to index: {str(e)}")
+        return True, messages, "Messages to index retrieved successfully"
+
+    def get_messages_changed_since(self, since):
+        try:
+            messages = self.orm.get_messages_changed_since(since)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve changed messages: {str(e)}")
+        return True, messages, "Changed messages retrieved successfully"
+
+    def get_total_message_count(self):
+        try:
+            count = self.orm.get_total_message_count()
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to retrieve total message count: {str(e)}")
+        return True, count, "Total message count retrieved successfully"
+
+    def get_existing_message_ids(self, message_ids):
+        try:
+            message_ids = self.orm.get_existing_message_ids(message_ids)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to check message ids: {str(e)}")
+        return True, message_ids, "Message ids checked successfully"
+
+    def add_message(self, conversation_id, role, message, prompt_tokens=0, completion_tokens=0):
         success, conversation, user_message = self.conversation_manager.get_conversation(conversation_id)
         if not success:
             return success, conversation, user_message
         if not conversation:
             return False, None, "Conversation not found"
         try:
-            message = self.orm.add_message(conversation, role, message)
+            message = self.orm.add_message(conversation, role, message, prompt_tokens, completion_tokens)
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to add message: {str(e)}")
         return True, message, "Message added successfully"
 
+    def add_messages(self, conversation_id, messages):
+        success, conversation, user_message = self.conversation_manager.get_conversation(conversation_id)
+        if not success:
+            return success, conversation, user_message
+        if not conversation:
+            return False, None, "Conversation not found"
+        try:
+            messages = self.orm.add_messages(conversation, messages)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to add messages: {str(e)}")
+        return True, messages, "Messages added successfully"
+
     def edit_message(self, message_id, **kwargs):
         success, message, user_message = self.get_message(message_id)
         if not success:
@@ -53,6 +164,13 @@ class MessageManager(Manager):
             return self._handle_error(f"Failed to edit message: {str(e)}")
         return True, updated_message, "Message edited successfully"
 
+    def edit_message_token_counts(self, token_counts):
+        try:
+            self.orm.edit_message_token_counts(token_counts)
+        except SQLAlchemyError as e:
+            return self._handle_error(f"Failed to edit message token counts: {str(e)}")
+        return True, token_counts, "Message token counts edited successfully"
+
     def delete_message(self, message_id):
         success, message, user_message = self.get_message(message_id)
         if not success:
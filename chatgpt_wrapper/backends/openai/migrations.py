@@ -0,0 +1,392 @@
+import datetime
+from abc import ABC, abstractmethod
+
+from sqlalchemy import MetaData, Table, ForeignKey, Index, Column, Integer, String, DateTime, JSON, Boolean
+from sqlalchemy import inspect, select, insert, func
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from chatgpt_wrapper.backends.openai.orm import create_storage, postgres_search_document, SEARCH_INDEX_TABLE, SEARCH_INDEX_DDL
+from chatgpt_wrapper.core.logger import Logger
+from chatgpt_wrapper.core.config import Config
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+schema_version = Table(
+    SCHEMA_VERSION_TABLE, MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String, nullable=False),
+    Column('applied_time', DateTime, nullable=False),
+)
+
+# Migrations describe the schema as it was when they were written, not the
+# current models, so later model changes never alter what an old migration
+# does. Tables are snapshotted here, one MetaData per migration that adds them.
+v1 = MetaData()
+v1_user = Table(
+    'user', v1,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('username', String, unique=True, nullable=False),
+    Column('password', String, nullable=True),
+    Column('email', String, unique=True, nullable=True),
+    Column('default_model', String, nullable=False),
+    Column('created_time', DateTime, nullable=False),
+    Column('last_login_time', DateTime, nullable=True),
+    Column('preferences', JSON, nullable=False),
+    Index('user_username_idx', 'username'),
+    Index('user_email_idx', 'email'),
+    Index('user_created_time_idx', 'created_time'),
+    Index('user_last_login_time', 'last_login_time'),
+)
+v1_conversation = Table(
+    'conversation', v1,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('user_id', Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False),
+    Column('title', String, nullable=True),
+    Column('model', String, nullable=False),
+    Column('created_time', DateTime, nullable=False),
+    Column('updated_time', DateTime, nullable=False),
+    Column('hidden', Boolean, nullable=False),
+    Index('conversation_user_id_idx', 'user_id'),
+    Index('conversation_created_time_idx', 'created_time'),
+    Index('conversation_updated_time_idx', 'updated_time'),
+    Index('conversation_hidden_idx', 'hidden'),
+)
+v1_message = Table(
+    'message', v1,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('conversation_id', Integer, ForeignKey('conversation.id', ondelete='CASCADE'), nullable=False),
+    Column('role', String, nullable=False),
+    Column('message', String, nullable=False),
+    Column('created_time', DateTime, nullable=False),
+    Column('prompt_tokens', Integer, nullable=False),
+    Column('completion_tokens', Integer, nullable=False),
+    Index('message_conversation_id_idx', 'conversation_id'),
+    Index('message_created_time_idx', 'created_time'),
+)
+
+v2 = MetaData()
+v2_conversation_summary = Table(
+    'conversation_summary', v2,
+    Column('conversation_id', Integer, ForeignKey('conversation.id', ondelete='CASCADE'), primary_key=True),
+    Column('message_id', Integer, ForeignKey('message.id', ondelete='CASCADE'), nullable=False),
+    Column('summary', String, nullable=False),
+    Column('token_count', Integer, nullable=False),
+    Column('updated_time', DateTime, nullable=False),
+    Index('conversation_summary_message_id_idx', 'message_id'),
+)
+# Foreign keys are resolved by table name, so the referenced tables need to
+# be in the same MetaData.
+v1_conversation.to_metadata(v2)
+v1_message.to_metadata(v2)
+
+v3 = MetaData()
+v3_message = v1_message.to_metadata(v3)
+v3_message_conversation_id_id_idx = Index('message_conversation_id_id_idx', v3_message.c.conversation_id, v3_message.c.id)
+
+v5 = MetaData()
+v5_message = v1_message.to_metadata(v5)
+# Full text search on PostgreSQL, the expression must match the one
+# PostgresOrm.search_messages() queries.
+v5_message_search_idx = Index('message_message_search_idx', postgres_search_document(v5_message.c.message), postgresql_using='gin')
+
+v6 = MetaData()
+v6_message = v1_message.to_metadata(v6)
+v6_message.append_column(Column('updated_time', DateTime, nullable=True))
+v6_message_updated_time_idx = Index('message_updated_time_idx', v6_message.c.updated_time)
+
+class Migrator:
+    """
+    Schema operations for migrations, run on one connection.
+
+    Every operation checks the live schema first and skips work that is
+    already done, so databases created before versioning, or a migration
+    interrupted part way, upgrade cleanly by running the migration again.
+
+    In dry run mode statements are only recorded, never executed.
+    """
+
+    def __init__(self, conn, dry_run=False, log=None):
+        self.conn = conn
+        self.dialect = conn.dialect
+        self.dry_run = dry_run
+        self.log = log
+        self.statements = []
+        # Run after the migration's transaction commits, for DDL that cannot
+        # run inside a transaction.
+        self.deferred = []
+
+    def _compile(self, statement):
+        if isinstance(statement, str):
+            return statement
+        return str(statement.compile(dialect=self.dialect)).strip()
+
+    def execute(self, statement):
+        sql = self._compile(statement)
+        self.statements.append(sql)
+        if self.log:
+            self.log.debug(f"Migration DDL: {sql}")
+        if not self.dry_run:
+            self.conn.exec_driver_sql(sql)
+
+    def has_table(self, name):
+        return inspect(self.conn).has_table(name)
+
+    def has_index(self, table_name, index_name):
+        return self.has_table(table_name) and index_name in [i['name'] for i in inspect(self.conn).get_indexes(table_name)]
+
+    def has_column(self, table_name, column_name):
+        return self.has_table(table_name) and column_name in [c['name'] for c in inspect(self.conn).get_columns(table_name)]
+
+    def has_rows(self, table):
+        return self.has_table(table.name) and self.conn.execute(select(table.c.id).limit(1)).first() is not None
+
+    def create_table(self, table, indexes=True):
+        if not self.has_table(table.name):
+            self.execute(CreateTable(table))
+        if indexes:
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                self.create_index(index)
+
+    def create_index(self, index, online=True):
+        """
+        Create an index if it does not exist.
+
+        With online set, PostgreSQL builds the index concurrently after the
+        migration commits, so writes are not blocked while it builds. SQLite
+        has no online index builds, but in WAL mode readers are not blocked
+        either way.
+        """
+        if self.has_index(index.table.name, index.name):
+            return
+        if online and self.dialect.name == 'postgresql':
+            sql = self._compile(CreateIndex(index)).replace('INDEX', 'INDEX CONCURRENTLY IF NOT EXISTS', 1)
+            self.deferred.append(sql)
+        else:
+            self.execute(CreateIndex(index))
+
+    def add_column(self, table_name, column):
+        if self.has_column(table_name, column.name):
+            return
+        column_type = column.type.compile(dialect=self.dialect)
+        sql = f"ALTER TABLE {self.dialect.identifier_preparer.quote(table_name)} ADD COLUMN {self.dialect.identifier_preparer.quote(column.name)} {column_type}"
+        if not column.nullable:
+            sql += " NOT NULL"
+        if column.server_default is not None:
+            default = column.server_default.arg
+            default = "'%s'" % default.replace("'", "''") if isinstance(default, str) else self._compile(default)
+            sql += f" DEFAULT {default}"
+        self.execute(sql)
+
+    def rebuild_table(self, table, column_map=None):
+        """
+        Batch mode table change for SQLite, which can only add columns with
+        ALTER TABLE. Creates the new definition of table alongside the old
+        one, copies the rows across, then swaps it in, and re-creates the
+        table's indexes and triggers.
+
+        Args:
+            table (Table): The new table definition.
+            column_map (dict): New column name -> SQL expression over the old
+                table's columns. Unmapped columns are copied by name.
+        """
+        if self.dialect.name != 'sqlite':
+            raise Exception(f"Table rebuilds are only needed on SQLite, use ALTER TABLE on {self.dialect.name}")
+        column_map = column_map or {}
+        quote = self.dialect.identifier_preparer.quote
+        name = table.name
+        tmp_name = f"_migrate_{name}"
+        triggers = [row.sql for row in self.conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (name,))]
+        old_columns = [c['name'] for c in inspect(self.conn).get_columns(name)] if self.has_table(name) else []
+        # Copy the tables it references too, so its foreign keys compile.
+        metadata = MetaData()
+        for other in table.metadata.tables.values():
+            other.to_metadata(metadata)
+        tmp_table = table.to_metadata(metadata, name=tmp_name)
+        # Index names are database wide, build them after the swap.
+        for index in list(tmp_table.indexes):
+            tmp_table.indexes.discard(index)
+        self.execute(CreateTable(tmp_table))
+        columns = [c.name for c in table.columns if c.name in column_map or c.name in old_columns]
+        expressions = [column_map.get(c, quote(c)) for c in columns]
+        self.execute(f"INSERT INTO {quote(tmp_name)} ({', '.join(quote(c) for c in columns)}) SELECT {', '.join(expressions)} FROM {quote(name)}")
+        self.execute(f"DROP TABLE {quote(name)}")
+        self.execute(f"ALTER TABLE {quote(tmp_name)} RENAME TO {quote(name)}")
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            self.execute(CreateIndex(index))
+        for trigger in triggers:
+            self.execute(trigger)
+
+class Migration(ABC):
+    """
+    One versioned change to the schema.
+
+    Add new migrations to the end of MIGRATIONS with the next version. Use
+    the Migrator operations, which skip work that is already done.
+    """
+
+    version = None
+    name = None
+
+    @abstractmethod
+    def upgrade(self, migrator):
+        pass
+
+class InitialSchema(Migration):
+    version = 1
+    name = 'initial_schema'
+
+    def upgrade(self, migrator):
+        for table in v1.sorted_tables:
+            migrator.create_table(table)
+
+class ConversationSummary(Migration):
+    version = 2
+    name = 'conversation_summary'
+
+    def upgrade(self, migrator):
+        migrator.create_table(v2_conversation_summary)
+
+class MessageConversationIdIdIndex(Migration):
+    version = 3
+    name = 'message_conversation_id_id_index'
+
+    def upgrade(self, migrator):
+        migrator.create_index(v3_message_conversation_id_id_idx)
+
+class MessageSearchIndex(Migration):
+    version = 4
+    name = 'message_search_index'
+
+    def upgrade(self, migrator):
+        if migrator.dialect.name != 'sqlite' or migrator.has_table(SEARCH_INDEX_TABLE):
+            return
+        for statement in SEARCH_INDEX_DDL:
+            migrator.execute(statement)
+        # The triggers only index new messages.
+        if migrator.has_rows(v1_message):
+            migrator.execute(f"INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}) VALUES ('rebuild')")
+
+class PostgresMessageSearchIndex(Migration):
+    version = 5
+    name = 'postgres_message_search_index'
+
+    def upgrade(self, migrator):
+        if migrator.dialect.name != 'postgresql':
+            return
+        migrator.create_index(v5_message_search_idx)
+
+class MessageUpdatedTime(Migration):
+    version = 6
+    name = 'message_updated_time'
+
+    def upgrade(self, migrator):
+        migrator.add_column('message', v6_message.c.updated_time)
+        migrator.create_index(v6_message_updated_time_idx)
+
+MIGRATIONS = [
+    InitialSchema,
+    ConversationSummary,
+    MessageConversationIdIdIndex,
+    MessageSearchIndex,
+    PostgresMessageSearchIndex,
+    MessageUpdatedTime,
+]
+
+class SchemaMigrations:
+    """
+    Versioned schema migrations.
+
+    The applied versions are recorded in the schema_version table, so checking
+    whether a database is up to date is a single query. Each migration runs
+    in its own transaction, and on SQLite with foreign key enforcement off so
+    tables can be rebuilt, checking the foreign keys before commit.
+    """
+
+    def __init__(self, config=None, orm=None, migrations=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.orm = orm or create_storage(self.config)
+        self.migrations = [m() for m in (migrations or MIGRATIONS)]
+        versions = [m.version for m in self.migrations]
+        if versions != sorted(set(versions)):
+            raise Exception(f"Migration versions must be unique and in order: {versions}")
+
+    @property
+    def latest_version(self):
+        return self.migrations[-1].version if self.migrations else 0
+
+    def _get_version(self, conn):
+        if not inspect(conn).has_table(SCHEMA_VERSION_TABLE):
+            return 0
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+    def get_version(self):
+        with self.orm.engine.connect() as conn:
+            return self._get_version(conn)
+
+    def get_pending(self, target=None, current=None):
+        current = self.get_version() if current is None else current
+        target = self.latest_version if target is None else target
+        return [m for m in self.migrations if current < m.version <= target]
+
+    def upgrade(self, target=None, dry_run=False):
+        """
+        Apply pending migrations up to target, default the latest.
+
+        Returns:
+            list: (migration, statements) for each migration applied, or that
+                would be applied in dry run mode.
+        """
+        results = []
+        with self.orm.engine.connect() as conn:
+            # Transactions are managed explicitly, pysqlite does not begin a
+            # transaction before DDL on its own. Autocommit is off so DML in
+            # a migration does not commit it part way.
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT", autocommit=False)
+            pending = self.get_pending(target, self._get_version(conn))
+            if not pending:
+                return results
+            if dry_run:
+                for migration in pending:
+                    migrator = Migrator(conn, dry_run=True, log=self.log)
+                    migration.upgrade(migrator)
+                    results.append((migration, migrator.statements + migrator.deferred))
+                return results
+            schema_version.create(conn, checkfirst=True)
+            sqlite = conn.dialect.name == 'sqlite'
+            if sqlite:
+                conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            try:
+                for migration in pending:
+                    self.log.info(f"Applying migration {migration.version}: {migration.name}")
+                    migrator = self._run(conn, migration)
+                    results.append((migration, migrator.statements + migrator.deferred))
+            finally:
+                if sqlite:
+                    conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+        return results
+
+    def _record_version(self, conn, migration):
+        conn.execute(insert(schema_version).values(version=migration.version, name=migration.name, applied_time=datetime.datetime.now()))
+
+    def _run(self, conn, migration):
+        migrator = Migrator(conn, log=self.log)
+        conn.exec_driver_sql("BEGIN")
+        try:
+            migration.upgrade(migrator)
+            if conn.dialect.name == 'sqlite':
+                violations = conn.exec_driver_sql("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise Exception(f"Migration {migration.version} left {len(violations)} foreign key violations, first: {tuple(violations[0])}")
+            if not migrator.deferred:
+                self._record_version(conn, migration)
+            conn.exec_driver_sql("COMMIT")
+        except Exception:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+        if migrator.deferred:
+            # If these fail the version is not recorded, and the next upgrade
+            # runs the migration again.
+            for statement in migrator.deferred:
+                conn.exec_driver_sql(statement)
+            self._record_version(conn, migration)
+        return migrator
@@ -1,27 +1,48 @@
+import csv
+import io
+import json
 import datetime
+import functools
+import threading
 
 from sqlalchemy import event
-from sqlalchemy.engine import Engine
-from sqlite3 import Connection as SQLite3Connection
-from sqlalchemy import MetaData, ForeignKey, Index, Column, Integer, String, DateTime, JSON, Boolean
-from sqlalchemy import desc
+from sqlalchemy.engine import make_url
+from sqlalchemy import MetaData, Table, ForeignKey, Index, Column, Integer, String, DateTime, JSON, Boolean
+from sqlalchemy import desc, func, literal_column, insert, or_, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import declarative_base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy import inspect
+from sqlalchemy.pool import QueuePool, NullPool, StaticPool, SingletonThreadPool
 
+from chatgpt_wrapper.backends.openai.cache import ConversationCache
+from chatgpt_wrapper.backends.openai.storage import Storage
 from chatgpt_wrapper.core.config import Config
 from chatgpt_wrapper.core.logger import Logger
 import chatgpt_wrapper.core.constants as constants
 
 Base = declarative_base()
-def _set_sqlite_pragma(conn, _record):
-    if isinstance(conn, SQLite3Connection):
+
+POOL_CLASSES = {
+    'queue': QueuePool,
+    'null': NullPool,
+    'static': StaticPool,
+    'singleton': SingletonThreadPool,
+}
+
+def is_sqlite_memory_database(database):
+    return database in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in database
+
+def make_sqlite_pragma_listener(pragmas):
+    # Foreign keys are always enforced, the cascading deletes rely on them.
+    statements = ["PRAGMA foreign_keys=ON;"] + ["PRAGMA %s=%s;" % (name, value) for name, value in pragmas.items() if value is not None]
+    def set_sqlite_pragmas(conn, _record):
         cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON;")
+        for statement in statements:
+            cursor.execute(statement)
         cursor.close()
-event.listen(Engine, "connect", _set_sqlite_pragma)
+    return set_sqlite_pragmas
 
 class User(Base):
     __tablename__ = 'user'
@@ -71,20 +92,153 @@ class Message(Base):
     created_time = Column(DateTime, nullable=False)
     prompt_tokens = Column(Integer, nullable=False)
     completion_tokens = Column(Integer, nullable=False)
+    # Set when the message is edited, NULL until then.
+    updated_time = Column(DateTime, nullable=True)
 
     conversation = relationship('Conversation', back_populates='messages')
 
 Index('message_conversation_id_idx', Message.conversation_id)
+Index('message_conversation_id_id_idx', Message.conversation_id, Message.id)
 Index('message_created_time_idx', Message.created_time)
+Index('message_updated_time_idx', Message.updated_time)
+
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summary'
+
+    conversation_id = Column(Integer, ForeignKey('conversation.id', ondelete='CASCADE'), primary_key=True)
+    message_id = Column(Integer, ForeignKey('message.id', ondelete='CASCADE'), nullable=False)
+    summary = Column(String, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+Index('conversation_summary_message_id_idx', ConversationSummary.message_id)
+
+# SQLite FTS5 full text index of message content, kept in sync with the
+# message table by triggers. Managed by Database, not part of Base.metadata.
+SEARCH_INDEX_TABLE = 'message_fts'
+SEARCH_INDEX_DDL = [
+    f"CREATE VIRTUAL TABLE {SEARCH_INDEX_TABLE} USING fts5(message, content='message', content_rowid='id', tokenize='porter unicode61')",
+    f"""CREATE TRIGGER {SEARCH_INDEX_TABLE}_insert AFTER INSERT ON message BEGIN
+        INSERT INTO {SEARCH_INDEX_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+    f"""CREATE TRIGGER {SEARCH_INDEX_TABLE}_delete AFTER DELETE ON message BEGIN
+        INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    f"""CREATE TRIGGER {SEARCH_INDEX_TABLE}_update AFTER UPDATE OF message ON message BEGIN
+        INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO {SEARCH_INDEX_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+]
+search_index = Table(SEARCH_INDEX_TABLE, MetaData(), Column('rowid', Integer), Column('message', String))
+
+def build_search_query(text):
+    """Quote each term, so user input is never parsed as FTS5 query syntax."""
+    return ' '.join('"%s"' % term.replace('"', '""') for term in text.split())
+
+# PostgreSQL full text search configuration, stemming like the FTS5 porter
+# tokenizer. A literal, so queries match the GIN expression index.
+POSTGRES_SEARCH_CONFIG = text("'english'::regconfig")
+
+def postgres_search_document(column):
+    return func.to_tsvector(POSTGRES_SEARCH_CONFIG, column)
+
+def build_postgres_headline_options(highlight, fragment_delimiter='...'):
+    quote = lambda value: '"%s"' % value.replace('"', '""')
+    return f"StartSel={quote(highlight[0])}, StopSel={quote(highlight[1])}, MaxWords={constants.SEARCH_SNIPPET_TOKENS}, MinWords={constants.SEARCH_SNIPPET_TOKENS // 2}, MaxFragments=1, FragmentDelimiter={quote(fragment_delimiter)}"
+
+@functools.lru_cache(maxsize=None)
+def get_column_keys(klass):
+    """Column attribute names of a mapped class, inspected once per class."""
+    return tuple(c.key for c in inspect(klass).mapper.column_attrs)
+
+def detached_copy(obj):
+    """A copy of a model's columns that belongs to no session, for caching."""
+    klass = type(obj)
+    return klass(**{key: getattr(obj, key) for key in get_column_keys(klass)})
+
+def create_conversation_cache(options):
+    options = options or {}
+    if not options.get('max_conversations'):
+        return None
+    return ConversationCache(options['max_conversations'], options.get('window_messages') or constants.DEFAULT_CONVERSATION_CACHE_WINDOW)
+
+class EngineRegistry:
+    """
+    Process-wide registry of engines, sessions and conversation caches, keyed
+    by database URL.
+
+    Creating an engine sets up a connection pool, so every Orm for the same
+    database shares a single engine, and a single cache so writes through
+    any of them keep it current. Sessions are scoped to the current thread,
+    so threads never share a session.
+    """
+
+    def __init__(self):
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    def create_engine_and_metadata(self, database, options=None):
+        engine = get_storage_class(database).make_engine(database, options or {})
+        # The schema is versioned by migrations, so the models are its
+        # description, no need to reflect it.
+        return engine, Base.metadata
+
+    def get(self, database, options=None):
+        with self.lock:
+            if database not in self.engines:
+                engine, metadata = self.create_engine_and_metadata(database, options)
+                cache = create_conversation_cache((options or {}).get('cache'))
+                self.engines[database] = (engine, metadata, scoped_session(sessionmaker(bind=engine)), cache)
+            return self.engines[database]
+
+    def dispose(self, database=None):
+        with self.lock:
+            databases = [database] if database else list(self.engines.keys())
+            for database in databases:
+                if database in self.engines:
+                    engine, _metadata, session, _cache = self.engines.pop(database)
+                    session.remove()
+                    engine.dispose()
+
+engine_registry = EngineRegistry()
+
+class Orm(Storage):
+    """
+    Storage on any database SQLAlchemy supports.
+
+    Subclasses add database specific engine setup and optimizations, the
+    class for a database URL is found with get_storage_class().
+    """
 
-class Orm:
     def __init__(self, config=None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
         self.database = self.config.get('database')
-        self.engine, self.metadata = self.create_engine_and_metadata()
-        session = sessionmaker(bind=self.engine)
-        self.session = session()
+        # Thread-local session registry, proxies to the current thread's session.
+        # The cache is None when disabled.
+        self.engine, self.metadata, self.session, self.cache = engine_registry.get(self.database, self.config.get('database_options'))
+
+    @classmethod
+    def get_engine_args(cls, database, options):
+        """Returns (engine args, DBAPI connect args) for create_engine()."""
+        engine_args = {}
+        pool_class = options.get('pool_class')
+        if pool_class:
+            if pool_class not in POOL_CLASSES:
+                raise Exception(f"Invalid database pool class '{pool_class}', must be one of: {', '.join(POOL_CLASSES.keys())}")
+            engine_args['poolclass'] = POOL_CLASSES[pool_class]
+            if pool_class == 'queue' and options.get('pool_size'):
+                engine_args['pool_size'] = options['pool_size']
+        return engine_args, {}
+
+    @classmethod
+    def make_engine(cls, database, options):
+        engine_args, connect_args = cls.get_engine_args(database, options)
+        return create_engine(database, connect_args=connect_args, **engine_args)
+
+    def close_session(self):
+        """Close the current thread's session, call when a thread or request is done with the database."""
+        self.session.remove()
 
     def _apply_limit_offset(self, query, limit, offset):
         if limit is not None:
@@ -93,22 +247,9 @@ class Orm:
             query = query.offset(offset)
         return query
 
-    def create_engine_and_metadata(self):
-        args = ""
-        # TODO: check_same_thread is currently needed for SQLite so the
-        # separate thread that generates titles can run without error.
-        # It would probably be better to work this out with locking or
-        # a separate database connection or other fix.
-        if self.database.startswith('sqlite'):
-            args = "?check_same_thread=False"
-        engine = create_engine(f"{self.database}{args}")
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-        return engine, metadata
-
     def object_as_dict(self, obj):
-        return {c.key: getattr(obj, c.key)
-                for c in inspect(obj).mapper.column_attrs}
+        return {key: getattr(obj, key)
+                for key in get_column_keys(type(obj))}
 
     def get_users(self, limit=None, offset=None):
         self.log.debug('Retrieving all Users')
@@ -117,25 +258,224 @@ class Orm:
         users = query.all()
         return users
 
-    def get_conversations(self, user, limit=constants.DEFAULT_HISTORY_LIMIT, offset=None, order_desc=True):
+    def get_conversations(self, user, limit=constants.DEFAULT_HISTORY_LIMIT, offset=None, order_desc=True, before_id=None, after_id=None):
         self.log.debug(f'Retrieving Conversations for User with id {user.id}')
-        if order_desc:
-            query = self.session.query(Conversation).filter(Conversation.user_id == user.id).order_by(desc(Conversation.id))
-        else:
-            query = self.session.query(Conversation).order_by(Conversation.id)
-        query = self._apply_limit_offset(query, limit, offset)
+        query = self._filter_conversations(self.session.query(Conversation), user, limit, offset, order_desc, before_id, after_id)
         conversations = query.all()
         return conversations
 
-    def get_messages(self, conversation, limit=None, offset=None, target_id=None):
+    def get_conversation_rows(self, user, columns, limit=constants.DEFAULT_HISTORY_LIMIT, offset=None, order_desc=True, before_id=None, after_id=None):
+        """
+        Like get_conversations(), but only loads the Conversation columns
+        named in columns, as plain rows instead of ORM objects.
+        """
+        self.log.debug(f'Retrieving Conversation rows for User with id {user.id}')
+        query = self._filter_conversations(self.session.query(*[Conversation.__table__.c[name] for name in columns]), user, limit, offset, order_desc, before_id, after_id)
+        rows = query.all()
+        return rows
+
+    def _filter_conversations(self, query, user, limit, offset, order_desc, before_id, after_id):
+        query = query.filter(Conversation.user_id == user.id)
+        # Keyset pagination, seeks straight to the page instead of scanning
+        # past every skipped row like OFFSET does.
+        if before_id:
+            query = query.filter(Conversation.id < before_id)
+        if after_id:
+            query = query.filter(Conversation.id > after_id)
+        if order_desc:
+            query = query.order_by(desc(Conversation.id))
+        else:
+            query = query.order_by(Conversation.id)
+        return self._apply_limit_offset(query, limit, offset)
+
+    def _persistent(self, obj):
+        """The session's instance of a model, for objects from the cache."""
+        if inspect(obj).transient:
+            return self.session.get(type(obj), obj.id)
+        return obj
+
+    def _filter_window(self, messages, target_id=None, after_id=None):
+        return [m for m in messages if (not target_id or m.id <= target_id) and (not after_id or m.id > after_id)]
+
+    def _load_window(self, conversation):
+        """Load a conversation's most recent messages into the cache."""
+        generation = self.cache.generation
+        query = self.session.query(Message).filter(Message.conversation_id == conversation.id).order_by(desc(Message.id)).limit(self.cache.window_messages + 1)
+        messages = query.all()
+        messages.reverse()
+        complete = len(messages) <= self.cache.window_messages
+        messages = [detached_copy(m) for m in messages[-self.cache.window_messages:]]
+        self.cache.put_window(conversation.id, messages, complete, generation)
+        return messages, complete
+
+    def _get_complete_window(self, conversation):
+        window = self.cache.get_window(conversation.id)
+        if window is not None and window[1]:
+            return window[0]
+        return None
+
+    def _message_range_filters(self, conversation, target_id=None, after_id=None):
+        filters = [Message.conversation_id == conversation.id]
+        if target_id:
+            filters.append(Message.id <= target_id)
+        if after_id:
+            filters.append(Message.id > after_id)
+        return filters
+
+    def get_messages(self, conversation, limit=None, offset=None, target_id=None, after_id=None):
         self.log.debug(f'Retrieving Messages for Conversation with id {conversation.id}')
-        query = self.session.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.id)
+        if self.cache:
+            window = self._get_complete_window(conversation)
+            if self.cache.record(window is not None):
+                messages = self._filter_window(window, target_id, after_id)[offset or 0:]
+                return messages if limit is None else messages[:limit]
+            generation = self.cache.generation
+        query = self.session.query(Message).filter(*self._message_range_filters(conversation, target_id, after_id)).order_by(Message.id)
         query = self._apply_limit_offset(query, limit, offset)
-        if target_id:
-            query = query.filter(Message.id <= target_id)
         messages = query.all()
+        if self.cache and not (limit or offset or target_id or after_id) and len(messages) <= self.cache.window_messages:
+            self.cache.put_window(conversation.id, [detached_copy(m) for m in messages], True, generation)
+        return messages
+
+    def _get_last_messages_from_window(self, window, limit, max_tokens, target_id, after_id):
+        messages, complete = window
+        last_messages = []
+        tokens = 0
+        for message in reversed(self._filter_window(messages, target_id, after_id)):
+            if limit is not None and len(last_messages) >= limit:
+                break
+            tokens += message.prompt_tokens + message.completion_tokens
+            if max_tokens is not None and tokens > max_tokens:
+                break
+            last_messages.append(message)
+        else:
+            # Ran out of cached messages, older ones may still qualify.
+            if not complete and not (limit is not None and len(last_messages) >= limit):
+                return None
+        last_messages.reverse()
+        return last_messages
+
+    def get_last_messages(self, conversation, limit=None, max_tokens=None, target_id=None, after_id=None):
+        """
+        Retrieve the most recent messages of a conversation, oldest first.
+
+        Args:
+            limit (int): Maximum number of messages.
+            max_tokens (int): Maximum total stored token count of the messages.
+            target_id (int): Only messages up to and including this message.
+            after_id (int): Only messages after this message.
+        """
+        self.log.debug(f'Retrieving last Messages for Conversation with id {conversation.id}, limit: {limit}, max_tokens: {max_tokens}')
+        if self.cache:
+            window = self.cache.get_window(conversation.id)
+            hit = window is not None
+            if not hit:
+                window = self._load_window(conversation)
+            messages = self._get_last_messages_from_window(window, limit, max_tokens, target_id, after_id)
+            self.cache.record(hit and messages is not None)
+            if messages is not None:
+                return messages
+        filters = self._message_range_filters(conversation, target_id, after_id)
+        query = self.session.query(Message).filter(*filters)
+        if max_tokens is not None:
+            running_tokens = func.sum(Message.prompt_tokens + Message.completion_tokens).over(order_by=desc(Message.id))
+            window = self.session.query(Message.id.label('id'), running_tokens.label('running_tokens')).filter(*filters).subquery()
+            query = self.session.query(Message).join(window, Message.id == window.c.id).filter(window.c.running_tokens <= max_tokens)
+        query = query.order_by(desc(Message.id))
+        query = self._apply_limit_offset(query, limit, None)
+        messages = query.all()
+        messages.reverse()
         return messages
 
+    def get_first_message(self, conversation):
+        self.log.debug(f'Retrieving first Message for Conversation with id {conversation.id}')
+        if self.cache:
+            window = self._get_complete_window(conversation)
+            if self.cache.record(window is not None):
+                return window[0] if window else None
+        message = self.session.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.id).first()
+        return message
+
+    def get_message_count(self, conversation, target_id=None, after_id=None):
+        self.log.debug(f'Retrieving Message count for Conversation with id {conversation.id}')
+        if self.cache:
+            window = self._get_complete_window(conversation)
+            if self.cache.record(window is not None):
+                return len(self._filter_window(window, target_id, after_id))
+        count = self.session.query(func.count(Message.id)).filter(*self._message_range_filters(conversation, target_id, after_id)).scalar()
+        return count
+
+    def _search_messages_query(self, *columns):
+        return self.session.query(
+            Message.id,
+            Message.conversation_id,
+            Message.role,
+            Message.created_time,
+            Conversation.title,
+            *columns,
+        ).join(Conversation, Conversation.id == Message.conversation_id)
+
+    def search_messages(self, user, query, limit=constants.DEFAULT_SEARCH_LIMIT, offset=None, highlight=('**', '**')):
+        """
+        Full text search of a user's messages, best matches first.
+
+        Returns rows with the message id, conversation_id, role, created_time,
+        the conversation title, and a snippet with matches wrapped in highlight.
+
+        Databases without full text search match every term as a substring,
+        newest first, and the snippet is the start of the message.
+        """
+        self.log.debug(f"Searching Messages for User with id {user.id}: {query}")
+        rank = (-Message.id).label('rank')
+        snippet = func.substr(Message.message, 1, constants.SEARCH_SNIPPET_TOKENS * 8).label('snippet')
+        terms = [Message.message.ilike('%%%s%%' % term) for term in query.split()]
+        query = self._search_messages_query(snippet, rank).filter(Conversation.user_id == user.id, *terms).order_by(rank)
+        query = self._apply_limit_offset(query, limit, offset)
+        rows = query.all()
+        return rows
+
+    def _messages_for_indexing_query(self):
+        return self.session.query(Message.id, Message.conversation_id, Conversation.user_id, Message.message, Message.created_time, Message.updated_time).join(Conversation, Message.conversation_id == Conversation.id)
+
+    def get_messages_for_indexing(self, after_id=0, limit=None):
+        self.log.debug(f'Retrieving Messages to index after id {after_id}')
+        query = self._messages_for_indexing_query().filter(Message.id > after_id).order_by(Message.id)
+        query = self._apply_limit_offset(query, limit, None)
+        rows = query.all()
+        return rows
+
+    def get_messages_changed_since(self, since):
+        """Messages created or edited at or after since, for re-indexing."""
+        self.log.debug(f'Retrieving Messages to index changed since {since}')
+        query = self._messages_for_indexing_query().filter(or_(Message.created_time >= since, Message.updated_time >= since)).order_by(Message.id)
+        rows = query.all()
+        return rows
+
+    def get_total_message_count(self):
+        self.log.debug('Retrieving total Message count')
+        count = self.session.query(func.count(Message.id)).scalar()
+        return count
+
+    def get_existing_message_ids(self, message_ids):
+        self.log.debug(f'Checking {len(message_ids)} Message ids exist')
+        rows = self.session.query(Message.id).filter(Message.id.in_(message_ids)).all()
+        return {row.id for row in rows}
+
+    def get_message_rows(self, message_ids):
+        self.log.debug(f'Retrieving {len(message_ids)} Message rows by id')
+        query = self.session.query(Message.id, Message.conversation_id, Message.role, Message.message, Message.created_time, Conversation.title).join(Conversation, Message.conversation_id == Conversation.id).filter(Message.id.in_(message_ids))
+        rows = query.all()
+        return rows
+
+    def find_user(self, identifiers, match_email=True):
+        """The first User whose username, or email with match_email set, is one of identifiers."""
+        self.log.debug(f'Finding User matching {identifiers}')
+        filters = [User.username.in_(identifiers)]
+        if match_email:
+            filters.append(User.email.in_(identifiers))
+        user = self.session.query(User).filter(or_(*filters)).first()
+        return user
+
     def add_user(self, username, password, email, default_model="default", preferences={}):
         now = datetime.datetime.now()
         user = User(username=username, password=password, email=email, default_model=default_model, created_time=now, last_login_time=now, preferences=preferences)
@@ -148,18 +488,94 @@ class Orm:
         now = datetime.datetime.now()
         conversation = Conversation(user_id=user.id, title=title, model=model, created_time=now, updated_time=now, hidden=False)
         self.session.add(conversation)
+        self.session.flush()
+        cached = self.cache and detached_copy(conversation)
         self.session.commit()
+        if self.cache:
+            self.cache.add_conversation(cached)
         self.log.info(f"Added Conversation with title '{title}' for User {user.username}")
         return conversation
 
-    def add_message(self, conversation, role, message):
+    def get_conversation_token_count(self, conversation, target_id=None):
+        self.log.debug(f'Retrieving token count for Conversation with id {conversation.id}')
+        if self.cache:
+            token_count = self._get_cached_token_count(conversation, target_id)
+            if self.cache.record(token_count is not None):
+                return token_count
+            generation = self.cache.generation
+        query = self.session.query(func.coalesce(func.sum(Message.prompt_tokens + Message.completion_tokens), 0)).filter(*self._message_range_filters(conversation, target_id))
+        token_count = query.scalar()
+        if self.cache and not target_id:
+            self.cache.put_totals(conversation.id, token_count=token_count, generation=generation)
+        return token_count
+
+    def _get_cached_token_count(self, conversation, target_id=None):
+        token_count, _uncounted = self.cache.get_totals(conversation.id)
+        window = self.cache.get_window(conversation.id)
+        # A target at or after the newest message counts every message.
+        if token_count is not None and (not target_id or (window and window[0] and target_id >= window[0][-1].id)):
+            return token_count
+        if window is not None and window[1]:
+            return sum(m.prompt_tokens + m.completion_tokens for m in self._filter_window(window[0], target_id))
+        return None
+
+    def get_messages_without_token_counts(self, conversation):
+        self.log.debug(f'Retrieving Messages without token counts for Conversation with id {conversation.id}')
+        if self.cache:
+            _token_count, uncounted = self.cache.get_totals(conversation.id)
+            window = self._get_complete_window(conversation) if uncounted != 0 else []
+            if self.cache.record(window is not None):
+                return [m for m in window if not m.prompt_tokens and not m.completion_tokens]
+            generation = self.cache.generation
+        query = self.session.query(Message).filter(Message.conversation_id == conversation.id, Message.prompt_tokens == 0, Message.completion_tokens == 0).order_by(Message.id)
+        messages = query.all()
+        if self.cache:
+            self.cache.put_totals(conversation.id, uncounted=len(messages), generation=generation)
+        return messages
+
+    def get_all_messages_without_token_counts(self, after_id=0, limit=None):
+        self.log.debug(f'Retrieving Messages without token counts after id {after_id}')
+        query = self.session.query(Message.id, Message.role, Message.message, Conversation.model).join(Conversation, Message.conversation_id == Conversation.id).filter(Message.id > after_id, Message.prompt_tokens == 0, Message.completion_tokens == 0).order_by(Message.id)
+        query = self._apply_limit_offset(query, limit, None)
+        rows = query.all()
+        return rows
+
+    def _insert_messages(self, rows):
+        """Insert message rows in the session's transaction, returns them as detached Messages."""
+        messages = [Message(**row) for row in rows]
+        self.session.add_all(messages)
+        self.session.flush()
+        for message in messages:
+            self.session.expunge(message)
+        return messages
+
+    def add_message(self, conversation, role, message, prompt_tokens=0, completion_tokens=0):
         now = datetime.datetime.now()
-        message = Message(conversation_id=conversation.id, role=role, message=message, created_time=now, prompt_tokens=0, completion_tokens=0)
-        self.session.add(message)
+        message = self._insert_messages([dict(conversation_id=conversation.id, role=role, message=message, created_time=now, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)])[0]
         self.session.commit()
+        if self.cache:
+            self.cache.append_messages(conversation.id, [detached_copy(message)])
         self.log.info(f"Added Message with role '{role}' for Conversation with id {conversation.id}")
         return message
 
+    def add_messages(self, conversation, messages):
+        """
+        Add several messages to a conversation in a single transaction, and
+        bump the conversation's updated time.
+
+        The new messages are detached from the session before the commit, so
+        their columns can be read afterwards without refreshing them.
+        """
+        now = datetime.datetime.now()
+        new_messages = self._insert_messages([dict(conversation_id=conversation.id, created_time=now, **m) for m in messages])
+        # An UPDATE, as the conversation may be a cached copy.
+        self.session.query(Conversation).filter(Conversation.id == conversation.id).update({Conversation.updated_time: now}, synchronize_session=False)
+        self.session.commit()
+        if self.cache:
+            self.cache.append_messages(conversation.id, [detached_copy(m) for m in new_messages], now)
+        self.log.info(f"Added {len(new_messages)} Messages for Conversation with id {conversation.id}")
+        return new_messages
+
     def get_user(self, user_id):
         self.log.debug(f'Retrieving User with id {user_id}')
         user = self.session.get(User, user_id)
@@ -167,9 +583,21 @@ class Orm:
 
     def get_conversation(self, conversation_id):
         self.log.debug(f'Retrieving Conversation with id {conversation_id}')
+        if self.cache:
+            conversation = self.cache.get_conversation(conversation_id)
+            if conversation is not None:
+                return conversation
+            generation = self.cache.generation
         conversation = self.session.get(Conversation, conversation_id)
+        if conversation is not None and self.cache:
+            self.cache.put_conversation(detached_copy(conversation), generation)
         return conversation
 
+    def get_conversation_summary(self, conversation):
+        self.log.debug(f'Retrieving ConversationSummary for Conversation with id {conversation.id}')
+        conversation_summary = self.session.get(ConversationSummary, conversation.id)
+        return conversation_summary
+
     def get_message(self, message_id):
         self.log.debug(f'Retrieving Message with id {message_id}')
         message = self.session.get(Message, message_id)
@@ -183,40 +611,269 @@ class Orm:
         return user
 
     def edit_conversation(self, conversation, **kwargs):
+        conversation = self._persistent(conversation)
+        conversation_id = conversation.id
         for key, value in kwargs.items():
             setattr(conversation, key, value)
         self.session.commit()
-        self.log.info(f'Edited Conversation with id {conversation.id}')
+        if self.cache:
+            self.cache.update_conversation(conversation_id, **kwargs)
+        self.log.info(f'Edited Conversation with id {conversation_id}')
         return conversation
 
-    def edit_message(self, message, **kwargs):
+    def edit_message(self, db_message, **kwargs):
+        # Named so a 'message' keyword edits the message content.
+        message_id, conversation_id = db_message.id, db_message.conversation_id
+        if 'message' in kwargs or 'role' in kwargs:
+            # The stored counts no longer match, they are recounted on next use.
+            kwargs.setdefault('prompt_tokens', 0)
+            kwargs.setdefault('completion_tokens', 0)
+            kwargs.setdefault('updated_time', datetime.datetime.now())
         for key, value in kwargs.items():
-            setattr(message, key, value)
+            setattr(db_message, key, value)
         self.session.commit()
-        self.log.info(f'Edited Message with id {message.id}')
-        return message
+        if self.cache:
+            self.cache.invalidate_messages(conversation_id)
+        self.log.info(f'Edited Message with id {message_id}')
+        return db_message
+
+    def save_conversation_summary(self, conversation, message_id, summary, token_count):
+        now = datetime.datetime.now()
+        conversation_summary = self.session.get(ConversationSummary, conversation.id)
+        if not conversation_summary:
+            conversation_summary = ConversationSummary(conversation_id=conversation.id)
+            self.session.add(conversation_summary)
+        conversation_summary.message_id = message_id
+        conversation_summary.summary = summary
+        conversation_summary.token_count = token_count
+        conversation_summary.updated_time = now
+        self.session.commit()
+        self.log.info(f'Saved ConversationSummary for Conversation with id {conversation.id} through Message with id {message_id}')
+        return conversation_summary
+
+    def edit_message_token_counts(self, token_counts):
+        self.session.bulk_update_mappings(Message, token_counts)
+        self.session.commit()
+        if self.cache:
+            self.cache.update_token_counts(token_counts)
+        self.log.info(f'Edited token counts for {len(token_counts)} Messages')
 
     def delete_user(self, user):
         self.session.delete(user)
         self.session.commit()
+        if self.cache:
+            # Its conversations are deleted too.
+            self.cache.clear()
         self.log.info(f'Deleted User with id {user.id}')
         return user
 
     def delete_conversation(self, conversation):
+        conversation = self._persistent(conversation)
         self.session.delete(conversation)
         self.session.commit()
+        if self.cache:
+            self.cache.invalidate(conversation.id)
         self.log.info(f'Deleted Conversation with id {conversation.id}')
 
     def delete_message(self, message):
+        conversation_id = message.conversation_id
         self.session.delete(message)
         self.session.commit()
+        if self.cache:
+            self.cache.invalidate_messages(conversation_id)
         self.log.info(f'Deleted Message with id {message.id}')
 
+    def _bulk_insert_rows(self, conn, table, rows):
+        conn.execute(insert(table), rows)
+
+    def bulk_insert(self, inserts):
+        """
+        Insert many rows with as few statements as the database allows, in a
+        single transaction, bypassing the session and the cache.
+
+        Args:
+            inserts (list): (table, rows) pairs, inserted in order. Rows are
+                dicts with the same keys, and may set ids explicitly.
+        """
+        with self.engine.begin() as conn:
+            for table, rows in inserts:
+                if rows:
+                    self._bulk_insert_rows(conn, table, rows)
+
+    def _insert_rows_with_new_ids(self, conn, table, rows):
+        """Insert rows with ids assigned by the database, returns the ids in order."""
+        return [conn.execute(insert(table).values(row)).inserted_primary_key[0] for row in rows]
+
+    def import_conversations(self, batches):
+        """
+        Insert new conversations and their messages in a single transaction,
+        bypassing the session and the cache.
+
+        Conversation ids are assigned by the database inside the transaction,
+        so concurrent writers never take the same ids, and a failure part
+        way leaves nothing behind.
+
+        Args:
+            batches (iterable): (conversations, messages) pairs. conversations
+                is a dict of key -> conversation row without an id. Message
+                rows have a conversation_key, the key of a conversation in
+                this or an earlier batch, instead of a conversation_id.
+
+        Returns:
+            tuple: (conversations inserted, messages inserted)
+        """
+        conversation_ids = {}
+        total_conversations = 0
+        total_messages = 0
+        with self.engine.begin() as conn:
+            for conversations, messages in batches:
+                if conversations:
+                    ids = self._insert_rows_with_new_ids(conn, Conversation.__table__, list(conversations.values()))
+                    conversation_ids.update(zip(conversations.keys(), ids))
+                if messages:
+                    rows = []
+                    for message in messages:
+                        row = {k: v for k, v in message.items() if k != 'conversation_key'}
+                        row['conversation_id'] = conversation_ids[message['conversation_key']]
+                        rows.append(row)
+                    self._bulk_insert_rows(conn, Message.__table__, rows)
+                total_conversations += len(conversations)
+                total_messages += len(messages)
+        self.log.info(f'Imported {total_conversations} Conversations with {total_messages} Messages')
+        return total_conversations, total_messages
+
+class SqliteOrm(Orm):
+
+    @classmethod
+    def get_engine_args(cls, database, options):
+        engine_args, connect_args = super().get_engine_args(database, options)
+        # Pooled SQLite connections may be handed to a different thread than
+        # the one that opened them. That is safe, as each connection is only
+        # ever used by one thread's session at a time.
+        connect_args['check_same_thread'] = False
+        # Each connection to an in-memory database is a separate database,
+        # so leave pooling to the SQLAlchemy default.
+        if is_sqlite_memory_database(database):
+            engine_args = {}
+        return engine_args, connect_args
+
+    @classmethod
+    def make_engine(cls, database, options):
+        engine = super().make_engine(database, options)
+        event.listen(engine, "connect", make_sqlite_pragma_listener(options.get('sqlite_pragmas') or {}))
+        return engine
+
+    def search_messages(self, user, query, limit=constants.DEFAULT_SEARCH_LIMIT, offset=None, highlight=('**', '**')):
+        self.log.debug(f"Searching Messages for User with id {user.id}: {query}")
+        match = build_search_query(query)
+        fts = literal_column(SEARCH_INDEX_TABLE)
+        rank = func.bm25(fts).label('rank')
+        snippet = func.snippet(fts, 0, highlight[0], highlight[1], '...', constants.SEARCH_SNIPPET_TOKENS).label('snippet')
+        query = self._search_messages_query(snippet, rank).join(search_index, Message.id == search_index.c.rowid)
+        query = query.filter(fts.op('MATCH')(match), Conversation.user_id == user.id).order_by(rank)
+        query = self._apply_limit_offset(query, limit, offset)
+        rows = query.all()
+        return rows
+
+class PostgresOrm(Orm):
+    """
+    PostgreSQL storage.
+
+    Uses a pre-pinged connection pool, multi-row INSERT ... RETURNING for new
+    messages, COPY for bulk inserts, and native full text search over a GIN
+    expression index.
+    """
+
+    @classmethod
+    def get_engine_args(cls, database, options):
+        engine_args, connect_args = super().get_engine_args(database, options)
+        # Server connections can be closed under the pool by restarts or
+        # idle timeouts, check them on checkout instead of failing a request.
+        engine_args['pool_pre_ping'] = True
+        return engine_args, connect_args
+
+    def search_messages(self, user, query, limit=constants.DEFAULT_SEARCH_LIMIT, offset=None, highlight=('**', '**')):
+        self.log.debug(f"Searching Messages for User with id {user.id}: {query}")
+        # Terms are ANDed like the quoted FTS5 terms, operators in the input are ignored.
+        tsquery = func.plainto_tsquery(POSTGRES_SEARCH_CONFIG, query)
+        document = postgres_search_document(Message.message)
+        # Negated, so lower is better like bm25() on SQLite.
+        rank = (-func.ts_rank(document, tsquery)).label('rank')
+        snippet = func.ts_headline(POSTGRES_SEARCH_CONFIG, Message.message, tsquery, build_postgres_headline_options(highlight)).label('snippet')
+        query = self._search_messages_query(snippet, rank).filter(document.op('@@')(tsquery), Conversation.user_id == user.id).order_by(rank)
+        query = self._apply_limit_offset(query, limit, offset)
+        rows = query.all()
+        return rows
+
+    def _insert_messages(self, rows):
+        # One statement for all the rows, RETURNING them instead of a round
+        # trip per row for the generated ids.
+        table = Message.__table__
+        result = self.session.execute(insert(table).values(rows).returning(*table.c))
+        return [Message(**row._mapping) for row in result]
+
+    def _copy_value(self, value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    def _bulk_insert_rows(self, conn, table, rows):
+        if conn.dialect.driver == 'psycopg2':
+            self._copy_rows(conn, table, rows)
+        else:
+            super()._bulk_insert_rows(conn, table, rows)
+        if 'id' in rows[0]:
+            # Explicit ids do not advance the sequence. Taking the greater of
+            # the max id and nextval() never moves it back past ids other
+            # transactions already took.
+            table_name = conn.dialect.identifier_preparer.format_table(table)
+            conn.execute(text(f"SELECT setval(CAST(seq AS regclass), greatest((SELECT max(id) FROM {table_name}), nextval(CAST(seq AS regclass)))) FROM (SELECT pg_get_serial_sequence(:table_name, 'id') AS seq) AS serial"), {'table_name': table_name})
+
+    def _insert_rows_with_new_ids(self, conn, table, rows):
+        # Reserve the ids from the sequence in one query, then insert the
+        # rows with them in bulk.
+        table_name = conn.dialect.identifier_preparer.format_table(table)
+        result = conn.execute(text("SELECT nextval(CAST(pg_get_serial_sequence(:table_name, 'id') AS regclass)) FROM generate_series(1, :count)"), {'table_name': table_name, 'count': len(rows)})
+        ids = [row[0] for row in result]
+        self._bulk_insert_rows(conn, table, [dict(row, id=id) for row, id in zip(rows, ids)])
+        return ids
+
+    def _copy_rows(self, conn, table, rows):
+        keys = list(rows[0].keys())
+        buffer = io.StringIO()
+        # Strings are quoted, so only None is written as an unquoted empty
+        # field, which COPY reads as NULL.
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+        for row in rows:
+            writer.writerow([self._copy_value(row[key]) for key in keys])
+        buffer.seek(0)
+        preparer = conn.dialect.identifier_preparer
+        columns = ', '.join(preparer.quote(key) for key in keys)
+        table_name = preparer.format_table(table)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+
+STORAGE_CLASSES = {
+    'sqlite': SqliteOrm,
+    'postgresql': PostgresOrm,
+}
+
+def get_storage_class(database):
+    """The storage class for a database URL, Orm for databases without a specialized one."""
+    return STORAGE_CLASSES.get(make_url(database).get_backend_name(), Orm)
+
+def create_storage(config=None):
+    config = config or Config()
+    return get_storage_class(config.get('database'))(config)
+
 class Manager:
-    def __init__(self, config=None):
+    def __init__(self, config=None, orm=None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
-        self.orm = Orm(self.config)
+        self.orm = orm or create_storage(self.config)
 
     def _handle_error(self, message):
         self.log.error(message)
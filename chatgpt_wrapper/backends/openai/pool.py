@@ -0,0 +1,178 @@
+import queue
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+from chatgpt_wrapper.backends.openai.orm import create_storage
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.core.logger import Logger
+import chatgpt_wrapper.core.constants as constants
+import chatgpt_wrapper.core.util as util
+
+class BackendPoolTimeoutError(Exception):
+    pass
+
+class BackendPool:
+    """
+    Fixed size pool of backends, for servers handling concurrent requests.
+
+    A backend holds the state of one conversation (current user,
+    conversation and parent message), so a request checks one out, sets the
+    state it needs, and has the backend to itself until it is released.
+    Backends share the database engine, conversation cache and token
+    encodings, so each one costs little. They are created as needed, up to
+    size.
+    """
+
+    def __init__(self, config=None, size=None, timeout=None, backend_class=OpenAIAPI):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.size = size or self.config.get('api_server.pool_size') or constants.DEFAULT_API_SERVER_POOL_SIZE
+        self.timeout = timeout or self.config.get('api_server.pool_timeout') or constants.DEFAULT_API_SERVER_POOL_TIMEOUT
+        self.backend_class = backend_class
+        self.backends = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        # Shares the backends' engine and thread-local sessions.
+        self.orm = create_storage(self.config)
+
+    def acquire(self):
+        try:
+            return self.backends.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.backend_class(self.config)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.backends.get(timeout=self.timeout)
+        except queue.Empty:
+            raise BackendPoolTimeoutError(f"No backend free after {self.timeout} seconds, all {self.size} are busy")
+
+    def release(self, backend):
+        self.reset(backend)
+        self.backends.put(backend)
+
+    def reset(self, backend):
+        backend.current_user = None
+        backend.new_conversation()
+        backend.set_active_model(self.config.get('chat.model'))
+
+    def prepare(self, backend, user_id=None, conversation_id=None, parent_message_id=None):
+        """
+        Set a backend up for a request.
+
+        Without a conversation, the next prompt starts a new one. Without a
+        parent message, it continues from the conversation's last message.
+
+        Returns:
+            tuple: (success, backend, message)
+        """
+        if user_id is not None:
+            success, user, message = backend.user_manager.get_by_user_id(user_id)
+            if not success:
+                return success, user, message
+            if not user:
+                return False, None, message
+            backend.set_current_user(user)
+        if conversation_id is not None:
+            success, conversation, message = backend.conversation.get_conversation(conversation_id)
+            if not success:
+                return success, conversation, message
+            if backend.current_user is None or conversation.user_id != backend.current_user.id:
+                return False, None, "Conversation not found."
+            if parent_message_id is None:
+                success, messages, message = backend.message.get_last_messages(conversation_id, limit=1)
+                if not success:
+                    return success, messages, message
+                parent_message_id = messages[-1].id if messages else None
+            backend.switch_to_conversation(conversation_id, parent_message_id)
+        return True, backend, "Backend ready."
+
+    @contextmanager
+    def backend(self):
+        backend = self.acquire()
+        try:
+            yield backend
+        finally:
+            self.release(backend)
+
+    def close_session(self):
+        """Close the current thread's database session, call at the end of each request."""
+        self.orm.close_session()
+
+class AsyncBackendPool(BackendPool):
+    """
+    BackendPool for asyncio servers, waiting for a free backend, and
+    creating and preparing backends, never blocks the event loop.
+
+    Check backends out per generation, not per connection, so idle
+    connections hold none.
+    """
+
+    def __init__(self, config=None, size=None, timeout=None, backend_class=OpenAIAPI):
+        super().__init__(config, size, timeout, backend_class)
+        self._available = None
+
+    @property
+    def available(self):
+        # Created on first use, inside the server's event loop, before
+        # Python 3.10 it binds to the loop current at creation.
+        if self._available is None:
+            self._available = asyncio.Semaphore(self.size)
+        return self._available
+
+    async def acquire_async(self):
+        try:
+            await asyncio.wait_for(self.available.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise BackendPoolTimeoutError(f"No backend free after {self.timeout} seconds, all {self.size} are busy")
+        try:
+            return self.backends.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            with self.lock:
+                self.created += 1
+            return await util.run_in_thread(self.backend_class, self.config)
+        except BaseException:
+            with self.lock:
+                self.created -= 1
+            self.available.release()
+            raise
+
+    def release_async(self, backend):
+        self.reset(backend)
+        self.backends.put(backend)
+        self.available.release()
+
+    async def run_in_thread(self, func, *args, **kwargs):
+        """Run blocking backend calls in a worker thread, closing the thread's session after."""
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.close_session()
+        return await util.run_in_thread(run)
+
+    async def prepare_async(self, backend, user_id=None, conversation_id=None, parent_message_id=None):
+        return await self.run_in_thread(self.prepare, backend, user_id=user_id, conversation_id=conversation_id, parent_message_id=parent_message_id)
+
+    @asynccontextmanager
+    async def backend_async(self):
+        backend = await self.acquire_async()
+        try:
+            yield backend
+        finally:
+            self.release_async(backend)
@@ -6,8 +6,8 @@ import chatgpt_wrapper.core.util as util
 from chatgpt_wrapper.core.repl import Repl
 from chatgpt_wrapper.backends.openai.database import Database
 from chatgpt_wrapper.backends.openai.orm import User
-from chatgpt_wrapper.backends.openai.user import UserManager
 from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+from chatgpt_wrapper.backends.openai.context import CONTEXT_STRATEGIES
 
 ALLOWED_BASE_SHELL_NOT_LOGGED_IN_COMMANDS = [
     'config',
@@ -23,6 +23,8 @@ class ApiRepl(Repl):
     def __init__(self, config=None):
         super().__init__(config)
         self.logged_in_user = None
+        self.history_limit = constants.DEFAULT_HISTORY_LIMIT
+        self.history_next_cursor = None
 
     def not_logged_in_disallowed_commands(self):
         base_shell_commands = util.introspect_commands(Repl)
@@ -58,19 +60,101 @@ class ApiRepl(Repl):
             util.command_with_leader('model-presence-penalty'): util.float_range_to_completions(constants.OPENAPI_PRESENCE_PENALTY_MIN, constants.OPENAPI_PRESENCE_PENALTY_MAX),
             util.command_with_leader('model-frequency-penalty'): util.float_range_to_completions(constants.OPENAPI_FREQUENCY_PENALTY_MIN, constants.OPENAPI_FREQUENCY_PENALTY_MAX),
             util.command_with_leader('model-system-message'): util.list_to_completion_hash(self.backend.get_system_message_aliases()),
+            util.command_with_leader('model-context-strategy'): util.list_to_completion_hash(CONTEXT_STRATEGIES.keys()),
         }
 
     def configure_backend(self):
         self.backend = OpenAIAPI(self.config)
         database = Database(self.config)
         database.create_schema()
-        self.user_management = UserManager(self.config)
+        self.user_management = self.backend.user_manager
         self.session = self.user_management.orm.session
 
     def launch_backend(self, interactive=True):
         if interactive:
             self.check_login()
 
+    def _fetch_history(self, limit=constants.DEFAULT_HISTORY_LIMIT, offset=0, cursor=None):
+        util.print_markdown("* Fetching conversation history...")
+        success, history, message = self.backend.get_history(limit=limit, offset=offset, cursor=cursor)
+        return success, history, message
+
+    def do_history(self, arg):
+        """
+        Show recent conversation history
+
+        Arguments;
+            limit: limit the number of messages to show (default {DEFAULT_HISTORY_LIMIT})
+            offset: offset the list of messages by this number
+            next: show the page after the last history shown
+
+        Examples:
+            {COMMAND}
+            {COMMAND} 10
+            {COMMAND} 10 5
+            {COMMAND} next
+        """
+        # Other commands fetch history too, only pages shown here move the cursor.
+        if arg.strip() == 'next':
+            if not self.history_next_cursor:
+                return False, None, "No more history"
+            limit, offset, cursor = self.history_limit, 0, self.history_next_cursor
+        else:
+            args = self._parse_history_args(arg)
+            if not args:
+                return
+            (limit, offset), cursor = args, None
+        success, history, message = self._fetch_history(limit=limit, offset=offset, cursor=cursor)
+        if success:
+            self.history_limit = limit
+            self.history_next_cursor = self.backend.get_history_next_cursor(history, limit)
+            self._print_history(history)
+        else:
+            return success, history, message
+
+    def do_search(self, arg):
+        """
+        Search the messages of all your conversations
+
+        Matches all words, ranked by relevance, with matches highlighted.
+
+        Arguments:
+            query: The words to search for
+
+        Examples:
+            {COMMAND} sqlite performance
+        """
+        if not arg:
+            return False, None, "Search query required"
+        success, results, message = self.backend.message.search_messages(self.logged_in_user.id, arg)
+        if not success:
+            return success, results, message
+        if not results:
+            return False, None, f"No messages found for: {arg}"
+        util.print_markdown("## Search results:\n\n%s" % "\n".join(["1. %s: %s (%s), %s: %s" % (r.created_time.strftime("%Y-%m-%d %H:%M"), r.title or constants.NO_TITLE_TEXT, r.conversation_id, r.role, r.snippet.replace("\n", " ")) for r in results]))
+
+    def do_semantic_search(self, arg):
+        """
+        Find the conversations most related to a description
+
+        Unlike {COMMAND_LEADER}search, matches on related wording rather than
+        requiring every word.
+
+        Arguments:
+            query: A description of what was discussed
+
+        Examples:
+            {COMMAND} speeding up database writes
+        """
+        if not arg:
+            return False, None, "Search query required"
+        success, results, message = self.backend.semantic_search(arg, user_id=self.logged_in_user.id)
+        if not success:
+            return success, results, message
+        if not results:
+            return False, None, f"No conversations found for: {arg}"
+        util.print_markdown("## Related conversations:\n\n%s" % "\n".join(["1. %s: %s (%s), %s: %s" % (r['created_time'].strftime("%Y-%m-%d %H:%M"), r['title'] or constants.NO_TITLE_TEXT, r['conversation_id'], r['role'], util.truncate_text(r['message'].replace("\n", " "), constants.SEMANTIC_SEARCH_EXCERPT_LENGTH)) for r in results]))
+
     def get_user(self, user_id):
         user = self.session.get(User, user_id)
         return user
@@ -117,9 +201,9 @@ class ApiRepl(Repl):
             return
         util.print_markdown("* Loaded specified context.")
         self.backend.conversation_id = (
-            conversation_id if conversation_id != "None" else None
+            int(conversation_id) if conversation_id != "None" else None
         )
-        self.backend.parent_message_id = parent_message_id
+        self.backend.parent_message_id = int(parent_message_id)
         self._update_message_map()
         self._write_log_context()
 
@@ -532,6 +616,34 @@ Before you can start using the shell, you must create a new user.
         """
         return self.adjust_model_setting("int", "max_submission_tokens", max_submission_tokens, constants.OPENAPI_MIN_SUBMISSION_TOKENS, constants.OPENAPI_MAX_TOKENS)
 
+    def do_model_context_strategy(self, context_strategy=None):
+        """
+        Set the strategy used to fit conversations under max submission tokens.
+
+        Strategies:
+            drop_oldest: Drop the oldest messages, always keeping the system message.
+            keep_last: Keep the system message plus the last N messages.
+            rolling_summary: Compact older messages into a stored summary of the conversation.
+
+        Arguments:
+            context_strategy: One of the strategies above, default: {DEFAULT_CONTEXT_STRATEGY}
+                              With no arguments, show the currently set strategy.
+
+        Examples:
+            {COMMAND}
+            {COMMAND} rolling_summary
+        """
+        if not self._is_logged_in():
+            return False, None, "Not logged in."
+        if context_strategy:
+            try:
+                self.backend.set_model_context_strategy(context_strategy)
+            except ValueError as e:
+                return False, context_strategy, str(e)
+            return True, context_strategy, f"context_strategy set to {context_strategy}"
+        else:
+            util.print_markdown(f"* Current context_strategy: {self.backend.model_context_strategy}")
+
     def do_model_system_message(self, system_message=None):
         """
         Set the system message sent for conversations.
@@ -0,0 +1,413 @@
+import os
+import re
+import json
+import math
+import hashlib
+import datetime
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+
+import numpy as np
+
+from chatgpt_wrapper.core.logger import Logger
+import chatgpt_wrapper.core.constants as constants
+
+# Per row: message id, conversation id, user id, and the version of the
+# message that was embedded, see message_version().
+ROW_IDS_DTYPE = np.dtype([('message_id', '<i8'), ('conversation_id', '<i8'), ('user_id', '<i8'), ('version', '<i8')])
+# Bumped when the file layout changes, older indexes are rebuilt.
+INDEX_FORMAT = 2
+METADATA_FILE = 'metadata.json'
+VECTORS_FILE = 'vectors.f32'
+ROW_IDS_FILE = 'rows.bin'
+DELETED_FILE = 'deleted.u8'
+CENTROIDS_FILE = 'centroids.f32'
+ASSIGNMENTS_FILE = 'assignments.i32'
+# Rows scored per matrix product, bounds memory when brute forcing large indexes.
+SEARCH_CHUNK_ROWS = 65536
+INDEX_BATCH_SIZE = 1000
+IVF_TRAINING_ITERATIONS = 10
+# Don't partition until there is enough data for the lists to be meaningful.
+IVF_MIN_ROWS_PER_LIST = 10
+# Ids are assigned before commit, so a message can commit after a higher id
+# was indexed. Messages created or edited this long before the last sync
+# are checked again.
+SYNC_LAG = datetime.timedelta(minutes=5)
+# Rebuild the index once more than this share of its rows are tombstones.
+MAX_DELETED_RATIO = 0.5
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def message_version(message):
+    """The message's edit time, or else its creation time, in microseconds."""
+    return (((message.updated_time or message.created_time) - EPOCH) // datetime.timedelta(microseconds=1))
+
+class Embedder(ABC):
+    """
+    Turns texts into fixed size float32 vectors.
+
+    Vectors should be L2 normalized, so a dot product is cosine similarity.
+    """
+
+    def __init__(self, dimensions=constants.DEFAULT_SEMANTIC_SEARCH_DIMENSIONS):
+        self.dimensions = dimensions
+
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    @abstractmethod
+    def embed(self, texts):
+        """
+        Args:
+            texts (list): Strings to embed.
+
+        Returns:
+            numpy.ndarray: float32 array of shape (len(texts), dimensions).
+        """
+        pass
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic offline embedder, hashes words and word bigrams into a
+    fixed number of signed buckets with sublinear term frequency.
+    """
+
+    word_pattern = re.compile(r'\w+')
+
+    def features(self, text):
+        words = self.word_pattern.findall(text.lower())
+        return words + ["%s %s" % pair for pair in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self.features(text)).items():
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                sign = 1.0 if digest & 1 else -1.0
+                vectors[row, (digest >> 1) % self.dimensions] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+EMBEDDERS = {
+    'hashing': HashingEmbedder,
+}
+
+def get_embedder(name, **kwargs):
+    """
+    Get an embedder by registered name, or by 'module.ClassName' import path
+    for embedders outside this package.
+    """
+    if name in EMBEDDERS:
+        return EMBEDDERS[name](**kwargs)
+    module_name, _, class_name = name.rpartition('.')
+    if not module_name:
+        raise ValueError(f"Invalid embedder '{name}', must be one of: {', '.join(EMBEDDERS.keys())}, or a module.ClassName path")
+    klass = getattr(importlib.import_module(module_name), class_name)
+    return klass(**kwargs)
+
+class SemanticIndex:
+    """
+    Vector index of messages, stored as flat files.
+
+    Vectors live in a float32 file that is memory mapped for search, next to
+    a file of (message id, conversation id, user id, version) rows. Files are
+    only appended to, rows for deleted or edited messages are marked in a
+    tombstone file and skipped by search. Indexing is incremental, each
+    sync() embeds only messages stored or edited since the last one.
+
+    With ivf_lists set, vectors are partitioned around k-means centroids and
+    a search only scores the nprobe partitions closest to the query.
+    """
+
+    def __init__(self, directory, embedder, database, ivf_lists=0, nprobe=constants.DEFAULT_SEMANTIC_SEARCH_IVF_NPROBE, config=None):
+        self.directory = directory
+        self.embedder = embedder
+        self.database = database
+        self.ivf_lists = ivf_lists or 0
+        self.nprobe = nprobe
+        self.log = Logger(self.__class__.__name__, config)
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.metadata = self.load_metadata()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _new_metadata(self):
+        return {
+            'format': INDEX_FORMAT,
+            'embedder': self.embedder.name,
+            'dimensions': self.embedder.dimensions,
+            'database': self.database,
+            'count': 0,
+            'live_count': 0,
+            'high_water_id': 0,
+            'synced_time': None,
+            'ivf_count': 0,
+        }
+
+    def load_metadata(self):
+        metadata = None
+        if os.path.exists(self._path(METADATA_FILE)):
+            with open(self._path(METADATA_FILE)) as f:
+                metadata = json.load(f)
+        expected = self._new_metadata()
+        if not metadata or any(metadata.get(key) != expected[key] for key in ['format', 'embedder', 'dimensions', 'database']):
+            self.log.info(f"Creating new semantic index in {self.directory}")
+            metadata = expected
+            self.reset(metadata)
+        return metadata
+
+    def save_metadata(self):
+        tmp_path = self._path(METADATA_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(tmp_path, self._path(METADATA_FILE))
+
+    def reset(self, metadata=None):
+        for filename in [VECTORS_FILE, ROW_IDS_FILE, DELETED_FILE, CENTROIDS_FILE, ASSIGNMENTS_FILE]:
+            if os.path.exists(self._path(filename)):
+                os.remove(self._path(filename))
+        self.metadata = metadata or self._new_metadata()
+        self.save_metadata()
+
+    def _append(self, filename, array, count):
+        # Drop any partial rows left by an interrupted append, the metadata
+        # count is the source of truth.
+        row_nbytes = array.nbytes // len(array)
+        with open(self._path(filename), 'ab') as f:
+            f.truncate(count * row_nbytes)
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    def vectors(self):
+        count = self.metadata['count']
+        if not count:
+            return np.zeros((0, self.embedder.dimensions), dtype=np.float32)
+        return np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode='r', shape=(count, self.embedder.dimensions))
+
+    def rows(self):
+        count = self.metadata['count']
+        if not count:
+            return np.zeros(0, dtype=ROW_IDS_DTYPE)
+        return np.memmap(self._path(ROW_IDS_FILE), dtype=ROW_IDS_DTYPE, mode='r', shape=(count,))
+
+    def deleted(self):
+        count = self.metadata['count']
+        if not count:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(self._path(DELETED_FILE), dtype=np.uint8, mode='r', shape=(count,))
+
+    def centroids(self):
+        if not os.path.exists(self._path(CENTROIDS_FILE)):
+            return None
+        return np.fromfile(self._path(CENTROIDS_FILE), dtype=np.float32).reshape(-1, self.embedder.dimensions)
+
+    def assignments(self):
+        count = self.metadata['ivf_count']
+        if not count:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(self._path(ASSIGNMENTS_FILE), dtype=np.int32, mode='r', shape=(count,))
+
+    def add(self, rows, texts):
+        """
+        Embed and append messages.
+
+        Args:
+            rows (list): (message id, conversation id, user id, version) tuples.
+            texts (list): Message content, same order as rows.
+        """
+        if not rows:
+            return 0
+        vectors = self.embedder.embed(texts).astype(np.float32, copy=False)
+        row_ids = np.array(rows, dtype=ROW_IDS_DTYPE)
+        count = self.metadata['count']
+        self._append(VECTORS_FILE, vectors, count)
+        self._append(ROW_IDS_FILE, row_ids, count)
+        self._append(DELETED_FILE, np.zeros(len(rows), dtype=np.uint8), count)
+        centroids = self.centroids()
+        if centroids is not None and self.metadata['ivf_count'] == count:
+            self._append(ASSIGNMENTS_FILE, self.assign(vectors, centroids), count)
+            self.metadata['ivf_count'] = count + len(rows)
+        self.metadata['count'] = count + len(rows)
+        self.metadata['live_count'] += len(rows)
+        self.metadata['high_water_id'] = max(self.metadata['high_water_id'], int(row_ids['message_id'].max()))
+        self.save_metadata()
+        return len(rows)
+
+    def _add_messages(self, messages):
+        return self.add([(m.id, m.conversation_id, m.user_id, message_version(m)) for m in messages], [m.message for m in messages])
+
+    def _live_positions(self, message_ids):
+        rows = self.rows()
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.isin(rows['message_id'], np.asarray(message_ids, dtype=np.int64)) & (self.deleted() == 0))
+
+    def _tombstone(self, positions):
+        if not len(positions):
+            return 0
+        deleted = np.memmap(self._path(DELETED_FILE), dtype=np.uint8, mode='r+', shape=(self.metadata['count'],))
+        positions = np.unique(positions)
+        positions = positions[deleted[positions] == 0]
+        deleted[positions] = 1
+        deleted.flush()
+        del deleted
+        self.metadata['live_count'] -= len(positions)
+        self.save_metadata()
+        return len(positions)
+
+    def remove(self, message_ids):
+        """Mark messages as deleted, so search no longer returns them."""
+        with self.lock:
+            return self._tombstone(self._live_positions(message_ids))
+
+    def _call_message_manager(self, message_manager, method, *args):
+        success, result, user_message = getattr(message_manager, method)(*args)
+        if not success:
+            raise Exception(user_message)
+        return result
+
+    def _index_new(self, message_manager, batch_size):
+        total = 0
+        while True:
+            messages = self._call_message_manager(message_manager, 'get_messages_for_indexing', self.metadata['high_water_id'], batch_size)
+            if not messages:
+                return total
+            total += self._add_messages(messages)
+
+    def _index_changed(self, messages, batch_size):
+        """Re-embed messages whose indexed version is missing or out of date."""
+        if not messages:
+            return 0
+        rows = self.rows()
+        positions = self._live_positions([m.id for m in messages])
+        indexed = dict(zip(rows['message_id'][positions].tolist(), rows['version'][positions].tolist()))
+        changed = [m for m in messages if indexed.get(m.id) != message_version(m)]
+        if not changed:
+            return 0
+        self._tombstone(positions[np.isin(rows['message_id'][positions], [m.id for m in changed])])
+        return sum(self._add_messages(changed[start:start + batch_size]) for start in range(0, len(changed), batch_size))
+
+    def _remove_deleted(self, message_manager, batch_size):
+        """Tombstone indexed messages that are no longer stored."""
+        rows = self.rows()
+        live = np.flatnonzero(self.deleted() == 0)
+        missing = []
+        for start in range(0, len(live), batch_size):
+            positions = live[start:start + batch_size]
+            message_ids = rows['message_id'][positions].tolist()
+            existing = self._call_message_manager(message_manager, 'get_existing_message_ids', message_ids)
+            missing.extend(position for position, message_id in zip(positions.tolist(), message_ids) if message_id not in existing)
+        return self._tombstone(np.array(missing, dtype=np.int64))
+
+    def sync(self, message_manager, batch_size=INDEX_BATCH_SIZE):
+        """
+        Bring the index up to date with the database, returns the number of
+        messages embedded.
+
+        New messages are found by id, edited and late committed ones by
+        their times, and deletions by comparing the number of messages
+        stored with the number indexed.
+        """
+        with self.lock:
+            started = datetime.datetime.now()
+            total = self._index_new(message_manager, batch_size)
+            if self.metadata['synced_time']:
+                since = datetime.datetime.fromisoformat(self.metadata['synced_time']) - SYNC_LAG
+                total += self._index_changed(self._call_message_manager(message_manager, 'get_messages_changed_since', since), batch_size)
+            removed = 0
+            if self._call_message_manager(message_manager, 'get_total_message_count') < self.metadata['live_count']:
+                removed = self._remove_deleted(message_manager, batch_size)
+            if self.metadata['count'] - self.metadata['live_count'] > self.metadata['count'] * MAX_DELETED_RATIO:
+                self.log.info(f"Rebuilding semantic index, {self.metadata['count'] - self.metadata['live_count']} of {self.metadata['count']} rows are deleted")
+                self.reset()
+                total = self._index_new(message_manager, batch_size)
+            self.metadata['synced_time'] = started.isoformat()
+            self.save_metadata()
+            if self.ivf_lists and self.metadata['ivf_count'] != self.metadata['count']:
+                self.build_ivf()
+            if total or removed:
+                self.log.debug(f"Indexed {total} messages, removed {removed}, {self.metadata['live_count']} total")
+            return total
+
+    def assign(self, vectors, centroids):
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def build_ivf(self):
+        """Train centroids with spherical k-means, then partition all vectors."""
+        count = self.metadata['count']
+        if count < self.ivf_lists * IVF_MIN_ROWS_PER_LIST:
+            return False
+        vectors = self.vectors()
+        rng = np.random.default_rng(0)
+        centroids = np.array(vectors[np.sort(rng.choice(count, self.ivf_lists, replace=False))])
+        for _ in range(IVF_TRAINING_ITERATIONS):
+            assignments = self.assign(vectors, centroids)
+            for i in range(self.ivf_lists):
+                members = vectors[assignments == i]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / (np.linalg.norm(centroid) or 1.0)
+        centroids.astype(np.float32).tofile(self._path(CENTROIDS_FILE))
+        self.assign(vectors, centroids).tofile(self._path(ASSIGNMENTS_FILE))
+        self.metadata['ivf_count'] = count
+        self.save_metadata()
+        self.log.info(f"Partitioned {count} vectors into {self.ivf_lists} lists")
+        return True
+
+    def _candidate_rows(self, query_vector):
+        centroids = self.centroids()
+        if not self.ivf_lists or centroids is None or self.metadata['ivf_count'] != self.metadata['count']:
+            return None
+        probe = np.argsort(-(centroids @ query_vector))[:self.nprobe]
+        return np.flatnonzero(np.isin(self.assignments(), probe))
+
+    def search(self, query, limit=constants.DEFAULT_SEARCH_LIMIT, user_id=None):
+        """
+        Find the messages closest to query.
+
+        Returns:
+            list: (message id, conversation id, score) tuples, best first.
+        """
+        if not self.metadata['live_count']:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        vectors = self.vectors()
+        rows = self.rows()
+        candidates = self._candidate_rows(query_vector)
+        if candidates is None:
+            scores = np.concatenate([vectors[start:start + SEARCH_CHUNK_ROWS] @ query_vector for start in range(0, len(vectors), SEARCH_CHUNK_ROWS)])
+            candidates = np.arange(len(scores))
+        else:
+            scores = vectors[candidates] @ query_vector
+        mask = self.deleted()[candidates] == 0
+        if user_id is not None:
+            mask &= rows['user_id'][candidates] == user_id
+        candidates = candidates[mask]
+        scores = scores[mask]
+        if not len(scores):
+            return []
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows['message_id'][candidates[i]]), int(rows['conversation_id'][candidates[i]]), float(scores[i])) for i in top]
+
+_semantic_indexes = {}
+_semantic_indexes_lock = threading.Lock()
+
+def get_semantic_index(config):
+    """
+    Get the semantic index configured for a profile.
+
+    Indexes are shared per directory, so concurrent backends never append to
+    the same files through different objects.
+    """
+    directory = config.get('semantic_search.directory') or os.path.join(config.data_profile_dir, constants.SEMANTIC_SEARCH_INDEX_DIR)
+    with _semantic_indexes_lock:
+        if directory not in _semantic_indexes:
+            embedder = get_embedder(config.get('semantic_search.embedder') or constants.DEFAULT_SEMANTIC_SEARCH_EMBEDDER, dimensions=config.get('semantic_search.dimensions') or constants.DEFAULT_SEMANTIC_SEARCH_DIMENSIONS)
+            _semantic_indexes[directory] = SemanticIndex(directory, embedder, config.get('database'), ivf_lists=config.get('semantic_search.ivf_lists'), nprobe=config.get('semantic_search.ivf_nprobe') or constants.DEFAULT_SEMANTIC_SEARCH_IVF_NPROBE, config=config)
+        return _semantic_indexes[directory]
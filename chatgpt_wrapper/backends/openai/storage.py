@@ -0,0 +1,158 @@
+from abc import ABC, abstractmethod
+
+class Storage(ABC):
+    """
+    Base class/interface for storage backends.
+
+    The user, conversation and message managers only program against these
+    methods. Orm implements them with SQLAlchemy, and is specialized for each
+    database it has optimizations for, see orm.get_storage_class().
+    """
+
+    @abstractmethod
+    def close_session(self):
+        pass
+
+    @abstractmethod
+    def object_as_dict(self, obj):
+        pass
+
+    @abstractmethod
+    def get_users(self, limit=None, offset=None):
+        pass
+
+    @abstractmethod
+    def get_user(self, user_id):
+        pass
+
+    @abstractmethod
+    def find_user(self, identifiers, match_email=True):
+        pass
+
+    @abstractmethod
+    def add_user(self, username, password, email, default_model="default", preferences={}):
+        pass
+
+    @abstractmethod
+    def edit_user(self, user, **kwargs):
+        pass
+
+    @abstractmethod
+    def delete_user(self, user):
+        pass
+
+    @abstractmethod
+    def get_conversations(self, user, limit=None, offset=None, order_desc=True, before_id=None, after_id=None):
+        pass
+
+    @abstractmethod
+    def get_conversation_rows(self, user, columns, limit=None, offset=None, order_desc=True, before_id=None, after_id=None):
+        pass
+
+    @abstractmethod
+    def get_conversation(self, conversation_id):
+        pass
+
+    @abstractmethod
+    def add_conversation(self, user, title, model="default", hidden=False):
+        pass
+
+    @abstractmethod
+    def edit_conversation(self, conversation, **kwargs):
+        pass
+
+    @abstractmethod
+    def delete_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    def get_conversation_token_count(self, conversation, target_id=None):
+        pass
+
+    @abstractmethod
+    def get_conversation_summary(self, conversation):
+        pass
+
+    @abstractmethod
+    def save_conversation_summary(self, conversation, message_id, summary, token_count):
+        pass
+
+    @abstractmethod
+    def get_messages(self, conversation, limit=None, offset=None, target_id=None, after_id=None):
+        pass
+
+    @abstractmethod
+    def get_last_messages(self, conversation, limit=None, max_tokens=None, target_id=None, after_id=None):
+        pass
+
+    @abstractmethod
+    def get_first_message(self, conversation):
+        pass
+
+    @abstractmethod
+    def get_message_count(self, conversation, target_id=None, after_id=None):
+        pass
+
+    @abstractmethod
+    def get_message(self, message_id):
+        pass
+
+    @abstractmethod
+    def get_messages_without_token_counts(self, conversation):
+        pass
+
+    @abstractmethod
+    def get_all_messages_without_token_counts(self, after_id=0, limit=None):
+        pass
+
+    @abstractmethod
+    def search_messages(self, user, query, limit=None, offset=None, highlight=('**', '**')):
+        pass
+
+    @abstractmethod
+    def get_messages_for_indexing(self, after_id=0, limit=None):
+        pass
+
+    @abstractmethod
+    def get_messages_changed_since(self, since):
+        pass
+
+    @abstractmethod
+    def get_total_message_count(self):
+        pass
+
+    @abstractmethod
+    def get_existing_message_ids(self, message_ids):
+        pass
+
+    @abstractmethod
+    def get_message_rows(self, message_ids):
+        pass
+
+    @abstractmethod
+    def add_message(self, conversation, role, message, prompt_tokens=0, completion_tokens=0):
+        pass
+
+    @abstractmethod
+    def add_messages(self, conversation, messages):
+        pass
+
+    @abstractmethod
+    def edit_message(self, db_message, **kwargs):
+        pass
+
+    @abstractmethod
+    def edit_message_token_counts(self, token_counts):
+        pass
+
+    @abstractmethod
+    def delete_message(self, message):
+        pass
+
+    @abstractmethod
+    def bulk_insert(self, inserts):
+        pass
+
+    @abstractmethod
+    def import_conversations(self, batches):
+        pass
@@ -0,0 +1,90 @@
+import os
+import threading
+from array import array
+
+import tiktoken
+
+DEFAULT_TOKEN_ENCODING = "cl100k_base"
+MESSAGE_OVERHEAD_TOKENS = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+DEFAULT_BATCH_ENCODING_THREADS = os.cpu_count() or 1
+
+class TokenEncodingRegistry:
+    """
+    Per-process cache of tiktoken encodings, keyed by model.
+
+    Loading an encoding is expensive (tiktoken reads and parses the BPE ranks),
+    so each model's encoding is loaded once and shared by every backend.
+    """
+
+    def __init__(self):
+        self.encodings = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model):
+        encoding = self.encodings.get(model)
+        if encoding is not None:
+            self.hits += 1
+            return encoding, True
+        with self.lock:
+            # Another thread may have loaded it while waiting for the lock.
+            encoding = self.encodings.get(model)
+            if encoding is None:
+                self.misses += 1
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding(DEFAULT_TOKEN_ENCODING)
+                self.encodings[model] = encoding
+                return encoding, False
+        self.hits += 1
+        return encoding, True
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'models': list(self.encodings.keys()),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.encodings = {}
+            self.hits = 0
+            self.misses = 0
+
+encoding_registry = TokenEncodingRegistry()
+
+def build_message_token_counts(role, token_count):
+    # Messages sent to the model are stored as prompt tokens, messages
+    # generated by the model as completion tokens, so the per-message
+    # count is always the sum of the two columns.
+    if role == 'assistant':
+        return {'prompt_tokens': 0, 'completion_tokens': token_count}
+    return {'prompt_tokens': token_count, 'completion_tokens': 0}
+
+def get_num_tokens_from_messages_batch(messages, encoding, num_threads=DEFAULT_BATCH_ENCODING_THREADS):
+    """
+    Count the tokens of each message, encoding all of them in parallel.
+
+    Args:
+        messages (list): Message dicts.
+        encoding: A tiktoken encoding.
+        num_threads (int): Encoder threads, defaults to the number of CPUs.
+
+    Returns:
+        array: Unsigned int array of per-message token counts, excluding reply priming.
+    """
+    texts = []
+    owners = array('I')
+    token_counts = array('I', [MESSAGE_OVERHEAD_TOKENS]) * len(messages)
+    for i, message in enumerate(messages):
+        for key, value in message.items():
+            texts.append(value)
+            owners.append(i)
+            if key == "name":  # if there's a name, the role is omitted
+                token_counts[i] -= 1  # role is always required and always 1 token
+    for owner, tokens in zip(owners, encoding.encode_batch(texts, num_threads=num_threads)):
+        token_counts[owner] += len(tokens)
+    return token_counts
@@ -3,7 +3,7 @@ import datetime
 
 from sqlalchemy.exc import SQLAlchemyError
 
-from chatgpt_wrapper.backends.openai.orm import Manager, User
+from chatgpt_wrapper.backends.openai.orm import Manager
 
 class UserManager(Manager):
     def _hash_password(self, password):
@@ -24,9 +24,7 @@ class UserManager(Manager):
     def get_by_username(self, username):
         username = username.lower()
         try:
-            user = self.orm.session.query(User).filter(
-                (User.username == username)
-            ).first()
+            user = self.orm.find_user([username], match_email=False)
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to get user: {str(e)}")
         return True, user, self.user_found_message(user)
@@ -34,9 +32,7 @@ class UserManager(Manager):
     def get_by_username_or_email(self, identifier):
         identifier = identifier.lower()
         try:
-            user = self.orm.session.query(User).filter(
-                (User.username == identifier) | (User.email == identifier)
-            ).first()
+            user = self.orm.find_user([identifier])
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to get user: {str(e)}")
         return True, user, self.user_found_message(user)
@@ -50,9 +46,7 @@ class UserManager(Manager):
         # Check if the username or email is equal to the email of an existing user.
         if email:
             try:
-                existing_user = self.orm.session.query(User).filter(
-                    (User.username == username) | (User.username == email) | (User.email == email) | (User.email == username)
-                ).first()
+                existing_user = self.orm.find_user([username, email])
             except SQLAlchemyError as e:
                 return self._handle_error(f"Failed to retrieve existing users: {str(e)}")
         else:
@@ -77,10 +71,8 @@ class UserManager(Manager):
         if self._hash_password(password) != user.password:
             return False, user, "Incorrect password."
         # Update the last login time
-        user.last_login_time = datetime.datetime.utcnow()
         try:
-            self.orm.session.commit()
-            self.orm.session.refresh(user)
+            user = self.orm.edit_user(user, last_login_time=datetime.datetime.utcnow())
         except SQLAlchemyError as e:
             return self._handle_error(f"Failed to log in user: {str(e)}")
         return True, user, "Login successful."
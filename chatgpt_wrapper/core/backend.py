@@ -1,12 +1,17 @@
+import queue
+import asyncio
+import threading
 from abc import ABC, abstractmethod
 from typing import Any
 
-from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.base import CallbackManager, AsyncCallbackManager, AsyncCallbackHandler
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
 from chatgpt_wrapper.core.config import Config
 from chatgpt_wrapper.core.logger import Logger
+from chatgpt_wrapper.core.llm_cache import llm_client_cache
 from chatgpt_wrapper.core import util
+import chatgpt_wrapper.core.constants as constants
 
 class VerboseStreamingStdOutCallbackHandler(StreamingStdOutCallbackHandler):
     @property
@@ -24,6 +29,159 @@ def make_interrupt_streaming_callback_handler(backend):
                 raise EOFError(message)
     return InterruptStreamingCallbackHandler()
 
+class StreamClosedError(EOFError):
+    pass
+
+class TokenQueueCallbackHandler(VerboseStreamingStdOutCallbackHandler):
+    def __init__(self, token_stream):
+        self.token_stream = token_stream
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.token_stream.put(token)
+
+class TokenStream:
+    """
+    Iterator over the tokens of a streaming response, generated in a worker
+    thread.
+
+    The buffer is bounded, so a consumer that falls behind pauses generation
+    instead of the whole response piling up in memory. close() stops
+    generation, the worker fails on the next token it receives.
+
+    Once iteration ends, result holds the (success, response, message) of
+    the request.
+    """
+
+    _done = object()
+
+    def __init__(self, max_buffered_tokens=constants.DEFAULT_STREAM_MAX_BUFFERED_TOKENS):
+        self.queue = queue.Queue(maxsize=max_buffered_tokens)
+        self.closed = threading.Event()
+        self.handler = TokenQueueCallbackHandler(self)
+        self.result = None
+        self.thread = None
+
+    def start(self, target, *args, **kwargs):
+        def run():
+            try:
+                self.result = target(*args, **kwargs)
+            except Exception as e:
+                self.result = (False, None, f"Streaming stopped: {e}" if self.closed.is_set() else str(e))
+            finally:
+                self._put(self._done)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _put(self, item):
+        # Wake up regularly, so a closed stream is noticed while full.
+        while True:
+            if self.closed.is_set():
+                return False
+            try:
+                self.queue.put(item, timeout=constants.STREAM_CLOSED_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+
+    def put(self, token):
+        if not self._put(token):
+            raise StreamClosedError("Token stream closed by the consumer")
+
+    def __iter__(self):
+        while not self.closed.is_set():
+            token = self.queue.get()
+            if token is self._done:
+                break
+            yield token
+
+    def close(self):
+        self.closed.set()
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+class AsyncTokenQueueCallbackHandler(AsyncCallbackHandler):
+    def __init__(self, token_stream):
+        self.token_stream = token_stream
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        await self.token_stream.put(token)
+
+class AsyncTokenStream:
+    """
+    Async iterator over the tokens of a streaming response, generated by a
+    task on the running event loop.
+
+    Like TokenStream, the buffer is bounded so a slow consumer pauses
+    generation. aclose() cancels the task, which stops generation.
+
+    Once iteration ends, result holds the (success, response, message) of
+    the request.
+    """
+
+    _done = object()
+
+    def __init__(self, max_buffered_tokens=constants.DEFAULT_STREAM_MAX_BUFFERED_TOKENS):
+        self.queue = asyncio.Queue(maxsize=max_buffered_tokens)
+        self.handler = AsyncTokenQueueCallbackHandler(self)
+        self.result = None
+        self.task = None
+
+    def start(self, coroutine):
+        async def run():
+            try:
+                self.result = await coroutine
+            except asyncio.CancelledError:
+                self.result = (False, None, "Streaming stopped")
+                # Ends iteration, unless the consumer stopped reading.
+                try:
+                    self.queue.put_nowait(self._done)
+                except asyncio.QueueFull:
+                    pass
+                raise
+            except Exception as e:
+                self.result = (False, None, str(e))
+            await self.queue.put(self._done)
+        self.task = asyncio.ensure_future(run())
+        return self
+
+    async def put(self, token):
+        await self.queue.put(token)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            # A task cancelled while the buffer was full could not queue
+            # the end of iteration.
+            if self.queue.empty() and self.task.done():
+                break
+            token = await self.queue.get()
+            if token is self._done:
+                break
+            yield token
+
+    async def wait(self):
+        """Wait for the request to finish, returns result."""
+        if self.task:
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        return self.result
+
+    async def aclose(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+        await self.wait()
+
 class Backend(ABC):
     """
     Base class/interface for all backends.
@@ -58,8 +216,13 @@ class Backend(ABC):
             # ]
         }
 
-    def streaming_args(self, interrupt_handler=False):
-        calback_handlers = [
+    def streaming_args(self, interrupt_handler=False, stream_handlers=None):
+        """
+        Args:
+            stream_handlers (list): Handlers to receive the tokens, instead
+                of printing them to stdout.
+        """
+        calback_handlers = list(stream_handlers) if stream_handlers else [
             VerboseStreamingStdOutCallbackHandler(),
         ]
         if interrupt_handler:
@@ -70,11 +233,21 @@ class Backend(ABC):
         }
         return args
 
+    def async_streaming_args(self, stream_handlers):
+        """Like streaming_args(), for async LLM calls, stream_handlers are async callback handlers."""
+        return {
+            'streaming': True,
+            'callback_manager': AsyncCallbackManager(list(stream_handlers)),
+        }
+
     def make_llm(self, args={}):
+        """
+        A client for the LLM, copied from a cached client for the model and
+        arguments, so making one per request is cheap.
+        """
         final_args = self.get_default_llm_args()
         final_args.update(args)
-        llm = self.llm_class(**final_args)
-        return llm
+        return llm_client_cache.make_llm(self.llm_class, final_args)
 
     def set_active_model(self, model=None):
         if model is None:
@@ -135,3 +308,12 @@ class Backend(ABC):
     @abstractmethod
     def ask(self, message: str):
         pass
+
+    @abstractmethod
+    async def ask_async(self, message: str):
+        pass
+
+    @abstractmethod
+    def ask_stream_async(self, message: str):
+        """Returns an AsyncTokenStream, call from a running event loop."""
+        pass
@@ -25,11 +25,19 @@ SYSTEM_MESSAGE_DEFAULT = "You are a helpful assistant."
 SYSTEM_MESSAGE_PROGRAMMER = "You are an expert programmer, who responds to questions with brief examples in code."
 DEFAULT_TITLE_GENERATION_SYSTEM_PROMPT = 'You write short 3-5 word titles for any content'
 DEFAULT_TITLE_GENERATION_USER_PROMPT = 'Write a title for this content:'
+CONTEXT_SUMMARY_SYSTEM_PROMPT = 'You summarize conversations between a user and an AI assistant. Keep all facts, decisions, names, code identifiers and open questions needed to continue the conversation. Respond with the summary only, in less than %d tokens.'
+CONTEXT_SUMMARY_USER_PROMPT = "Existing summary of the conversation:\n\n%s\n\nUpdate the summary with these newer messages:\n\n%s"
+CONTEXT_SUMMARY_EMPTY = 'None'
+CONTEXT_SUMMARY_MESSAGE_PREFIX = 'Summary of the earlier part of this conversation:'
 
 OPENAPI_MAX_TOKENS = 4096
 OPENAPI_MIN_SUBMISSION_TOKENS = 1
 OPENAPI_DEFAULT_MAX_SUBMISSION_TOKENS = 4000
 
+DEFAULT_CONTEXT_STRATEGY = 'drop_oldest'
+DEFAULT_CONTEXT_KEEP_LAST_MESSAGES = 20
+DEFAULT_CONTEXT_SUMMARY_MAX_TOKENS = 500
+
 OPENAPI_DEFAULT_TEMPERATURE = 0.9
 OPENAPI_TEMPERATURE_MIN = 0
 OPENAPI_TEMPERATURE_MAX = 2
@@ -51,6 +59,34 @@ DEFAULT_PROFILE = 'default'
 DEFAULT_CONFIG_DIR = 'chatgpt-wrapper'
 DEFAULT_DATABASE_BASENAME = 'storage'
 CONFIG_PROFILES_DIR = 'profiles'
+DEFAULT_DATABASE_POOL_CLASS = 'queue'
+DEFAULT_DATABASE_POOL_SIZE = 5
+DEFAULT_SQLITE_PRAGMAS = {
+    # Only applies to new databases, lets maintenance reclaim space
+    # incrementally. Must run before journal_mode initializes the file.
+    'auto_vacuum': 'incremental',
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'busy_timeout': 5000,
+}
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+DEFAULT_CONVERSATION_CACHE_SIZE = 128
+DEFAULT_CONVERSATION_CACHE_WINDOW = 200
+DEFAULT_MAINTENANCE_BATCH_SIZE = 500
+DEFAULT_API_SERVER_POOL_SIZE = 8
+DEFAULT_API_SERVER_POOL_TIMEOUT = 30
+DEFAULT_API_SERVER_DRAIN_TIMEOUT = 30
+DEFAULT_LLM_CLIENT_CACHE_SIZE = 32
+DEFAULT_OPENAI_HTTP_POOL_SIZE = 32
+DEFAULT_OPENAI_HTTP_MAX_RETRIES = 2
+DEFAULT_SEMANTIC_SEARCH_EMBEDDER = 'hashing'
+DEFAULT_SEMANTIC_SEARCH_DIMENSIONS = 256
+DEFAULT_SEMANTIC_SEARCH_IVF_LISTS = 0
+DEFAULT_SEMANTIC_SEARCH_IVF_NPROBE = 4
+SEMANTIC_SEARCH_INDEX_DIR = 'semantic_index'
+SEMANTIC_SEARCH_CANDIDATES_PER_RESULT = 5
 DEFAULT_CONFIG = {
     'backend': 'chatgpt-api',
     'shell': {
@@ -58,6 +94,38 @@ DEFAULT_CONFIG = {
         'history_file': '%s%srepl_history.log' % (tempfile.gettempdir(), os.path.sep),
     },
     'database': None,
+    'database_options': {
+        'pool_class': DEFAULT_DATABASE_POOL_CLASS,
+        'pool_size': DEFAULT_DATABASE_POOL_SIZE,
+        'sqlite_pragmas': DEFAULT_SQLITE_PRAGMAS,
+        'cache': {
+            # Off by default, the cache only sees writes made by its own
+            # process, so it is unsafe with several server workers.
+            'max_conversations': 0,
+            'window_messages': DEFAULT_CONVERSATION_CACHE_WINDOW,
+        },
+    },
+    'maintenance': {
+        'max_age_days': None,
+        'purge_hidden': False,
+        'max_conversations_per_user': None,
+        'archive_directory': None,
+        'batch_size': DEFAULT_MAINTENANCE_BATCH_SIZE,
+        'vacuum_pages': None,
+        'interval_hours': None,
+    },
+    'api_server': {
+        'pool_size': DEFAULT_API_SERVER_POOL_SIZE,
+        'pool_timeout': DEFAULT_API_SERVER_POOL_TIMEOUT,
+        'drain_timeout': DEFAULT_API_SERVER_DRAIN_TIMEOUT,
+    },
+    'semantic_search': {
+        'embedder': DEFAULT_SEMANTIC_SEARCH_EMBEDDER,
+        'dimensions': DEFAULT_SEMANTIC_SEARCH_DIMENSIONS,
+        'ivf_lists': DEFAULT_SEMANTIC_SEARCH_IVF_LISTS,
+        'ivf_nprobe': DEFAULT_SEMANTIC_SEARCH_IVF_NPROBE,
+        'directory': None,
+    },
     'browser': {
         'provider': 'firefox',
         'debug': False,
@@ -70,6 +138,15 @@ DEFAULT_CONFIG = {
             'presence_penalty': OPENAPI_DEFAULT_PRESENCE_PENALTY,
             'frequency_penalty': OPENAPI_DEFAULT_FREQUENCY_PENALTY,
             'max_submission_tokens': OPENAPI_DEFAULT_MAX_SUBMISSION_TOKENS,
+            'context_strategy': {
+                'name': DEFAULT_CONTEXT_STRATEGY,
+                'keep_last': {
+                    'messages': DEFAULT_CONTEXT_KEEP_LAST_MESSAGES,
+                },
+                'rolling_summary': {
+                    'max_summary_tokens': DEFAULT_CONTEXT_SUMMARY_MAX_TOKENS,
+                },
+            },
             'system_message': {
                 'programmer': SYSTEM_MESSAGE_PROGRAMMER,
             },
@@ -106,6 +183,7 @@ COMMAND_LEADER = '/'
 LEGACY_COMMAND_LEADER = '!'
 DEFAULT_COMMAND = 'ask'
 DEFAULT_HISTORY_LIMIT = 20
+DEFAULT_SEARCH_LIMIT = 20
 SHELL_ONE_SHOT_COMMANDS = [
     'install',
     'reinstall',
@@ -114,15 +192,23 @@ SHELL_ONE_SHOT_COMMANDS = [
 
 # Interface-specific constants.
 NO_TITLE_TEXT = "No title"
+SEARCH_SNIPPET_TOKENS = 16
+SEMANTIC_SEARCH_EXCERPT_LENGTH = 120
+# Tokens a streaming response buffers for a slow consumer before generation waits.
+DEFAULT_STREAM_MAX_BUFFERED_TOKENS = 256
+# Seconds between checks for a closed stream while the buffer is full.
+STREAM_CLOSED_CHECK_INTERVAL = 0.1
 # These are the variables in this file that are available for substitution in
 # help messages.
 HELP_TOKEN_VARIABLE_SUBSTITUTIONS = [
     'COMMAND_LEADER',
     'DEFAULT_HISTORY_LIMIT',
+    'DEFAULT_SEARCH_LIMIT',
     'SYSTEM_MESSAGE_DEFAULT',
     'OPENAPI_MAX_TOKENS',
     'OPENAPI_MIN_SUBMISSION_TOKENS',
     'OPENAPI_DEFAULT_MAX_SUBMISSION_TOKENS',
+    'DEFAULT_CONTEXT_STRATEGY',
     'OPENAPI_DEFAULT_TEMPERATURE',
     'OPENAPI_TEMPERATURE_MIN',
     'OPENAPI_TEMPERATURE_MAX',
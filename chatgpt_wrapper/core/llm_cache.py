@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+import chatgpt_wrapper.core.constants as constants
+
+# Applied to a copy of a cached client, they do not need a client of their own.
+LLM_REQUEST_ARGS = (
+    'temperature',
+    'top_p',
+    'presence_penalty',
+    'frequency_penalty',
+    'streaming',
+    'callback_manager',
+    'verbose',
+)
+
+def freeze_llm_arg(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze_llm_arg(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_llm_arg(item) for item in value)
+    return value
+
+def copy_llm(llm, overrides):
+    """
+    A shallow copy of a client with overrides applied, without validating
+    the model again.
+
+    Overrides that are not fields of the client are passed to the model
+    through model_kwargs, like the client's own validation would.
+    """
+    update = {}
+    for key, value in overrides.items():
+        if key in llm.__fields__:
+            update[key] = value
+        elif 'model_kwargs' in llm.__fields__:
+            update.setdefault('model_kwargs', dict(llm.model_kwargs))[key] = value
+        else:
+            raise ValueError(f"{llm.__class__.__name__} has no argument {key}")
+    return llm.copy(update=update)
+
+class LlmClientCache:
+    """
+    Per-process LRU cache of LLM clients, keyed by class and arguments.
+
+    Building a client validates the pydantic model and sets up its callback
+    manager, so each combination of model and client arguments is built
+    once. Requests get a shallow copy of the shared client with their own
+    temperature, streaming and so on, see LLM_REQUEST_ARGS, and never change
+    the shared client.
+    """
+
+    def __init__(self, max_clients=constants.DEFAULT_LLM_CLIENT_CACHE_SIZE):
+        self.max_clients = max_clients
+        self.clients = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, klass, args):
+        key = (klass, freeze_llm_arg(args))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, klass, args):
+        key = self.make_key(klass, args)
+        if key is None:
+            self.misses += 1
+            return klass(**args)
+        with self.lock:
+            llm = self.clients.get(key)
+            if llm is not None:
+                self.clients.move_to_end(key)
+                self.hits += 1
+                return llm
+        # Built outside the lock, two threads may both build a missing client.
+        llm = klass(**args)
+        with self.lock:
+            self.misses += 1
+            self.clients[key] = llm
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        return llm
+
+    def make_llm(self, klass, args):
+        """A client for one request, built from a cached client."""
+        if not hasattr(klass, '__fields__'):
+            # Not a pydantic model, it can not be copied.
+            return klass(**args)
+        client_args = {key: value for key, value in args.items() if key not in LLM_REQUEST_ARGS}
+        overrides = {key: value for key, value in args.items() if key in LLM_REQUEST_ARGS}
+        return copy_llm(self.get(klass, client_args), overrides)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'clients': len(self.clients),
+            'max_clients': self.max_clients,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.clients = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+llm_client_cache = LlmClientCache()
@@ -408,6 +408,18 @@ class Repl():
             {COMMAND} 10
             {COMMAND} 10 5
         """
+        args = self._parse_history_args(arg)
+        if not args:
+            return
+        limit, offset = args
+        success, history, message = self._fetch_history(limit=limit, offset=offset)
+        if success:
+            self._print_history(history)
+        else:
+            return success, history, message
+
+    def _parse_history_args(self, arg):
+        """Returns (limit, offset), or None if the arguments are invalid."""
         limit = constants.DEFAULT_HISTORY_LIMIT
         offset = 0
         if arg:
@@ -427,12 +439,11 @@ class Repl():
                     except ValueError:
                         util.print_markdown("* Invalid offset, must be an integer")
                         return
-        success, history, message = self._fetch_history(limit=limit, offset=offset)
-        if success:
-            history_list = [h for h in history.values()]
-            util.print_markdown("## Recent history:\n\n%s" % "\n".join(["1. %s: %s (%s)%s" % (h['created_time'].strftime("%Y-%m-%d %H:%M"), h['title'] or constants.NO_TITLE_TEXT, h['id'], ' (✓)' if h['id'] == self.backend.conversation_id else '') for h in history_list]))
-        else:
-            return success, history, message
+        return limit, offset
+
+    def _print_history(self, history):
+        history_list = [h for h in history.values()]
+        util.print_markdown("## Recent history:\n\n%s" % "\n".join(["1. %s: %s (%s)%s" % (h['created_time'].strftime("%Y-%m-%d %H:%M"), h['title'] or constants.NO_TITLE_TEXT, h['id'], ' (✓)' if h['id'] == self.backend.conversation_id else '') for h in history_list]))
 
     def do_nav(self, arg):
         """
@@ -1,4 +1,9 @@
 import os
+import asyncio
+import base64
+import contextvars
+import functools
+import json
 import shutil
 import sys
 from datetime import datetime
@@ -19,6 +24,12 @@ console = Console()
 
 is_windows = platform.system() == "Windows"
 
+async def run_in_thread(func, *args, **kwargs):
+    """Like asyncio.to_thread(), which needs Python 3.9."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
 def introspect_commands(klass):
     return [method[3:] for method in dir(klass) if callable(getattr(klass, method)) and method.startswith("do_")]
 
@@ -199,6 +210,21 @@ def create_file(directory, filename, content=None):
         if content:
             file.write(content)
 
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(data, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return data
+
+def truncate_text(text, length):
+    return text if len(text) <= length else text[:length - 3].rstrip() + '...'
+
 def current_datetime():
     now = datetime.now()
     return now
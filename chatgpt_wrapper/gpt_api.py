@@ -1,20 +1,84 @@
+import json
 import argparse
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 
-from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+from chatgpt_wrapper.backends.openai.pool import BackendPool, BackendPoolTimeoutError
+from chatgpt_wrapper.backends.openai.maintenance import start_maintenance_scheduler
 from chatgpt_wrapper.core.config import Config
 
 
-def create_application(name, config=None, timeout=60, proxy=None):
+def format_sse(event, data):
+    """A Server-Sent Events message, data is sent as JSON."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class RequestError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def create_application(name, config=None, timeout=60, proxy=None, pool_size=None):
+    """
+    Create the API server.
+
+    Requests are independent, the user and conversation are request
+    parameters, and each request gets a backend of its own from a pool, so
+    the application is safe to serve from many threads at once.
+    """
     config = config or Config()
     config.set('debug.log.enabled', True)
-    gpt = OpenAIAPI(config)
+    pool = BackendPool(config, size=pool_size)
     app = Flask(name)
+    app.backend_pool = pool
+    app.maintenance_scheduler = start_maintenance_scheduler(config, pool.orm)
 
     def _error_handler(message, status_code=500):
         return jsonify({"success": False, "error": str(message)}), status_code
 
+    @app.errorhandler(RequestError)
+    def _request_error(e):
+        return _error_handler(e, e.status_code)
+
+    @app.errorhandler(BackendPoolTimeoutError)
+    def _pool_timeout(e):
+        return _error_handler(e, 503)
+
+    @app.teardown_request
+    def _close_session(_exception):
+        pool.close_session()
+
+    def _prepare_backend(gpt):
+        """Set up a pooled backend from the user_id, conversation_id and parent_message_id query parameters."""
+        success, _gpt, user_message = pool.prepare(
+            gpt,
+            user_id=request.args.get("user_id", type=int),
+            conversation_id=request.args.get("conversation_id", type=int),
+            parent_message_id=request.args.get("parent_message_id", type=int),
+        )
+        if not success:
+            raise RequestError(user_message, 404)
+        return gpt
+
+    def _prepare_conversation_owner(gpt, conversation_id):
+        """Check the conversation belongs to the user in the required user_id query parameter."""
+        user_id = request.args.get("user_id", type=int)
+        if user_id is None:
+            raise RequestError("The user_id query parameter is required")
+        success, _gpt, user_message = pool.prepare(gpt, user_id=user_id, conversation_id=conversation_id)
+        if not success:
+            raise RequestError(user_message, 404)
+        return gpt
+
+    def _conversation_headers(gpt):
+        headers = {}
+        if gpt.conversation_id:
+            headers["X-Conversation-Id"] = str(gpt.conversation_id)
+        if gpt.parent_message_id:
+            headers["X-Parent-Message-Id"] = str(gpt.parent_message_id)
+        return headers
+
     @app.route("/conversations", methods=["POST"])
     def ask():
         """
@@ -23,30 +87,128 @@ def create_application(name, config=None, timeout=60, proxy=None):
         Path:
             POST /conversations
 
+        Query Parameters:
+            user_id (int, optional): Save the exchange to this user's conversations.
+            conversation_id (int, optional): Continue this conversation of the user,
+                a new one is started without it.
+            parent_message_id (int, optional): Continue from this message, defaults
+                to the last message of the conversation.
+
         Request Body:
             STRING:
                 Some text.
 
+        Response Headers:
+            X-Conversation-Id: The conversation, to continue it in the next request.
+            X-Parent-Message-Id: The stored response message.
+
         Returns:
             STRING:
                 Some response.
         """
         prompt = request.get_data().decode("utf-8")
-        success, result, user_message = gpt.ask(prompt)
-        return result
+        with pool.backend() as gpt:
+            _prepare_backend(gpt)
+            success, result, user_message = gpt.ask(prompt)
+            if not success:
+                return _error_handler(user_message)
+            return Response(result, mimetype="text/plain", headers=_conversation_headers(gpt))
+
+    @app.route("/conversations/stream", methods=["POST"])
+    def ask_stream():
+        """
+        Ask a question, streaming the response as Server-Sent Events.
+
+        Each token is sent as it is generated. The stream pauses generation
+        while the client is not reading, and a client that disconnects stops
+        generation.
+
+        Path:
+            POST /conversations/stream
+
+        Query Parameters:
+            The same as POST /conversations.
+
+        Request Body:
+            STRING:
+                Some text.
+
+        Returns:
+            text/event-stream:
+                event: token
+                data: "Some"
+
+                event: token
+                data: " response."
+
+                event: done
+                data: {"success": true, "conversation_id": 1, "parent_message_id": 2}
+
+            On failure the last event is:
+                event: done
+                data: {"success": false, "error": "Some error"}
+        """
+        prompt = request.get_data().decode("utf-8")
+        # Held until the stream ends, not just for this function.
+        gpt = pool.acquire()
+        try:
+            _prepare_backend(gpt)
+            stream = gpt.ask_stream_iter(prompt)
+        except Exception:
+            pool.release(gpt)
+            raise
+
+        def generate():
+            try:
+                # Sends the headers right away, before the first token.
+                yield ": stream started\n\n"
+                for token in stream:
+                    yield format_sse("token", token)
+                stream.join()
+                success, _response, user_message = stream.result
+                if success:
+                    yield format_sse("done", {"success": True, "conversation_id": gpt.conversation_id, "parent_message_id": gpt.parent_message_id})
+                else:
+                    yield format_sse("done", {"success": False, "error": str(user_message)})
+            finally:
+                # Also runs when the server closes the generator because the
+                # client went away.
+                stream.close()
+                stream.join()
+                pool.release(gpt)
+
+        return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            # Stops reverse proxies like nginx from buffering the stream.
+            "X-Accel-Buffering": "no",
+        })
 
     @app.route("/conversations/new", methods=["POST"])
     def new_conversation():
         """
         Start a new conversation.
 
+        Conversations are request parameters, this only creates one ahead
+        of the first prompt, for a user.
+
         Path:
             POST /conversations/new
 
+        Query Parameters:
+            user_id (int, optional): The user to create the conversation for.
+
+        Request Body:
+            JSON (optional):
+                {
+                    "title": "New Title"
+                }
+
         Returns:
             JSON:
                 {
                     "success": true,
+                    "conversation_id": 1,
+                    "parent_message_id": null
                 }
 
             JSON:
@@ -55,10 +217,17 @@ def create_application(name, config=None, timeout=60, proxy=None):
                     "error": "Failed to start new conversation"
                 }
         """
-        gpt.new_conversation()
-        return jsonify({"success": True, "parent_message_id": gpt.parent_message_id})
-
-    @app.route("/conversations/<string:conversation_id>", methods=["DELETE"])
+        data = request.get_json(silent=True) or {}
+        with pool.backend() as gpt:
+            _prepare_backend(gpt)
+            if gpt.current_user:
+                try:
+                    gpt.create_new_conversation_if_needed(title=data.get("title"))
+                except Exception as e:
+                    return _error_handler(e)
+            return jsonify({"success": True, "conversation_id": gpt.conversation_id, "parent_message_id": gpt.parent_message_id})
+
+    @app.route("/conversations/<int:conversation_id>", methods=["DELETE"])
     def delete_conversation(conversation_id):
         """
         Delete a conversation.
@@ -67,7 +236,10 @@ def create_application(name, config=None, timeout=60, proxy=None):
             DELETE /conversations/:conversation_id
 
         Parameters:
-            conversation_id (str): The ID of the conversation to delete.
+            conversation_id (int): The ID of the conversation to delete.
+
+        Query Parameters:
+            user_id (int): The user the conversation belongs to.
 
         Returns:
             JSON:
@@ -81,13 +253,15 @@ def create_application(name, config=None, timeout=60, proxy=None):
                     "error": "Failed to delete conversation"
                 }
         """
-        success, result, user_message = gpt.delete_conversation(conversation_id)
+        with pool.backend() as gpt:
+            _prepare_conversation_owner(gpt, conversation_id)
+            success, result, user_message = gpt.delete_conversation(conversation_id)
         if success:
             return user_message
         else:
             return _error_handler(user_message)
 
-    @app.route("/conversations/<string:conversation_id>/set-title", methods=["PATCH"])
+    @app.route("/conversations/<int:conversation_id>/set-title", methods=["PATCH"])
     def set_title(conversation_id):
         """
         Set the title of a conversation.
@@ -96,7 +270,10 @@ def create_application(name, config=None, timeout=60, proxy=None):
             PATCH /conversations/:conversation_id/set-title
 
         Parameters:
-            conversation_id (str): The ID of the conversation to set the title for.
+            conversation_id (int): The ID of the conversation to set the title for.
+
+        Query Parameters:
+            user_id (int): The user the conversation belongs to.
 
         Request Body:
             JSON:
@@ -118,11 +295,12 @@ def create_application(name, config=None, timeout=60, proxy=None):
         """
         json = request.get_json()
         title = json["title"]
-        success, conversation, user_message = gpt.set_title(title, conversation_id)
-        if success:
-            return jsonify(gpt.conversation.orm.object_as_dict(conversation))
-        else:
-            return _error_handler("Failed to set title")
+        with pool.backend() as gpt:
+            _prepare_conversation_owner(gpt, conversation_id)
+            success, conversation, user_message = gpt.set_title(title, conversation_id)
+            if success:
+                return jsonify(gpt.conversation.orm.object_as_dict(conversation))
+        return _error_handler("Failed to set title")
 
     @app.route("/history/<int:user_id>", methods=["GET"])
     def get_history(user_id):
@@ -135,6 +313,11 @@ def create_application(name, config=None, timeout=60, proxy=None):
         Query Parameters:
             limit (int, optional): The maximum number of conversations to return (default is 20).
             offset (int, optional): The number of conversations to skip before starting to return results (default is 0).
+            cursor (str, optional): Return the page after this cursor, taken from the
+                X-Next-Cursor header of the previous page. Overrides offset.
+
+        Response Headers:
+            X-Next-Cursor: Cursor for the next page, absent on the last page.
 
         Returns:
             JSON:
@@ -152,11 +335,19 @@ def create_application(name, config=None, timeout=60, proxy=None):
                     "error": "Failed to get history"
                 }
         """
-        limit = request.args.get("limit", 20)
-        offset = request.args.get("offset", 0)
-        success, result, user_message = gpt.get_history(limit=limit, offset=offset, user_id=user_id)
+        limit = request.args.get("limit", 20, type=int)
+        offset = request.args.get("offset", 0, type=int)
+        cursor = request.args.get("cursor")
+        with pool.backend() as gpt:
+            success, result, user_message = gpt.get_history(limit=limit, offset=offset, user_id=user_id, cursor=cursor)
+            next_cursor = gpt.get_history_next_cursor(result, limit) if success and result else None
+        if cursor and not success:
+            return _error_handler(user_message, 400)
         if result:
-            return jsonify(result)
+            response = jsonify(result)
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return response
         else:
             return _error_handler("Failed to get history")
 
@@ -166,6 +357,11 @@ def create_application(name, config=None, timeout=60, proxy=None):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--pool-size", type=int, help="Requests handled at once, defaults to the api_server.pool_size setting")
     args = parser.parse_args()
-    app = create_application("chatgpt")
-    app.run(host="0.0.0.0", port=args.port, threaded=False)
+    app = create_application("chatgpt", pool_size=args.pool_size)
+    # For production, serve with a WSGI server instead, for example:
+    #   gunicorn --workers 4 --threads 8 'chatgpt_wrapper.gpt_api:create_application("chatgpt")'
+    # With more than one worker, keep database_options.cache disabled, each
+    # worker's cache only sees its own writes.
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
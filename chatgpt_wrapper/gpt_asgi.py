@@ -0,0 +1,539 @@
+import re
+import json
+import asyncio
+import argparse
+from urllib.parse import parse_qs
+
+from chatgpt_wrapper.backends.openai.pool import AsyncBackendPool, BackendPoolTimeoutError
+from chatgpt_wrapper.backends.openai.http_sessions import http_sessions
+from chatgpt_wrapper.backends.openai.maintenance import start_maintenance_scheduler
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.gpt_api import RequestError, format_sse
+import chatgpt_wrapper.core.constants as constants
+import chatgpt_wrapper.core.util as util
+
+SHUTTING_DOWN_MESSAGE = "Server is shutting down"
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope.get("method")
+        self.path = scope["path"]
+        self.args = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+
+    def arg(self, name, default=None, type=None):
+        if name not in self.args:
+            return default
+        value = self.args[name][0]
+        if type is None:
+            return value
+        try:
+            return type(value)
+        except ValueError:
+            raise RequestError(f"Invalid {name}: {value}")
+
+    async def body(self):
+        chunks = []
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def json(self):
+        body = await self.body()
+        if not body:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise RequestError("Invalid JSON")
+
+
+class WebSocketConnection:
+    """One open WebSocket, sends from the connection and its generation are serialized."""
+
+    def __init__(self, send, conversation_id=None):
+        self._send = send
+        self.lock = asyncio.Lock()
+        self.closed = False
+        self.conversation_id = conversation_id
+        self.stream = None
+        self.generation = None
+
+    def generating(self):
+        return self.generation is not None and not self.generation.done()
+
+    async def send_json(self, data):
+        async with self.lock:
+            if not self.closed:
+                await self._send({"type": "websocket.send", "text": json.dumps(data)})
+
+    async def close(self, code=1000):
+        async with self.lock:
+            if not self.closed:
+                self.closed = True
+                await self._send({"type": "websocket.close", "code": code})
+
+    async def stop(self):
+        """Stop the running generation, its done message reports it stopped."""
+        if self.stream:
+            await self.stream.aclose()
+
+
+class AsgiApplication:
+    """
+    The API server as an ASGI application, with the routes of the Flask
+    application in gpt_api, and a WebSocket endpoint for chat.
+
+    Everything runs on the event loop, with database work in worker
+    threads. Connections only hold a backend while a response is being
+    generated, so a process can keep many idle connections open.
+
+    On shutdown, new requests are refused, and in-flight responses get
+    api_server.drain_timeout seconds to finish before they are stopped.
+    """
+
+    def __init__(self, config=None, pool_size=None, drain_timeout=None):
+        self.config = config or Config()
+        self.config.set('debug.log.enabled', True)
+        self.pool = AsyncBackendPool(self.config, size=pool_size)
+        self.drain_timeout = drain_timeout or self.config.get('api_server.drain_timeout') or constants.DEFAULT_API_SERVER_DRAIN_TIMEOUT
+        self.maintenance_scheduler = None
+        self.draining = False
+        # Tasks generating responses, and the open WebSockets.
+        self.generations = set()
+        self._idle = None
+        self.websockets = set()
+        self.routes = [
+            ("POST", re.compile(r"^/conversations$"), self.ask),
+            ("POST", re.compile(r"^/conversations/stream$"), self.ask_stream),
+            ("POST", re.compile(r"^/conversations/new$"), self.new_conversation),
+            ("DELETE", re.compile(r"^/conversations/(?P<conversation_id>\d+)$"), self.delete_conversation),
+            ("PATCH", re.compile(r"^/conversations/(?P<conversation_id>\d+)/set-title$"), self.set_title),
+            ("GET", re.compile(r"^/history/(?P<user_id>\d+)$"), self.get_history),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.handle_websocket(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+
+    @property
+    def idle(self):
+        """Set while no responses are generating."""
+        # Created inside the server's event loop, before Python 3.10 it
+        # binds to the loop current at creation. Lifespan startup creates
+        # it, servers without lifespan events create it on first use.
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if not self.generations:
+                self._idle.set()
+        return self._idle
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Creates the event inside the server's loop.
+                self.idle
+                self.maintenance_scheduler = start_maintenance_scheduler(self.config, self.pool.orm)
+                await http_sessions.open_async()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.drain()
+                if self.maintenance_scheduler:
+                    await util.run_in_thread(self.maintenance_scheduler.stop)
+                await http_sessions.close_async()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _track(self, task):
+        self.generations.add(task)
+        self.idle.clear()
+        task.add_done_callback(self._untrack)
+        return task
+
+    def _untrack(self, task):
+        self.generations.discard(task)
+        if not self.generations:
+            self.idle.set()
+
+    async def drain(self, timeout=None):
+        """
+        Refuse new requests and prompts, and wait for in-flight responses
+        to finish, stopping those still running after timeout seconds.
+        """
+        self.draining = True
+        timeout = self.drain_timeout if timeout is None else timeout
+        for connection in list(self.websockets):
+            if not connection.generating():
+                await connection.close(1001)
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            generations = list(self.generations)
+            for task in generations:
+                task.cancel()
+            await asyncio.gather(*generations, return_exceptions=True)
+
+    async def _generate(self, coroutine):
+        """Await a response, drain stops it like a stream."""
+        if self.draining:
+            coroutine.close()
+            raise RequestError(SHUTTING_DOWN_MESSAGE, 503)
+
+        async def run():
+            try:
+                return await coroutine
+            except asyncio.CancelledError:
+                return False, None, SHUTTING_DOWN_MESSAGE
+        return await self._track(asyncio.ensure_future(run()))
+
+    def _start_stream(self, gpt, prompt):
+        if self.draining:
+            raise RequestError(SHUTTING_DOWN_MESSAGE, 503)
+        stream = gpt.ask_stream_async(prompt)
+        self._track(stream.task)
+        return stream
+
+    async def _prepare_backend(self, gpt, user_id=None, conversation_id=None, parent_message_id=None):
+        success, _gpt, user_message = await self.pool.prepare_async(gpt, user_id=user_id, conversation_id=conversation_id, parent_message_id=parent_message_id)
+        if not success:
+            raise RequestError(user_message, 404)
+        return gpt
+
+    async def _prepare_backend_from_request(self, gpt, request):
+        """Set up a pooled backend from the user_id, conversation_id and parent_message_id query parameters."""
+        return await self._prepare_backend(
+            gpt,
+            user_id=request.arg("user_id", type=int),
+            conversation_id=request.arg("conversation_id", type=int),
+            parent_message_id=request.arg("parent_message_id", type=int),
+        )
+
+    async def _prepare_conversation_owner(self, gpt, request, conversation_id):
+        """Check the conversation belongs to the user in the required user_id query parameter."""
+        user_id = request.arg("user_id", type=int)
+        if user_id is None:
+            raise RequestError("The user_id query parameter is required")
+        return await self._prepare_backend(gpt, user_id=user_id, conversation_id=conversation_id)
+
+    def _conversation_headers(self, gpt):
+        headers = {}
+        if gpt.conversation_id:
+            headers["X-Conversation-Id"] = str(gpt.conversation_id)
+        if gpt.parent_message_id:
+            headers["X-Parent-Message-Id"] = str(gpt.parent_message_id)
+        return headers
+
+    async def _start_response(self, send, status=200, content_type="application/json", headers=None):
+        raw_headers = [(b"content-type", content_type.encode("latin-1"))]
+        raw_headers.extend((name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items())
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+
+    async def _respond(self, send, body, status=200, content_type="application/json", headers=None):
+        await self._start_response(send, status, content_type, headers)
+        await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+    async def _respond_json(self, send, data, status=200, headers=None):
+        await self._respond(send, json.dumps(data, default=str), status, headers=headers)
+
+    async def _error_handler(self, send, message, status_code=500):
+        await self._respond_json(send, {"success": False, "error": str(message)}, status_code)
+
+    async def handle_http(self, scope, receive, send):
+        request = Request(scope, receive)
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match and method == request.method:
+                break
+        else:
+            await self._error_handler(send, "Not found", 404)
+            return
+        if self.draining:
+            await self._error_handler(send, SHUTTING_DOWN_MESSAGE, 503)
+            return
+        try:
+            await handler(request, send, **match.groupdict())
+        except RequestError as e:
+            await self._error_handler(send, e, e.status_code)
+        except BackendPoolTimeoutError as e:
+            await self._error_handler(send, e, 503)
+        except ClientDisconnected:
+            pass
+
+    async def ask(self, request, send):
+        """
+        Ask a question, see gpt_api for the parameters.
+
+        Path:
+            POST /conversations
+        """
+        prompt = (await request.body()).decode("utf-8")
+        async with self.pool.backend_async() as gpt:
+            await self._prepare_backend_from_request(gpt, request)
+            success, result, user_message = await self._generate(gpt.ask_async(prompt))
+            if not success:
+                await self._error_handler(send, user_message)
+                return
+            await self._respond(send, result, content_type="text/plain; charset=utf-8", headers=self._conversation_headers(gpt))
+
+    async def ask_stream(self, request, send):
+        """
+        Ask a question, streaming the response as Server-Sent Events, see
+        gpt_api for the parameters and events.
+
+        Path:
+            POST /conversations/stream
+        """
+        prompt = (await request.body()).decode("utf-8")
+        async with self.pool.backend_async() as gpt:
+            await self._prepare_backend_from_request(gpt, request)
+            stream = self._start_stream(gpt, prompt)
+
+            async def stop_on_disconnect():
+                while (await request.receive())["type"] != "http.disconnect":
+                    pass
+                await stream.aclose()
+
+            watcher = asyncio.ensure_future(stop_on_disconnect())
+            try:
+                await self._start_response(send, content_type="text/event-stream", headers={
+                    "Cache-Control": "no-cache",
+                    # Stops reverse proxies like nginx from buffering the stream.
+                    "X-Accel-Buffering": "no",
+                })
+                await send({"type": "http.response.body", "body": b": stream started\n\n", "more_body": True})
+                async for token in stream:
+                    await send({"type": "http.response.body", "body": format_sse("token", token).encode("utf-8"), "more_body": True})
+                success, _response, user_message = await stream.wait()
+                if success:
+                    event = format_sse("done", {"success": True, "conversation_id": gpt.conversation_id, "parent_message_id": gpt.parent_message_id})
+                else:
+                    event = format_sse("done", {"success": False, "error": str(user_message)})
+                await send({"type": "http.response.body", "body": event.encode("utf-8")})
+            finally:
+                watcher.cancel()
+                await stream.aclose()
+
+    async def new_conversation(self, request, send):
+        """
+        Start a new conversation for a user.
+
+        Path:
+            POST /conversations/new
+        """
+        data = await request.json() or {}
+        async with self.pool.backend_async() as gpt:
+            await self._prepare_backend_from_request(gpt, request)
+            if gpt.current_user:
+                try:
+                    await self.pool.run_in_thread(gpt.create_new_conversation_if_needed, title=data.get("title"))
+                except Exception as e:
+                    await self._error_handler(send, e)
+                    return
+            await self._respond_json(send, {"success": True, "conversation_id": gpt.conversation_id, "parent_message_id": gpt.parent_message_id})
+
+    async def delete_conversation(self, request, send, conversation_id):
+        """
+        Delete a conversation.
+
+        Path:
+            DELETE /conversations/:conversation_id
+
+        Query Parameters:
+            user_id (int): The user the conversation belongs to.
+        """
+        conversation_id = int(conversation_id)
+        async with self.pool.backend_async() as gpt:
+            await self._prepare_conversation_owner(gpt, request, conversation_id)
+            success, result, user_message = await self.pool.run_in_thread(gpt.delete_conversation, conversation_id)
+        if success:
+            await self._respond(send, user_message, content_type="text/plain; charset=utf-8")
+        else:
+            await self._error_handler(send, user_message)
+
+    async def set_title(self, request, send, conversation_id):
+        """
+        Set the title of a conversation.
+
+        Path:
+            PATCH /conversations/:conversation_id/set-title
+
+        Query Parameters:
+            user_id (int): The user the conversation belongs to.
+        """
+        conversation_id = int(conversation_id)
+        data = await request.json() or {}
+        if "title" not in data:
+            raise RequestError("Missing title")
+
+        def set_title(gpt):
+            success, conversation, user_message = gpt.set_title(data["title"], conversation_id)
+            return gpt.conversation.orm.object_as_dict(conversation) if success else None
+
+        async with self.pool.backend_async() as gpt:
+            await self._prepare_conversation_owner(gpt, request, conversation_id)
+            conversation = await self.pool.run_in_thread(set_title, gpt)
+        if conversation:
+            await self._respond_json(send, conversation)
+        else:
+            await self._error_handler(send, "Failed to set title")
+
+    async def get_history(self, request, send, user_id):
+        """
+        Retrieve conversation history for a user, paged by the X-Next-Cursor
+        response header.
+
+        Path:
+            GET /history/:user_id
+        """
+        limit = request.arg("limit", 20, type=int)
+        offset = request.arg("offset", 0, type=int)
+        cursor = request.arg("cursor")
+        async with self.pool.backend_async() as gpt:
+            success, result, user_message = await self.pool.run_in_thread(gpt.get_history, limit=limit, offset=offset, user_id=int(user_id), cursor=cursor)
+            next_cursor = gpt.get_history_next_cursor(result, limit) if success and result else None
+        if cursor and not success:
+            await self._error_handler(send, user_message, 400)
+        elif result:
+            await self._respond_json(send, result, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
+        else:
+            await self._error_handler(send, "Failed to get history")
+
+    async def handle_websocket(self, scope, receive, send):
+        """
+        Chat over a WebSocket.
+
+        Path:
+            /conversations/ws
+
+        Query Parameters:
+            user_id (int, optional): Save the exchanges to this user's conversations.
+            conversation_id (int, optional): Continue this conversation of the user,
+                a new one is started by the first prompt without it.
+
+        Client messages:
+            {"prompt": "Some text", "conversation_id": 1, "parent_message_id": 2}
+                Ask a question, conversation_id and parent_message_id are
+                optional, by default the conversation of the last response
+                is continued.
+            {"type": "stop"}
+                Stop generating the current response.
+
+        Server messages:
+            {"type": "token", "token": "Some"}
+            {"type": "done", "success": true, "conversation_id": 1, "parent_message_id": 2}
+            {"type": "done", "success": false, "error": "Some error"}
+            {"type": "error", "error": "Some error"}
+                A message was rejected.
+
+        One response is generated at a time. A connection only holds a
+        backend while generating.
+        """
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        request = Request(scope, receive)
+        if request.path != "/conversations/ws" or self.draining:
+            # Closing before accepting rejects the connection.
+            await send({"type": "websocket.close", "code": 1008 if not self.draining else 1001})
+            return
+        try:
+            user_id = request.arg("user_id", type=int)
+            conversation_id = request.arg("conversation_id", type=int)
+        except RequestError:
+            await send({"type": "websocket.close", "code": 1008})
+            return
+        await send({"type": "websocket.accept"})
+        connection = WebSocketConnection(send, conversation_id)
+        self.websockets.add(connection)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message["type"] != "websocket.receive":
+                    continue
+                try:
+                    data = json.loads(message.get("text") or message.get("bytes") or "")
+                    if not isinstance(data, dict):
+                        raise ValueError()
+                except ValueError:
+                    await connection.send_json({"type": "error", "error": "Messages must be JSON objects"})
+                    continue
+                if data.get("type") == "stop":
+                    await connection.stop()
+                elif connection.generating():
+                    await connection.send_json({"type": "error", "error": "A response is already being generated"})
+                elif self.draining:
+                    await connection.send_json({"type": "error", "error": SHUTTING_DOWN_MESSAGE})
+                elif not data.get("prompt"):
+                    await connection.send_json({"type": "error", "error": "Missing prompt"})
+                else:
+                    connection.generation = asyncio.ensure_future(self._websocket_generate(
+                        connection,
+                        data["prompt"],
+                        user_id,
+                        data.get("conversation_id", connection.conversation_id),
+                        data.get("parent_message_id"),
+                    ))
+        finally:
+            self.websockets.discard(connection)
+            connection.closed = True
+            if connection.generating():
+                connection.generation.cancel()
+                await asyncio.gather(connection.generation, return_exceptions=True)
+
+    async def _websocket_generate(self, connection, prompt, user_id, conversation_id, parent_message_id):
+        try:
+            async with self.pool.backend_async() as gpt:
+                await self._prepare_backend(gpt, user_id, conversation_id, parent_message_id)
+                connection.stream = self._start_stream(gpt, prompt)
+                try:
+                    async for token in connection.stream:
+                        await connection.send_json({"type": "token", "token": token})
+                finally:
+                    await connection.stream.aclose()
+                success, _response, user_message = connection.stream.result
+                if success:
+                    connection.conversation_id = gpt.conversation_id
+                    await connection.send_json({"type": "done", "success": True, "conversation_id": gpt.conversation_id, "parent_message_id": gpt.parent_message_id})
+                else:
+                    await connection.send_json({"type": "done", "success": False, "error": str(user_message)})
+        except (RequestError, BackendPoolTimeoutError) as e:
+            await connection.send_json({"type": "error", "error": str(e)})
+        finally:
+            connection.stream = None
+            if self.draining:
+                await connection.close(1001)
+
+
+def create_asgi_application(config=None, pool_size=None, drain_timeout=None):
+    """Create the ASGI API server, serve it with any ASGI server, for example uvicorn."""
+    return AsgiApplication(config, pool_size=pool_size, drain_timeout=drain_timeout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--pool-size", type=int, help="Responses generated at once, defaults to the api_server.pool_size setting")
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The ASGI server needs uvicorn, install it with the asgi extra: pip install 'chatGPT[asgi]'")
+    app = create_asgi_application(pool_size=args.pool_size)
+    uvicorn.run(app, host="0.0.0.0", port=args.port, lifespan="on", timeout_graceful_shutdown=app.drain_timeout)
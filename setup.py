@@ -24,6 +24,12 @@ setup(
     url="https://github.com/mmabrouk/chatgpt-wrapper",
     packages=find_packages(),
     install_requires=install_requirement,
+    extras_require={
+        # The ASGI API server, chatgpt_wrapper/gpt_asgi.py.
+        "asgi": ["uvicorn[standard]>=0.24"],
+        # Parquet and Arrow conversation archives, chatgpt_wrapper/backends/openai/archive.py.
+        "archive": ["pyarrow>=8.0"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import pytest
+
+from langchain.schema import AIMessage, ChatGeneration, LLMResult
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+from chatgpt_wrapper.backends.openai.database import Database
+from chatgpt_wrapper.backends.openai.orm import engine_registry
+import chatgpt_wrapper.core.util as util
+
+TEST_DIR = os.path.join(tempfile.gettempdir(), 'chatgpt_wrapper_test')
+TEST_CONFIG_DIR = os.path.join(TEST_DIR, 'config')
+TEST_DATA_DIR = os.path.join(TEST_DIR, 'data')
+TEST_PROFILE = 'test'
+
+
+class FakeEncoding:
+    """Whitespace tokenizer standing in for tiktoken, which needs network access to load encodings."""
+
+    def __init__(self):
+        self.encode_calls = 0
+
+    def encode(self, text):
+        self.encode_calls += 1
+        return text.split()
+
+    def encode_batch(self, texts, num_threads=8):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture
+def test_config():
+    engine_registry.dispose()
+    util.remove_and_create_dir(TEST_CONFIG_DIR)
+    util.remove_and_create_dir(TEST_DATA_DIR)
+    config = Config(TEST_CONFIG_DIR, TEST_DATA_DIR, profile=TEST_PROFILE)
+    return config
+
+
+@pytest.fixture
+def encoding():
+    return FakeEncoding()
+
+
+def make_backend(config, encoding, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    Database(config).create_schema()
+    monkeypatch.setattr(OpenAIAPI, 'get_token_encoding', lambda self, model=None: encoding)
+    gpt = OpenAIAPI(config)
+    success, user, user_message = gpt.user_manager.register('test', None, None)
+    assert success, user_message
+    gpt.set_current_user(user)
+    return gpt
+
+
+@pytest.fixture
+def backend(test_config, encoding, monkeypatch):
+    return make_backend(test_config, encoding, monkeypatch)
+
+
+@pytest.fixture
+def cached_backend(test_config, encoding, monkeypatch):
+    # Restored after the test, the config shares nested defaults.
+    monkeypatch.setitem(test_config.get('database_options.cache'), 'max_conversations', 128)
+    return make_backend(test_config, encoding, monkeypatch)
+
+
+def add_conversation(backend, count):
+    conversation = backend.create_new_conversation_if_needed(title='Test')
+    backend.add_message('system', 'You are a helpful assistant.')
+    for i in range(count):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        backend.add_message(role, f'message number {i}')
+    return conversation
+
+
+class FakeCompletion:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChatLLM:
+    """Stands in for ChatOpenAI, streaming each word of its reply as a token."""
+
+    reply = 'Hello there, how can I help?'
+    tokens_sent = 0
+
+    def __init__(self, streaming=False, callback_manager=None, **kwargs):
+        self.streaming = streaming
+        self.callback_manager = callback_manager
+
+    def tokens(self):
+        return [word if i == 0 else ' ' + word for i, word in enumerate(self.reply.split(' '))]
+
+    def __call__(self, messages):
+        for token in self.tokens():
+            if self.streaming:
+                FakeChatLLM.tokens_sent += 1
+                self.callback_manager.on_llm_new_token(token, verbose=True)
+        return FakeCompletion(self.reply)
+
+    async def agenerate(self, messages_list):
+        for token in self.tokens():
+            if self.streaming:
+                FakeChatLLM.tokens_sent += 1
+                await self.callback_manager.on_llm_new_token(token, verbose=True)
+        return LLMResult(generations=[[ChatGeneration(message=AIMessage(content=self.reply))]])
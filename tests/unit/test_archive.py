@@ -0,0 +1,50 @@
+import json
+import pytest
+
+from sqlalchemy.exc import IntegrityError
+from chatgpt_wrapper.backends.openai.archive import Archive
+
+from conftest import add_conversation
+
+
+@pytest.mark.parametrize('archive_format', ['jsonl', 'parquet', 'arrow'])
+def test_archive_export_import(backend, tmp_path, archive_format):
+    if archive_format != 'jsonl':
+        pytest.importorskip('pyarrow')
+    add_conversation(backend, 5)
+    backend.new_conversation()
+    backend.create_new_conversation_if_needed(title='Empty')
+    user = backend.current_user
+    archive = Archive(backend.config)
+    path = str(tmp_path / f'export.{archive_format}')
+    assert archive.export(user, path, batch_size=4) == 7
+    success, other_user, _ = backend.user_manager.register('other', None, None)
+    assert archive.import_archive(other_user, path, batch_size=4) == (2, 6)
+    original = list(archive.iter_rows(user))
+    imported = list(archive.iter_rows(other_user))
+    ignored = {'conversation_id', 'message_id'}
+    assert [{k: v for k, v in r.items() if k not in ignored} for r in imported] == [{k: v for k, v in r.items() if k not in ignored} for r in original]
+
+
+def test_archive_failed_import_rolls_back(backend, tmp_path):
+    add_conversation(backend, 5)
+    archive = Archive(backend.config)
+    path = str(tmp_path / 'export.jsonl')
+    archive.export(backend.current_user, path)
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    # The last batch has a message that cannot be stored.
+    rows[-1]['role'] = None
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(row) + "\n" for row in rows)
+    success, other_user, _ = backend.user_manager.register('other', None, None)
+    with pytest.raises(IntegrityError):
+        archive.import_archive(other_user, path, batch_size=2)
+    assert list(archive.iter_rows(other_user)) == []
+    # Conversations added between imports do not collide with imported ids.
+    success, conversation, _ = backend.conversation.add_conversation(other_user.id, 'Between imports')
+    rows[-1]['role'] = 'assistant'
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(row) + "\n" for row in rows)
+    assert archive.import_archive(other_user, path, batch_size=2) == (1, 6)
+    assert len({row['conversation_id'] for row in archive.iter_rows(other_user)}) == 2
@@ -0,0 +1,54 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+
+from chatgpt_wrapper.core.config import Config
+import chatgpt_wrapper.core.util as util
+from chatgpt_wrapper.backends.browser.chatgpt import ChatGPT
+
+TEST_DIR = os.path.join(tempfile.gettempdir(), 'chatgpt_wrapper_test')
+TEST_CONFIG_DIR = os.path.join(TEST_DIR, 'config')
+TEST_DATA_DIR = os.path.join(TEST_DIR, 'data')
+TEST_PROFILE = 'test'
+
+
+def test_ask_stream_async_reads_page_on_browser_thread(monkeypatch):
+    util.remove_and_create_dir(TEST_CONFIG_DIR)
+    util.remove_and_create_dir(TEST_DATA_DIR)
+    gpt = ChatGPT(Config(TEST_CONFIG_DIR, TEST_DATA_DIR, profile=TEST_PROFILE))
+    requests = []
+
+    def fake_ask_stream(prompt, title=None, model_customizations={}):
+        requests.append((prompt, title, threading.current_thread().name))
+        for token in ['Hello', ' there']:
+            # Polls the page like the real generator.
+            time.sleep(0.1)
+            yield token
+
+    monkeypatch.setattr(gpt, '_ask_stream', fake_ask_stream)
+
+    async def ask():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        stream = gpt.ask_stream_async('Hi', title='Greeting')
+        tokens = [token async for token in stream]
+        ticker.cancel()
+        return tokens, await stream.wait(), ticks
+
+    tokens, result, ticks = asyncio.run(ask())
+    assert tokens == ['Hello', ' there']
+    assert result == (True, 'Hello there', 'Response received')
+    # The event loop kept running while the page was polled.
+    assert ticks > 5
+    assert requests[0][:2] == ('Hi', 'Greeting')
+    assert requests[0][2].startswith('chatgpt-browser')
+    gpt.browser_executor.shutdown()
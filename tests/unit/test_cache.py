@@ -0,0 +1,90 @@
+
+from sqlalchemy import event
+from chatgpt_wrapper.backends.openai.cache import ConversationCache
+from chatgpt_wrapper.backends.openai.context import REPLY_PRIMING_TOKENS
+from chatgpt_wrapper.backends.openai.orm import SqliteOrm, Conversation, Message, EngineRegistry
+import chatgpt_wrapper.backends.openai.orm as orm_module
+
+from conftest import add_conversation
+
+
+def test_conversation_cache():
+    cache = ConversationCache(max_conversations=2, window_messages=3)
+    messages = [Message(id=i, conversation_id=1, role='user', message=str(i), prompt_tokens=i % 2, completion_tokens=0) for i in range(1, 5)]
+    cache.put_window(1, messages, True)
+    assert cache.get_window(1) == (messages[-3:], False)
+    assert cache.get_totals(1) == (2, 2)
+    cache.append_messages(1, [Message(id=5, conversation_id=1, role='user', message='5', prompt_tokens=1, completion_tokens=0)])
+    assert [m.id for m in cache.get_window(1)[0]] == [3, 4, 5]
+    assert cache.get_totals(1) == (3, 2)
+    cache.update_token_counts([dict(id=4, prompt_tokens=2, completion_tokens=0)])
+    assert cache.get_totals(1) == (5, 1)
+    cache.update_token_counts([dict(id=2, prompt_tokens=1, completion_tokens=0)])
+    assert cache.get_totals(1) == (None, None)
+    cache.add_conversation(Conversation(id=2))
+    cache.add_conversation(Conversation(id=3))
+    assert cache.get_window(1) is None
+    assert cache.get_conversation(2).id == 2
+    assert cache.get_conversation(1) is None
+    assert cache.stats()['evictions'] == 1
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+    generation = cache.generation
+    cache.invalidate(2)
+    cache.put_conversation(Conversation(id=2), generation)
+    assert cache.get_conversation(2) is None
+
+
+def test_conversation_cache_steady_state_turn(cached_backend):
+    backend = cached_backend
+    conversation = add_conversation(backend, 4)
+    backend.conversation_id = conversation.id
+    engine = backend.message.orm.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement.split()[0])
+    for prompt in ['first', 'second']:
+        statements.clear()
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            new_messages, messages = backend._prepare_ask_request(prompt)
+            success, conversation, _ = backend._ask_request_post(None, new_messages, f'{prompt} response')
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        assert success
+        assert messages[-1]['content'] == prompt
+    assert statements and set(statements) <= {'INSERT', 'UPDATE'}
+    assert backend.message.orm.cache.stats()['hits'] > 0
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    assert [m.message for m in messages[-2:]] == ['second', 'second response']
+    assert backend.get_conversation_token_count() == backend._get_stored_token_count(conversation.id) + REPLY_PRIMING_TOKENS
+
+
+def test_conversation_cache_invalidation(cached_backend):
+    backend = cached_backend
+    conversation = add_conversation(backend, 2)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    backend.message.edit_message(messages[-1].id, role='user')
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    assert messages[-1].role == 'user'
+    backend.message.delete_message(messages[-1].id)
+    success, count, _ = backend.message.get_message_count(conversation.id)
+    assert count == 2
+    backend.set_title('Renamed', conversation.id)
+    success, cached, _ = backend.conversation.get_conversation(conversation.id)
+    assert cached.title == 'Renamed'
+    backend.delete_conversation(conversation.id)
+    success, _, message = backend.conversation.get_conversation(conversation.id)
+    assert not success
+
+
+def test_storage_sees_writes_from_other_processes(backend, monkeypatch):
+    assert backend.message.orm.cache is None
+    conversation = add_conversation(backend, 1)
+    assert backend.message.get_last_messages(conversation.id, limit=1)[1][-1].message == 'message number 0'
+    # Another process has an engine and cache of its own.
+    monkeypatch.setattr(orm_module, 'engine_registry', EngineRegistry())
+    other = SqliteOrm(backend.config)
+    other.add_message(other.get_conversation(conversation.id), 'assistant', 'from another process')
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    assert [m.message for m in messages][1:] == ['message number 0', 'from another process']
+    assert backend.message.get_last_messages(conversation.id, limit=1)[1][-1].message == 'from another process'
+    other.engine.dispose()
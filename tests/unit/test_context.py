@@ -0,0 +1,50 @@
+import pytest
+
+from chatgpt_wrapper.backends.openai.context import REPLY_PRIMING_TOKENS, strip_messages_over_max_tokens
+
+
+def make_messages(count, system=True):
+    messages = []
+    if system:
+        messages.append({'role': 'system', 'content': 'system'})
+    for i in range(count):
+        messages.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': str(i)})
+    return messages
+
+
+def test_strip_messages_under_max_tokens():
+    messages = make_messages(4)
+    token_counts = [10] * len(messages)
+    kept, token_count, stripped = strip_messages_over_max_tokens(messages, token_counts, 1000)
+    assert kept == messages
+    assert token_count == 50 + REPLY_PRIMING_TOKENS
+    assert stripped == []
+
+
+def test_strip_messages_preserves_system_message():
+    messages = make_messages(6)
+    token_counts = [10] * len(messages)
+    kept, token_count, stripped = strip_messages_over_max_tokens(messages, token_counts, 30 + REPLY_PRIMING_TOKENS)
+    assert kept == [messages[0]] + messages[-2:]
+    assert token_count == 30 + REPLY_PRIMING_TOKENS
+    assert stripped == messages[1:5]
+
+
+def test_strip_messages_without_preserving_system_message():
+    messages = make_messages(3)
+    token_counts = [10] * len(messages)
+    kept, _, stripped = strip_messages_over_max_tokens(messages, token_counts, 20 + REPLY_PRIMING_TOKENS, preserve_system_message=False)
+    assert kept == messages[-2:]
+    assert stripped == messages[:2]
+
+
+def test_strip_messages_still_over_max_tokens():
+    messages = make_messages(2)
+    token_counts = [10, 10, 100]
+    with pytest.raises(Exception, match="still over max submission tokens"):
+        strip_messages_over_max_tokens(messages, token_counts, 50)
+
+
+def test_strip_messages_length_mismatch():
+    with pytest.raises(ValueError):
+        strip_messages_over_max_tokens(make_messages(2), [1], 50)
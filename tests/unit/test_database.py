@@ -0,0 +1,41 @@
+
+from chatgpt_wrapper.backends.openai.database import Database, DatabaseDevel, build_parser
+import chatgpt_wrapper.backends.openai.tokens as tokens
+
+from conftest import add_conversation
+
+
+def test_backfill_token_counts(backend, encoding, monkeypatch):
+    conversation = add_conversation(backend, 2)
+    for i in range(3):
+        backend.message.add_message(conversation.id, 'user', f'legacy row {i}')
+    monkeypatch.setattr(tokens.encoding_registry, 'get', lambda model: (encoding, True))
+    database = Database(backend.config)
+    assert database.backfill_token_counts(batch_size=2) == 3
+    assert database.backfill_token_counts() == 0
+    success, missing, _ = backend.message.get_messages_without_token_counts(conversation.id)
+    assert missing == []
+
+
+def test_bulk_test_data(backend, encoding, monkeypatch):
+    monkeypatch.setattr(tokens.encoding_registry, 'get', lambda model: (encoding, True))
+    args = build_parser().parse_args(['-t', '--bulk', '-u', '2', '-n', '3', '-m', '5', '--chunk-size', '4', '--roles', 'system,user,assistant', '--count-tokens', '--seed', '1'])
+    database = DatabaseDevel(backend.config, args)
+    assert database.create_bulk_test_data() == 30
+    users = [u for u in database.orm.get_users() if u.username != 'test']
+    assert len(users) == 2
+    conversations = database.orm.get_conversations(users[0])
+    assert len(conversations) == 3
+    messages = database.orm.get_messages(conversations[0])
+    assert [m.role for m in messages] == ['system', 'user', 'assistant', 'system', 'user']
+    success, missing, _ = backend.message.get_messages_without_token_counts(conversations[0].id)
+    assert missing == []
+
+
+def test_search_index_backfill(backend):
+    database = Database(backend.config)
+    database.drop_search_index()
+    add_conversation(backend, 2)
+    assert database.create_search_index()
+    success, results, _ = backend.message.search_messages(backend.current_user.id, 'number')
+    assert len(results) == 2
@@ -0,0 +1,57 @@
+import threading
+import asyncio
+import openai
+from openai import api_requestor
+
+from chatgpt_wrapper.backends.openai.http_sessions import HttpSessionRegistry
+
+
+
+def test_openai_thread_context_is_available():
+    # HttpSessionRegistry.install() relies on this private attribute, which
+    # openai reads the session for synchronous requests from.
+    assert isinstance(api_requestor._thread_context, threading.local)
+
+
+def test_http_sessions_follow_openai_proxy(monkeypatch):
+    registry = HttpSessionRegistry()
+    monkeypatch.setattr(openai, 'proxy', None)
+    assert registry.get_session().proxies == {}
+    monkeypatch.setattr(openai, 'proxy', 'http://proxy:3128')
+    assert registry.get_session().proxies == {'http': 'http://proxy:3128', 'https': 'http://proxy:3128'}
+    monkeypatch.setattr(openai, 'proxy', {'https': 'http://secure-proxy:3128'})
+    assert registry.get_session().proxies == {'https': 'http://secure-proxy:3128'}
+    registry.close()
+
+
+def test_http_sessions_share_connection_pool():
+    registry = HttpSessionRegistry()
+    sessions = []
+
+    def request_thread():
+        registry.install()
+        sessions.append(api_requestor._thread_context.session)
+
+    threads = [threading.Thread(target=request_thread) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A session per thread, sharing one pooled adapter.
+    assert sessions[0] is not sessions[1]
+    assert sessions[0].get_adapter('https://api.openai.com') is sessions[1].get_adapter('https://api.openai.com') is registry.get_adapter()
+    assert registry.get_session() is registry.get_session()
+    registry.close()
+    assert registry.get_adapter() is not sessions[0].get_adapter('https://api.openai.com')
+
+    async def loop_session():
+        registry.install_async()
+        assert openai.aiosession.get() is None
+        session = await registry.open_async()
+        assert await registry.open_async() is session
+        registry.install_async()
+        assert openai.aiosession.get() is session
+        await registry.close_async()
+        return session
+
+    assert asyncio.run(loop_session()).closed
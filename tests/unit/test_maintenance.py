@@ -0,0 +1,62 @@
+import json
+import time
+import datetime
+
+from sqlalchemy import select, update
+from chatgpt_wrapper.backends.openai.maintenance import Maintenance, MaintenanceScheduler
+from chatgpt_wrapper.backends.openai.orm import Conversation, Message
+
+from conftest import add_conversation
+
+
+def test_maintenance_purge(backend, tmp_path):
+    old = add_conversation(backend, 2)
+    backend.new_conversation()
+    hidden = add_conversation(backend, 2)
+    backend.new_conversation()
+    kept = add_conversation(backend, 2)
+    orm = backend.conversation.orm
+    with orm.engine.begin() as conn:
+        conn.execute(update(Conversation).where(Conversation.id == old.id).values(updated_time=datetime.datetime.now() - datetime.timedelta(days=30)))
+        conn.execute(update(Conversation).where(Conversation.id == hidden.id).values(hidden=True))
+    purged_ids = {old.id, hidden.id}
+    maintenance = Maintenance(backend.config, orm)
+    policy = maintenance.get_policy(max_age_days=7, purge_hidden=True, archive_directory=str(tmp_path))
+    assert maintenance.count_purgeable(policy) == 2
+    assert maintenance.purge(policy, batch_size=1) == 2
+    with orm.engine.connect() as conn:
+        assert [row.id for row in conn.execute(select(Conversation.id))] == [kept.id]
+        assert {row.conversation_id for row in conn.execute(select(Message.conversation_id))} == {kept.id}
+    archived = [json.loads(line) for path in tmp_path.iterdir() for line in path.read_text().splitlines()]
+    assert {row['conversation_id'] for row in archived} == purged_ids
+    assert len(archived) == 6
+
+
+def test_maintenance_quota_and_compact(backend):
+    conversations = []
+    for i in range(3):
+        backend.new_conversation()
+        conversations.append(add_conversation(backend, 200))
+    kept_id = conversations[-1].id
+    maintenance = Maintenance(backend.config, backend.conversation.orm)
+    report = maintenance.run(maintenance.get_policy(max_conversations_per_user=1))
+    assert report['purged'] == 2
+    assert report['reclaimed'] > 0
+    assert report['free'] == 0
+    with backend.conversation.orm.engine.connect() as conn:
+        assert [row.id for row in conn.execute(select(Conversation.id))] == [kept_id]
+
+
+def test_maintenance_scheduler(backend):
+    maintenance = Maintenance(backend.config, backend.conversation.orm)
+    scheduler = MaintenanceScheduler(maintenance, 0.01)
+    scheduler.start()
+    try:
+        for _ in range(100):
+            if scheduler.last_report:
+                break
+            time.sleep(0.01)
+    finally:
+        scheduler.stop(timeout=5)
+    assert scheduler.last_report['purged'] == 0
+    assert not scheduler.thread.is_alive()
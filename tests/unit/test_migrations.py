@@ -0,0 +1,98 @@
+import datetime
+
+from sqlalchemy import inspect, insert, select, update
+from sqlalchemy import MetaData, Table, ForeignKey, Index, Column, Integer, String, DateTime, Boolean
+from chatgpt_wrapper.backends.openai.database import Database
+from chatgpt_wrapper.backends.openai import migrations
+from chatgpt_wrapper.backends.openai.orm import Base, Conversation, Message
+
+from conftest import add_conversation
+
+
+def test_schema_migrations_match_models(backend):
+    database = Database(backend.config)
+    assert database.migrations.get_version() == migrations.MIGRATIONS[-1].version
+    assert database.create_schema() == []
+    inspector = inspect(backend.conversation.orm.engine)
+    for table in Base.metadata.sorted_tables:
+        assert {c['name'] for c in inspector.get_columns(table.name)} == {c.name for c in table.columns}
+        assert {i['name'] for i in inspector.get_indexes(table.name)} == {i.name for i in table.indexes}
+
+
+def test_schema_migrations_upgrade_legacy_database(test_config):
+    database = Database(test_config)
+    engine = database.orm.engine
+    migrations.v1.create_all(bind=engine)
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        conn.execute(insert(migrations.v1_user).values(id=1, username='legacy', default_model='default', created_time=now, preferences={}))
+        conn.execute(insert(migrations.v1_conversation).values(id=1, user_id=1, model='default', created_time=now, updated_time=now, hidden=False))
+        conn.execute(insert(migrations.v1_message).values(conversation_id=1, role='user', message='an upgraded message', created_time=now, prompt_tokens=0, completion_tokens=0))
+    assert database.migrations.get_version() == 0
+    assert database.schema_exists()
+    dry_run = database.create_schema(dry_run=True)
+    assert [m.version for m, _ in dry_run] == [1, 2, 3, 4, 5, 6]
+    assert dry_run[0][1] == []
+    assert any('message_conversation_id_id_idx' in statement for statement in dry_run[2][1])
+    assert database.migrations.get_version() == 0
+    assert [m.version for m, _ in database.create_schema()] == [1, 2, 3, 4, 5, 6]
+    assert database.migrations.get_version() == 6
+    user = database.orm.get_users()[0]
+    assert [m.snippet for m in database.orm.search_messages(user, 'upgraded', highlight=('', ''))] == ['an upgraded message']
+
+
+def test_schema_migrations_rebuild_table(backend):
+    add_conversation(backend, 2)
+
+    class NotNullTitle(migrations.Migration):
+        version = 7
+        name = 'not_null_title'
+
+        def upgrade(self, migrator):
+            metadata = MetaData()
+            migrations.v1_user.to_metadata(metadata)
+            table = Table(
+                'conversation', metadata,
+                Column('id', Integer, primary_key=True),
+                Column('user_id', Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False),
+                Column('title', String, nullable=False),
+                Column('model', String, nullable=False),
+                Column('created_time', DateTime, nullable=False),
+                Column('updated_time', DateTime, nullable=False),
+                Column('hidden', Boolean, nullable=False),
+                *[Index(i.name, *[c.name for c in i.columns]) for i in migrations.v1_conversation.indexes],
+            )
+            migrator.rebuild_table(table, {'title': "coalesce(title, 'Untitled')"})
+            migrator.add_column('message', Column('source', String, nullable=False, server_default='chat'))
+
+    orm = backend.conversation.orm
+    with orm.engine.begin() as conn:
+        conn.execute(update(Conversation).values(title=None))
+    schema_migrations = migrations.SchemaMigrations(backend.config, orm, migrations.MIGRATIONS + [NotNullTitle])
+    assert schema_migrations.get_pending()[0].name == 'not_null_title'
+    schema_migrations.upgrade()
+    assert schema_migrations.get_version() == 7
+    inspector = inspect(orm.engine)
+    assert not {c['name']: c for c in inspector.get_columns('conversation')}['title']['nullable']
+    assert {i['name'] for i in inspector.get_indexes('conversation')} == {i.name for i in migrations.v1_conversation.indexes}
+    with orm.engine.connect() as conn:
+        assert [row.title for row in conn.execute(select(Conversation.title))] == ['Untitled']
+        assert conn.execute(Table('message', MetaData(), Column('source', String)).select()).scalars().all() == ['chat'] * 3
+    # Foreign keys into the rebuilt table still cascade.
+    backend.conversation.delete_conversation(backend.conversation_id)
+    with orm.engine.connect() as conn:
+        assert conn.execute(select(Message.id)).first() is None
+
+
+def test_schema_migrations_dry_run_changes_nothing(test_config):
+    database = Database(test_config)
+    engine = database.orm.engine
+    assert not database.schema_exists()
+    dry_run = database.create_schema(dry_run=True)
+    assert [m.version for m, _ in dry_run] == [m.version for m in migrations.MIGRATIONS]
+    assert any(statement.strip().startswith('CREATE TABLE conversation') for statement in dry_run[0][1])
+    assert database.migrations.get_version() == 0
+    assert inspect(engine).get_table_names() == []
+    assert not database.schema_exists()
+    # The statements are what a real run applies.
+    assert [statements for _, statements in database.create_schema()] == [statements for _, statements in dry_run]
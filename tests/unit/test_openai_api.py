@@ -0,0 +1,479 @@
+import os
+import shutil
+import subprocess
+import threading
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+from sqlalchemy import event, update
+from sqlalchemy.dialects.postgresql import pg8000
+from chatgpt_wrapper.core.config import Config
+from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+import chatgpt_wrapper.backends.openai.api as api
+from chatgpt_wrapper.core.llm_cache import llm_client_cache
+from chatgpt_wrapper.backends.openai.database import Database
+from chatgpt_wrapper.backends.openai.archive import Archive
+from chatgpt_wrapper.backends.openai.orm import Orm, SqliteOrm, PostgresOrm, Message, engine_registry, get_storage_class
+import chatgpt_wrapper.backends.openai.tokens as tokens
+
+from conftest import TEST_CONFIG_DIR, TEST_DATA_DIR, TEST_PROFILE, FakeEncoding, FakeCompletion, FakeChatLLM, add_conversation
+
+
+def test_get_num_tokens_from_messages(backend):
+    messages = [
+        backend.build_openai_message('system', 'one two'),
+        backend.build_openai_message('user', 'three'),
+    ]
+    # 4 per message, 1 token per role, content tokens, plus 2 for reply priming.
+    assert backend.get_num_tokens_from_messages(messages) == (4 + 1 + 2) + (4 + 1 + 1) + 2
+
+
+def test_add_message_stores_token_count(backend):
+    conversation = add_conversation(backend, 2)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    assert success
+    for m in messages:
+        expected = backend.get_num_tokens_from_message(backend.build_openai_message(m.role, m.message))
+        if m.role == 'assistant':
+            assert (m.prompt_tokens, m.completion_tokens) == (0, expected)
+        else:
+            assert (m.prompt_tokens, m.completion_tokens) == (expected, 0)
+
+
+def test_conversation_token_count_does_not_retokenize(backend, encoding):
+    conversation = add_conversation(backend, 20)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    expected = backend.get_num_tokens_from_messages(backend.prepare_prompt_messsage_context(messages))
+    backend.message_token_counts = {}
+    encoding.encode_calls = 0
+    assert backend.get_conversation_token_count(conversation.id) == expected
+    assert backend.get_stored_message_token_counts(messages)
+    assert encoding.encode_calls == 0
+
+
+def test_conversation_token_count_backfills_uncounted_messages(backend, encoding):
+    conversation = add_conversation(backend, 4)
+    backend.message.add_message(conversation.id, 'user', 'legacy row without counts')
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    expected = backend.get_num_tokens_from_messages(backend.prepare_prompt_messsage_context(messages))
+    assert backend.get_conversation_token_count(conversation.id) == expected
+    success, missing, _ = backend.message.get_messages_without_token_counts(conversation.id)
+    assert missing == []
+
+
+def test_keep_last_context_strategy(backend):
+    add_conversation(backend, 10)
+    backend.config.set('chat.model_customizations.context_strategy.keep_last.messages', 4)
+    backend.set_model_context_strategy('keep_last')
+    _new_messages, messages = backend._prepare_ask_request('new prompt')
+    assert [m['role'] for m in messages] == ['system', 'assistant', 'user', 'assistant', 'user']
+    assert messages[-1]['content'] == 'new prompt'
+
+
+def test_edit_message_recounts_tokens(backend):
+    conversation = add_conversation(backend, 3)
+    backend.switch_to_conversation(conversation.id, None)
+    _new_messages, messages = backend._prepare_ask_request('new prompt')
+    success, old_messages, _ = backend.message.get_messages(conversation.id)
+    edited = old_messages[1]
+    old_count = backend.get_stored_message_token_counts([edited])[0]
+    content = ' '.join(['word'] * 20)
+    expected_count = backend.get_num_tokens_from_message(backend.build_openai_message(edited.role, content))
+    success, message, _ = backend.edit_message(edited.id, message=content)
+    assert success
+    assert backend.conversation_tokens == backend.get_conversation_token_count(conversation.id)
+    _new_messages, edited_messages = backend._prepare_ask_request('new prompt')
+    assert edited_messages[1]['content'] == content
+    success, old_messages, _ = backend.message.get_messages(conversation.id)
+    assert old_messages[1].prompt_tokens + old_messages[1].completion_tokens == expected_count
+    assert backend.get_stored_message_token_counts([old_messages[1]]) == [expected_count]
+    assert expected_count != old_count
+    assert backend.get_num_tokens_from_messages(edited_messages) == backend.get_num_tokens_from_messages(messages) + expected_count - old_count
+
+
+def test_rolling_summary_context_strategy_reuses_summary(backend, monkeypatch):
+    conversation = add_conversation(backend, 20)
+    summary_calls = []
+
+    def call_openai_non_streaming(messages, **kwargs):
+        summary_calls.append(messages)
+        return True, FakeCompletion('short summary'), "Response received"
+
+    monkeypatch.setattr(backend, '_call_openai_non_streaming', call_openai_non_streaming)
+    backend.set_model_context_strategy('rolling_summary')
+    backend.set_model_max_submission_tokens(60)
+    backend.context_strategy.config['max_summary_tokens'] = 15
+    _new_messages, messages = backend._prepare_ask_request('new prompt')
+    summary_call_count = len(summary_calls)
+    assert summary_call_count > 0
+    assert messages[0]['role'] == 'system'
+    assert messages[1]['content'].endswith('short summary')
+    assert messages[-1]['content'] == 'new prompt'
+    assert backend.get_num_tokens_from_messages(messages) <= 60
+    success, summary, _ = backend.conversation.get_summary(conversation.id)
+    assert summary.summary == 'short summary'
+    # Asking again with the same history reuses the stored summary.
+    _new_messages, second_messages = backend._prepare_ask_request('new prompt')
+    assert len(summary_calls) == summary_call_count
+    assert second_messages == messages
+
+
+def test_rolling_summary_context_strategy_oversized_newest_message(backend, monkeypatch):
+    conversation = add_conversation(backend, 4)
+    summary_calls = []
+
+    def call_openai_non_streaming(messages, **kwargs):
+        summary_calls.append(messages)
+        return True, FakeCompletion('short summary'), "Response received"
+
+    monkeypatch.setattr(backend, '_call_openai_non_streaming', call_openai_non_streaming)
+    backend.set_model_context_strategy('rolling_summary')
+    backend.set_model_max_submission_tokens(60)
+    backend.context_strategy.config['max_summary_tokens'] = 40
+    prompt = ' '.join(['word'] * 30)
+    _new_messages, messages = backend._prepare_ask_request(prompt)
+    # No room for a summary, so the oldest messages are dropped instead.
+    assert summary_calls == []
+    assert messages[-1]['content'] == prompt
+    assert backend.get_num_tokens_from_messages(messages) <= 60
+    success, summary, _ = backend.conversation.get_summary(conversation.id)
+    assert summary is None
+    with pytest.raises(Exception, match="still over max submission tokens"):
+        backend._prepare_ask_request(' '.join(['word'] * 80))
+    assert summary_calls == []
+
+
+def test_token_encoding_registry_caches_by_model(monkeypatch):
+    loaded = []
+
+    def encoding_for_model(model):
+        loaded.append(model)
+        return FakeEncoding()
+
+    monkeypatch.setattr(tokens.tiktoken, 'encoding_for_model', encoding_for_model)
+    registry = tokens.TokenEncodingRegistry()
+    encoding, cached = registry.get('gpt-4')
+    assert cached is False
+    assert registry.get('gpt-4') == (encoding, True)
+    registry.get('gpt-3.5-turbo')
+    assert loaded == ['gpt-4', 'gpt-3.5-turbo']
+    assert registry.stats() == {'hits': 1, 'misses': 2, 'models': ['gpt-4', 'gpt-3.5-turbo']}
+
+
+def test_get_num_tokens_from_messages_batch(backend, encoding):
+    messages = [
+        backend.build_openai_message('system', 'one two'),
+        backend.build_openai_message('user', 'three'),
+        {'role': 'user', 'name': 'example', 'content': 'four five six'},
+    ]
+    counts = tokens.get_num_tokens_from_messages_batch(messages, encoding)
+    assert list(counts) == [backend.get_num_tokens_from_message(m) for m in messages]
+    assert counts.typecode == 'I'
+
+
+def test_get_messages_target_id(backend):
+    conversation = add_conversation(backend, 10)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    target_id = messages[4].id
+    success, target_messages, _ = backend.message.get_messages(conversation.id, target_id=target_id)
+    assert [m.id for m in target_messages] == [m.id for m in messages[:5]]
+    success, limited_messages, _ = backend.message.get_messages(conversation.id, limit=2, offset=1, target_id=target_id)
+    assert [m.id for m in limited_messages] == [m.id for m in messages[1:3]]
+
+
+def test_get_last_messages(backend):
+    conversation = add_conversation(backend, 10)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    token_counts = backend.get_stored_message_token_counts(messages)
+    success, last_messages, _ = backend.message.get_last_messages(conversation.id, limit=3, target_id=messages[-2].id)
+    assert [m.id for m in last_messages] == [m.id for m in messages[-4:-1]]
+    max_tokens = sum(token_counts[-3:]) + 1
+    success, last_messages, _ = backend.message.get_last_messages(conversation.id, max_tokens=max_tokens)
+    assert [m.id for m in last_messages] == [m.id for m in messages[-3:]]
+
+
+def test_drop_oldest_loads_only_messages_that_fit(backend, monkeypatch):
+    conversation = add_conversation(backend, 40)
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    monkeypatch.setattr(backend.message, 'get_messages', lambda *args, **kwargs: pytest.fail("loaded the full conversation"))
+    monkeypatch.setattr(backend.message, 'get_message_count', lambda *args, **kwargs: pytest.fail("counted the full conversation"))
+    backend.set_model_max_submission_tokens(60)
+    old_messages, new_messages = backend.prepare_prompt_conversation_messages('new prompt', conversation.id)
+    assert old_messages[0].id == messages[0].id
+    assert 1 < len(old_messages) < 10
+    assert old_messages[-1].id == messages[-1].id
+    _new_messages, context = backend._prepare_ask_request('new prompt')
+    assert backend.get_num_tokens_from_messages(context) <= 60
+
+
+def test_managers_share_engine(backend):
+    assert backend.conversation.orm is backend.user_manager.orm
+    assert backend.message.conversation_manager.orm is backend.message.orm
+    assert Database(backend.config).orm.engine is backend.message.orm.engine
+    assert len(engine_registry.engines) == 1
+
+
+def test_sessions_are_thread_local(backend):
+    conversation = add_conversation(backend, 2)
+    main_session = backend.message.orm.session()
+    results = {}
+
+    def worker():
+        success, messages, _ = backend.message.get_messages(conversation.id)
+        results['session'] = backend.message.orm.session()
+        results['count'] = len(messages)
+        backend.message.orm.close_session()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert results['count'] == 3
+    assert results['session'] is not main_session
+    assert backend.message.orm.session() is main_session
+
+
+def test_sqlite_performance_profile(backend):
+    engine = backend.message.orm.engine
+    assert engine.pool.__class__.__name__ == 'QueuePool'
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == 'wal'
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert conn.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+
+
+def test_add_new_messages_to_conversation_single_commit(backend):
+    conversation = add_conversation(backend, 2)
+    updated_time = conversation.updated_time
+    commits = []
+    session = backend.message.orm.session()
+    event.listen(session, 'after_commit', lambda session: commits.append(session))
+    new_messages = [backend.build_openai_message('user', 'new prompt')]
+    conversation, last_message = backend.add_new_messages_to_conversation(conversation.id, new_messages, 'the response')
+    assert len(commits) == 1
+    assert (last_message.role, last_message.message) == ('assistant', 'the response')
+    assert last_message.completion_tokens == backend.get_num_tokens_from_message(backend.build_openai_message('assistant', 'the response'))
+    assert backend.message_token_counts[last_message.id] == last_message.completion_tokens
+    assert conversation.updated_time > updated_time
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    assert [m.message for m in messages[-2:]] == ['new prompt', 'the response']
+
+
+def test_get_history_keyset_pagination(backend):
+    conversation_ids = [backend.conversation.add_conversation(backend.current_user.id, title=f'Conversation {i}')[1].id for i in range(5)]
+    success, history, _ = backend.get_history(limit=2)
+    assert list(history.keys()) == conversation_ids[::-1][:2]
+    assert history[conversation_ids[-1]]['title'] == 'Conversation 4'
+    assert set(history[conversation_ids[-1]].keys()) == {'id', 'title', 'model', 'created_time', 'updated_time', 'hidden'}
+    cursor = backend.get_history_next_cursor(history, 2)
+    success, history, _ = backend.get_history(limit=2, cursor=cursor)
+    assert list(history.keys()) == conversation_ids[::-1][2:4]
+    success, history, _ = backend.get_history(limit=2, cursor=backend.get_history_next_cursor(history, 2))
+    assert list(history.keys()) == conversation_ids[:1]
+    assert backend.get_history_next_cursor(history, 2) is None
+    success, history, message = backend.get_history(limit=2, cursor='not-a-cursor')
+    assert not success
+
+
+def test_search_messages(backend):
+    conversation = add_conversation(backend, 2)
+    backend.add_message('user', 'How do I enable write ahead logging in SQLite?')
+    backend.add_message('assistant', 'Set the journal mode pragma to WAL.')
+    success, results, _ = backend.message.search_messages(backend.current_user.id, 'sqlite logging')
+    assert success
+    assert len(results) == 1
+    assert results[0].conversation_id == conversation.id
+    assert '**SQLite**' in results[0].snippet
+    # Edits and deletes are reflected in the index.
+    with backend.message.orm.engine.begin() as conn:
+        conn.execute(update(Message).where(Message.id == results[0].id).values(message='Nothing to see here'))
+    success, results, _ = backend.message.search_messages(backend.current_user.id, 'sqlite')
+    assert results == []
+    success, results, _ = backend.message.search_messages(backend.current_user.id, 'journal-mode "pragma')
+    assert len(results) == 1
+    backend.message.delete_message(results[0].id)
+    success, results, _ = backend.message.search_messages(backend.current_user.id, 'pragma')
+    assert results == []
+
+
+def test_storage_backends(backend):
+    assert get_storage_class('sqlite:///storage.db') is SqliteOrm
+    assert get_storage_class('postgresql+psycopg2://user@localhost/chatgpt') is PostgresOrm
+    assert get_storage_class('mysql://user@localhost/chatgpt') is Orm
+    assert type(backend.message.orm) is SqliteOrm
+    assert backend.user_manager.orm.find_user(['nobody', 'test']).username == 'test'
+    assert backend.user_manager.orm.find_user(['test@example.com']) is None
+    # The generic implementation, for databases without a specialized one.
+    add_conversation(backend, 2)
+    backend.add_message('user', 'How do I enable write ahead logging in SQLite?')
+    results = Orm(backend.config).search_messages(backend.current_user, 'LOGGING sqlite')
+    assert [r.snippet for r in results] == ['How do I enable write ahead logging in SQLite?']
+    with backend.message.orm.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+
+
+def get_postgres_database():
+    database = os.environ.get('CHATGPT_WRAPPER_TEST_POSTGRES_URL')
+    if not database and shutil.which('pg_tmp'):
+        # A throwaway server, listening on TCP so psycopg2 can connect with a plain URL.
+        database = subprocess.check_output(['pg_tmp', '-t']).decode().strip()
+    return database
+
+
+def test_postgres_storage(tmp_path, monkeypatch):
+    pytest.importorskip('psycopg2')
+    database = get_postgres_database()
+    if not database:
+        pytest.skip('Set CHATGPT_WRAPPER_TEST_POSTGRES_URL or install pg_tmp to test PostgreSQL storage')
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    engine_registry.dispose()
+    config = Config(TEST_CONFIG_DIR, TEST_DATA_DIR, profile=TEST_PROFILE)
+    config.set('database', database)
+    db = Database(config)
+    db.remove_schema()
+    db.create_schema()
+    try:
+        gpt = OpenAIAPI(config)
+        assert type(gpt.message.orm) is PostgresOrm
+        success, user, _ = gpt.user_manager.register('test', None, None)
+        gpt.set_current_user(user)
+        conversation = add_conversation(gpt, 2)
+        messages = gpt.message.orm.add_messages(conversation, [
+            dict(role='user', message='How do I enable write ahead logging in SQLite?', prompt_tokens=0, completion_tokens=0),
+            dict(role='assistant', message='Set the journal mode pragma to WAL.', prompt_tokens=0, completion_tokens=0),
+        ])
+        assert messages[0].id < messages[1].id
+        success, results, _ = gpt.message.search_messages(user.id, 'sqlite logging')
+        assert [r.id for r in results] == [messages[0].id]
+        assert '**logging**' in results[0].snippet
+        archive = Archive(config)
+        path = str(tmp_path / 'export.jsonl')
+        archive.export(user, path)
+        success, other_user, _ = gpt.user_manager.register('other', None, None)
+        assert archive.import_archive(other_user, path) == (1, 5)
+        # COPY with explicit ids left the sequence past them.
+        gpt.conversation.add_conversation(other_user.id, 'After import')
+    finally:
+        db.remove_schema()
+        engine_registry.dispose()
+
+
+def test_postgres_bulk_insert_advances_sequence_without_copy():
+    class RecordingConnection:
+        dialect = pg8000.dialect()
+
+        def __init__(self):
+            self.statements = []
+
+        def execute(self, statement, params=None):
+            self.statements.append((str(statement), params))
+
+    conn = RecordingConnection()
+    orm = PostgresOrm.__new__(PostgresOrm)
+    orm._bulk_insert_rows(conn, Message.__table__, [dict(id=7, conversation_id=1, role='user', message='test')])
+    assert len(conn.statements) == 2
+    assert conn.statements[0][0].startswith('INSERT INTO message')
+    assert 'setval' in conn.statements[1][0]
+    assert conn.statements[1][1] == {'table_name': 'message'}
+    conn = RecordingConnection()
+    orm._bulk_insert_rows(conn, Message.__table__, [dict(conversation_id=1, role='user', message='test')])
+    assert len(conn.statements) == 1
+
+
+def test_ask_stream_iter(backend, monkeypatch):
+    backend.set_llm_class(FakeChatLLM)
+    stream = backend.ask_stream_iter('Hi', title='Streamed')
+    assert ''.join(stream) == FakeChatLLM.reply
+    stream.join()
+    assert stream.result == (True, FakeChatLLM.reply, 'Conversation updated with new messages')
+    assert [m.message for m in backend.message.orm.get_messages(backend.conversation.orm.get_conversation(backend.conversation_id))][-1] == FakeChatLLM.reply
+    assert not backend.streaming
+    # Closing the stream stops generation, and the reply is not saved.
+    monkeypatch.setattr(FakeChatLLM, 'reply', ' '.join(['word'] * 1000))
+    monkeypatch.setattr(FakeChatLLM, 'tokens_sent', 0)
+    message_count = backend.message.orm.get_message_count(backend.conversation.orm.get_conversation(backend.conversation_id))
+    stream = backend.ask_stream_iter('Hi again', max_buffered_tokens=2)
+    assert next(iter(stream)) == 'word'
+    stream.close()
+    stream.join(5)
+    assert not stream.result[0]
+    assert FakeChatLLM.tokens_sent < 10
+    assert not backend.streaming
+    assert backend.message.orm.get_message_count(backend.conversation.orm.get_conversation(backend.conversation_id)) == message_count
+
+
+def test_ask_async(backend, monkeypatch):
+    backend.set_llm_class(FakeChatLLM)
+
+    async def ask():
+        stream = backend.ask_stream_async('Hi', title='Async')
+        tokens = [token async for token in stream]
+        return tokens, await stream.wait(), await backend.ask_async('Again')
+
+    tokens, result, second = asyncio.run(ask())
+    assert ''.join(tokens) == FakeChatLLM.reply
+    assert result == (True, FakeChatLLM.reply, 'Conversation updated with new messages')
+    assert second[1] == FakeChatLLM.reply
+    success, messages, _ = backend.message.get_messages(backend.conversation_id)
+    assert [m.message for m in messages][-4:] == ['Hi', FakeChatLLM.reply, 'Again', FakeChatLLM.reply]
+    # Closing the stream cancels the request, and the reply is not saved.
+    monkeypatch.setattr(FakeChatLLM, 'reply', ' '.join(['word'] * 1000))
+    monkeypatch.setattr(FakeChatLLM, 'tokens_sent', 0)
+
+    async def ask_and_close():
+        stream = backend.ask_stream_async('Stop', max_buffered_tokens=2)
+        async for token in stream:
+            break
+        await stream.aclose()
+        return stream.result
+
+    assert not asyncio.run(ask_and_close())[0]
+    assert FakeChatLLM.tokens_sent < 10
+    assert backend.message.get_message_count(backend.conversation_id)[1] == len(messages)
+
+
+def test_gen_title_uses_request_settings(backend, monkeypatch):
+    models = []
+
+    class TitleLLM(FakeChatLLM):
+        reply = 'A title'
+
+        def __init__(self, model_name=None, **kwargs):
+            models.append(model_name)
+            super().__init__(**kwargs)
+
+    threads = []
+
+    class DeferredThread:
+        def __init__(self, target, args, kwargs):
+            threads.append((target, args, kwargs))
+
+        def start(self):
+            pass
+
+    monkeypatch.setattr(api, 'threading', SimpleNamespace(Thread=DeferredThread))
+    backend.set_llm_class(TitleLLM)
+    conversation = add_conversation(backend, 2)
+    backend.set_active_model('gpt4')
+    backend.gen_title(conversation)
+    # A pooled backend is reset for the next request while the thread runs.
+    backend.set_active_model('default')
+    target, args, kwargs = threads[0]
+    target(*args, **kwargs)
+    assert models == ['gpt-4']
+    assert backend.conversation.get_conversation(args[0])[1].title == 'A title'
+
+
+def test_make_llm_reuses_cached_clients(backend):
+    llm_client_cache.clear()
+    first = backend.make_llm({'temperature': 0.5, 'top_p': 0.9})
+    second = backend.make_llm(backend.streaming_args())
+    # Request arguments are applied to copies of one client.
+    assert (llm_client_cache.stats()['misses'], llm_client_cache.stats()['hits']) == (1, 1)
+    assert first is not second
+    assert (first.temperature, first.model_kwargs, first.streaming) == (0.5, {'top_p': 0.9}, False)
+    assert (second.temperature, second.model_kwargs, second.streaming) == (0, {}, True)
+    backend.set_active_model('gpt4')
+    assert backend.make_llm().model_name == 'gpt-4'
+    assert llm_client_cache.stats()['misses'] == 2
@@ -0,0 +1,40 @@
+import asyncio
+import pytest
+
+from chatgpt_wrapper.backends.openai.pool import BackendPool, AsyncBackendPool, BackendPoolTimeoutError
+
+
+def test_backend_pool_times_out_when_busy(backend):
+    pool = BackendPool(backend.config, size=1, timeout=0.05)
+    gpt = pool.acquire()
+    with pytest.raises(BackendPoolTimeoutError):
+        pool.acquire()
+    assert pool.created == 1
+    pool.release(gpt)
+    assert pool.acquire() is gpt
+
+
+def test_backend_pool_failed_create_frees_its_slot(backend):
+    def fail(config):
+        raise Exception('Backend failed to start')
+
+    pool = BackendPool(backend.config, size=1, timeout=0.05, backend_class=fail)
+    with pytest.raises(Exception, match='Backend failed to start'):
+        pool.acquire()
+    assert pool.created == 0
+
+
+def test_async_backend_pool_times_out_when_busy(backend):
+    pool = AsyncBackendPool(backend.config, size=1, timeout=0.05)
+
+    async def acquire():
+        gpt = await pool.acquire_async()
+        with pytest.raises(BackendPoolTimeoutError):
+            await pool.acquire_async()
+        pool.release_async(gpt)
+        async with pool.backend_async() as again:
+            assert again is gpt
+        return pool.available.locked()
+
+    assert not asyncio.run(acquire())
+    assert pool.created == 1
@@ -0,0 +1,24 @@
+
+from chatgpt_wrapper.backends.openai.repl import ApiRepl
+import chatgpt_wrapper.core.util as util
+import chatgpt_wrapper.core.constants as constants
+
+
+
+def test_repl_history_next_follows_history_command(backend, monkeypatch):
+    conversation_ids = [backend.conversation.add_conversation(backend.current_user.id, title=f'Conversation {i}')[1].id for i in range(5)]
+    repl = ApiRepl.__new__(ApiRepl)
+    repl.backend = backend
+    repl.history_limit = constants.DEFAULT_HISTORY_LIMIT
+    repl.history_next_cursor = None
+    shown = []
+    monkeypatch.setattr(repl, '_print_history', lambda history: shown.append(list(history.keys())))
+    monkeypatch.setattr(util, 'print_markdown', lambda *args, **kwargs: None)
+    assert repl.do_history('next') == (False, None, "No more history")
+    repl.do_history('2')
+    # Listings fetched by other commands do not move the cursor.
+    repl._fetch_history(limit=4)
+    repl.do_history('next')
+    assert shown == [conversation_ids[::-1][:2], conversation_ids[::-1][2:4]]
+    repl.do_history('2 x')
+    assert len(shown) == 2
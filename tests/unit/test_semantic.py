@@ -0,0 +1,83 @@
+import os
+import datetime
+import numpy as np
+
+from sqlalchemy import insert
+from chatgpt_wrapper.backends.openai.orm import Message
+import chatgpt_wrapper.backends.openai.semantic as semantic
+
+from conftest import TEST_DATA_DIR, add_conversation
+
+
+def test_hashing_embedder_is_deterministic():
+    embedder = semantic.HashingEmbedder(dimensions=64)
+    vectors = embedder.embed(['the quick brown fox', 'the quick brown fox', ''])
+    assert vectors.dtype == np.float32
+    assert vectors.shape == (3, 64)
+    assert np.array_equal(vectors[0], vectors[1])
+    assert abs(np.linalg.norm(vectors[0]) - 1.0) < 1e-5
+    assert not vectors[2].any()
+
+
+def test_semantic_search(backend):
+    backend.config.set('semantic_search.directory', os.path.join(TEST_DATA_DIR, 'semantic_index'))
+    add_conversation(backend, 4)
+    backend.new_conversation()
+    target = backend.create_new_conversation_if_needed(title='Databases')
+    backend.add_message('user', 'How do I make sqlite database writes faster?')
+    success, results, _ = backend.semantic_search('faster sqlite writes')
+    assert success
+    assert results[0]['conversation_id'] == target.id
+    # Messages stored after the first search are indexed incrementally.
+    backend.new_conversation()
+    other = backend.create_new_conversation_if_needed(title='Cooking')
+    backend.add_message('user', 'What is a good recipe for banana bread?')
+    success, results, _ = backend.semantic_search('banana bread recipe', limit=1)
+    assert [r['conversation_id'] for r in results] == [other.id]
+    index = semantic.get_semantic_index(backend.config)
+    assert index.metadata['count'] == 7
+
+
+def test_semantic_index_ivf(tmp_path):
+    embedder = semantic.HashingEmbedder(dimensions=32)
+    index = semantic.SemanticIndex(str(tmp_path), embedder, 'sqlite://', ivf_lists=2, nprobe=2)
+    texts = [f'message about topic {i % 5} number {i}' for i in range(40)]
+    index.add([(i + 1, i // 4 + 1, 1, 0) for i in range(len(texts))], texts)
+    assert index.build_ivf()
+    # Probing every list gives the same answer as brute force.
+    assert index.search('topic 3 number 13', limit=1)[0][0] == 14
+    index.add([(41, 11, 2, 0)], ['a message from another user'])
+    assert index.metadata['ivf_count'] == 41
+    assert index.search('another user', user_id=2)[0][0] == 41
+    assert index.search('another user', user_id=3) == []
+
+
+def test_semantic_index_tracks_edits_and_deletes(backend, tmp_path):
+    index = semantic.SemanticIndex(str(tmp_path), semantic.HashingEmbedder(dimensions=64), 'test')
+    orm = backend.message.orm
+    conversation = add_conversation(backend, 3)
+    assert index.sync(backend.message) == 4
+    success, messages, _ = backend.message.get_messages(conversation.id)
+    backend.edit_message(messages[1].id, message='a good recipe for banana bread')
+    # Only the edited message is embedded again, replacing its old vector.
+    assert index.sync(backend.message) == 1
+    assert index.metadata['live_count'] == 4
+    results = index.search('banana bread recipe', limit=10)
+    assert results[0][0] == messages[1].id
+    assert [r[0] for r in results].count(messages[1].id) == 1
+    # Deleted messages are no longer returned.
+    backend.message.delete_message(messages[2].id)
+    assert index.sync(backend.message) == 0
+    assert messages[2].id not in [r[0] for r in index.search('message number 2', limit=10)]
+    # A message that commits after a higher id was indexed is still found.
+    with orm.engine.begin() as conn:
+        conn.execute(insert(Message).values(id=messages[2].id, conversation_id=conversation.id, role='user', message='how to tune sqlite', created_time=datetime.datetime.now(), prompt_tokens=0, completion_tokens=0))
+    assert index.sync(backend.message) == 1
+    assert index.search('tune sqlite', limit=1)[0][0] == messages[2].id
+    assert index.remove([messages[2].id]) == 1
+    assert messages[2].id not in [r[0] for r in index.search('tune sqlite', limit=10)]
+    # Once most rows are tombstones the index is rebuilt.
+    backend.conversation.delete_conversation(conversation.id)
+    index.sync(backend.message)
+    assert index.metadata['count'] == index.metadata['live_count'] == 0
+    assert index.search('banana bread recipe') == []
@@ -0,0 +1,224 @@
+import json
+import threading
+import asyncio
+
+from chatgpt_wrapper.backends.openai.api import OpenAIAPI
+import chatgpt_wrapper.backends.openai.api as api
+
+from conftest import FakeChatLLM
+
+
+def test_api_server_streams_sse(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_api
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    client = gpt_api.create_application('test', backend.config).test_client()
+    response = client.post('/conversations/stream', data='Hi')
+    assert response.mimetype == 'text/event-stream'
+    events = [event.split('\n') for event in response.get_data(as_text=True).split('\n\n') if event and not event.startswith(':')]
+    tokens = [json.loads(data[6:]) for event, data in events if event == 'event: token']
+    assert ''.join(tokens) == FakeChatLLM.reply
+    assert events[-1][0] == 'event: done'
+    assert json.loads(events[-1][1][6:])['success']
+
+
+def test_api_server_per_request_conversations(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_api
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    monkeypatch.setattr(OpenAIAPI, 'gen_title', lambda self, conversation: None)
+    success, other_user, _ = backend.user_manager.register('other', None, None)
+    # Requests close the thread's session, detaching these.
+    user_id, other_user_id = backend.current_user.id, other_user.id
+    app = gpt_api.create_application('test', backend.config, pool_size=2)
+    client = app.test_client()
+    response = client.post(f'/conversations?user_id={user_id}', data='Hi')
+    assert response.get_data(as_text=True) == FakeChatLLM.reply
+    conversation_id = int(response.headers['X-Conversation-Id'])
+    response = client.post(f'/conversations?user_id={user_id}&conversation_id={conversation_id}', data='Again')
+    assert int(response.headers['X-Conversation-Id']) == conversation_id
+    success, messages, _ = backend.message.get_messages(conversation_id)
+    assert [m.message for m in messages][1:] == ['Hi', FakeChatLLM.reply, 'Again', FakeChatLLM.reply]
+    assert int(response.headers['X-Parent-Message-Id']) == messages[-1].id
+    # Conversations belong to their user.
+    response = client.post(f'/conversations?user_id={other_user_id}&conversation_id={conversation_id}', data='Hi')
+    assert response.status_code == 404
+    # Concurrent requests each get a backend, up to the pool size.
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(client.post(f'/conversations?user_id={other_user_id}', data='Hi'))) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [r.status_code for r in responses] == [200] * 6
+    assert len({r.headers['X-Conversation-Id'] for r in responses}) == 6
+    assert app.backend_pool.created <= 2
+    # Only the owner can rename or delete a conversation.
+    assert client.patch(f'/conversations/{conversation_id}/set-title', json={'title': 'Renamed'}).status_code == 400
+    assert client.patch(f'/conversations/{conversation_id}/set-title?user_id={other_user_id}', json={'title': 'Renamed'}).status_code == 404
+    assert client.delete(f'/conversations/{conversation_id}?user_id={other_user_id}').status_code == 404
+    assert client.patch(f'/conversations/{conversation_id}/set-title?user_id={user_id}', json={'title': 'Renamed'}).get_json()['title'] == 'Renamed'
+    assert client.delete(f'/conversations/{conversation_id}?user_id={user_id}').status_code == 200
+    assert not backend.conversation.get_conversation(conversation_id)[0]
+
+
+async def asgi_request(app, method, path, body=b'', query_string=''):
+    """Call an ASGI application, returns (status, headers, body)."""
+    requests = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        if requests:
+            return requests.pop(0)
+        # The client stays connected.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string.encode()}
+    await app(scope, receive, send)
+    headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:]).decode()
+
+
+def test_asgi_server(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_asgi
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    monkeypatch.setattr(OpenAIAPI, 'gen_title', lambda self, conversation: None)
+    success, other_user, _ = backend.user_manager.register('other', None, None)
+    user_id, other_user_id = backend.current_user.id, other_user.id
+    app = gpt_asgi.create_asgi_application(backend.config, pool_size=2)
+
+    async def requests():
+        status, headers, body = await asgi_request(app, 'POST', '/conversations', b'Hi', f'user_id={user_id}')
+        assert (status, body) == (200, FakeChatLLM.reply)
+        conversation_id = headers['x-conversation-id']
+        status, headers, body = await asgi_request(app, 'POST', '/conversations/stream', b'Again', f'user_id={user_id}&conversation_id={conversation_id}')
+        assert headers['content-type'] == 'text/event-stream'
+        events = [event.split('\n') for event in body.split('\n\n') if event and not event.startswith(':')]
+        assert ''.join(json.loads(data[6:]) for event, data in events if event == 'event: token') == FakeChatLLM.reply
+        assert json.loads(events[-1][1][6:])['conversation_id'] == int(conversation_id)
+        status, headers, body = await asgi_request(app, 'GET', f'/history/{user_id}')
+        assert list(json.loads(body)) == [conversation_id]
+        status, headers, body = await asgi_request(app, 'POST', '/conversations', b'Hi', 'user_id=999')
+        assert status == 404
+        # Only the owner can rename or delete a conversation.
+        status, headers, body = await asgi_request(app, 'DELETE', f'/conversations/{conversation_id}')
+        assert status == 400
+        status, headers, body = await asgi_request(app, 'DELETE', f'/conversations/{conversation_id}', query_string=f'user_id={other_user_id}')
+        assert status == 404
+        status, headers, body = await asgi_request(app, 'PATCH', f'/conversations/{conversation_id}/set-title', b'{"title": "Renamed"}', f'user_id={user_id}')
+        assert json.loads(body)['title'] == 'Renamed'
+        return conversation_id
+
+    conversation_id = asyncio.run(requests())
+    success, messages, _ = backend.message.get_messages(int(conversation_id))
+    assert [m.message for m in messages][1:] == ['Hi', FakeChatLLM.reply, 'Again', FakeChatLLM.reply]
+
+
+def test_asgi_websocket_chat_and_drain(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_asgi
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    monkeypatch.setattr(OpenAIAPI, 'gen_title', lambda self, conversation: None)
+    user_id, reply = backend.current_user.id, FakeChatLLM.reply
+    app = gpt_asgi.create_asgi_application(backend.config, pool_size=1)
+
+    async def chat():
+        # The client reads one message at a time.
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue(maxsize=1)
+        scope = {'type': 'websocket', 'path': '/conversations/ws', 'query_string': f'user_id={user_id}'.encode()}
+        connection = asyncio.ensure_future(app(scope, incoming.get, outgoing.put))
+        await incoming.put({'type': 'websocket.connect'})
+        assert (await outgoing.get())['type'] == 'websocket.accept'
+
+        async def ask(prompt):
+            await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'prompt': prompt})})
+            tokens = []
+            while True:
+                message = json.loads((await outgoing.get())['text'])
+                if message['type'] != 'token':
+                    return ''.join(tokens), message
+                tokens.append(message['token'])
+
+        reply, done = await ask('Hi')
+        assert reply == FakeChatLLM.reply and done['success']
+        # Idle connections hold no backend.
+        assert app.pool.backends.qsize() == 1
+        reply, second = await ask('Again')
+        assert second['conversation_id'] == done['conversation_id']
+        # Shutting down stops a response still generating after the drain timeout.
+        monkeypatch.setattr(FakeChatLLM, 'reply', ' '.join(['word'] * 1000))
+        await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'prompt': 'Long'})})
+        assert json.loads((await outgoing.get())['text'])['type'] == 'token'
+        drain = asyncio.ensure_future(app.drain(timeout=0))
+        messages = []
+        while not messages or messages[-1]['type'] != 'websocket.close':
+            messages.append(await outgoing.get())
+        await drain
+        assert messages[-1]['code'] == 1001
+        assert json.loads(messages[-2]['text']) == {'type': 'done', 'success': False, 'error': 'Streaming stopped'}
+        assert len(messages) < 1000
+        await incoming.put({'type': 'websocket.disconnect'})
+        await connection
+        return done['conversation_id']
+
+    conversation_id = asyncio.run(chat())
+    success, messages, _ = backend.message.get_messages(conversation_id)
+    assert [m.message for m in messages][1:] == ['Hi', reply, 'Again', reply]
+
+
+def test_api_server_busy_pool_and_bad_cursor(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_api
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    monkeypatch.setattr(OpenAIAPI, 'gen_title', lambda self, conversation: None)
+    monkeypatch.setitem(backend.config.get('api_server'), 'pool_timeout', 0.05)
+    user_id = backend.current_user.id
+    for title in ['First', 'Second', 'Third']:
+        backend.new_conversation()
+        backend.create_new_conversation_if_needed(title=title)
+    app = gpt_api.create_application('test', backend.config, pool_size=1)
+    client = app.test_client()
+    response = client.get(f'/history/{user_id}?limit=2')
+    assert len(response.get_json()) == 2
+    response = client.get(f"/history/{user_id}?limit=2&cursor={response.headers['X-Next-Cursor']}")
+    assert [c['title'] for c in response.get_json().values()] == ['First']
+    response = client.get(f'/history/{user_id}?cursor=not-a-cursor')
+    assert response.status_code == 400
+    assert not response.get_json()['success']
+    # Requests waiting longer than the pool timeout for a backend are turned away.
+    gpt = app.backend_pool.acquire()
+    response = client.post(f'/conversations?user_id={user_id}', data='Hi')
+    assert response.status_code == 503
+    assert 'busy' in response.get_json()['error']
+    app.backend_pool.release(gpt)
+    assert client.post(f'/conversations?user_id={user_id}', data='Hi').status_code == 200
+
+
+def test_asgi_server_busy_pool_and_bad_cursor(backend, monkeypatch):
+    from chatgpt_wrapper import gpt_asgi
+    monkeypatch.setattr(api, 'ChatOpenAI', FakeChatLLM)
+    monkeypatch.setattr(OpenAIAPI, 'gen_title', lambda self, conversation: None)
+    monkeypatch.setitem(backend.config.get('api_server'), 'pool_timeout', 0.05)
+    user_id = backend.current_user.id
+    for title in ['First', 'Second', 'Third']:
+        backend.new_conversation()
+        backend.create_new_conversation_if_needed(title=title)
+    app = gpt_asgi.create_asgi_application(backend.config, pool_size=1)
+
+    async def requests():
+        status, headers, body = await asgi_request(app, 'GET', f'/history/{user_id}', query_string='limit=2')
+        assert len(json.loads(body)) == 2
+        status, headers, body = await asgi_request(app, 'GET', f'/history/{user_id}', query_string=f"limit=2&cursor={headers['x-next-cursor']}")
+        assert [c['title'] for c in json.loads(body).values()] == ['First']
+        status, headers, body = await asgi_request(app, 'GET', f'/history/{user_id}', query_string='cursor=not-a-cursor')
+        assert status == 400
+        assert not json.loads(body)['success']
+        # Requests waiting longer than the pool timeout for a backend are turned away.
+        gpt = await app.pool.acquire_async()
+        status, headers, body = await asgi_request(app, 'POST', '/conversations', b'Hi', f'user_id={user_id}')
+        assert status == 503
+        assert 'busy' in json.loads(body)['error']
+        app.pool.release_async(gpt)
+        status, headers, body = await asgi_request(app, 'POST', '/conversations', b'Hi', f'user_id={user_id}')
+        assert status == 200
+
+    asyncio.run(requests())